@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""This file contains the inference benchmark: a synthetic dataset with the columns of flows.py
+and the label mix of a configuration is classified by its cascade for every chunk-size and max-threads
+of the sweep, and the throughput, chunk latencies, peak memory and seconds spent in every stage of every node
+(ingest, encode, route, scale, reduce, predict, stats) are written as json
+
+Every sweep point runs in a fresh forked process, so its peak memory isn't inflated by the previous ones.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import argparse, sys, time, io, json, resource, threading, multiprocessing
+import numpy as np
+from lib.cascade import Cascade
+from lib.flowstats import FEATURE_NAMES
+from lib.log import StageTimer
+from lib.adaptive import ChunkSizer
+from lib.config import read_config
+
+# =====================
+#     CLI OPTIONS
+# =====================
+
+op = argparse.ArgumentParser(description="Benchmark the inference cost of a classifier configuration")
+op.add_argument('-c', '--config-file', help="configuration file", dest='config_file', default='configs/ids.cfg')
+op.add_argument('-n', '--rows', type=int, help="rows of the synthetic test dataset", dest='rows', default=100000)
+op.add_argument('--chunk-sizes', help="comma separated chunk-size values to sweep (default: the configured one)", dest='chunk_sizes')
+op.add_argument('--max-threads', help="comma separated max-threads values to sweep (default: the configured one)", dest='max_threads')
+op.add_argument('--label-mix', help="label weights of the synthetic rows, e.g. benign=8,dos=1,portscan=1 (default: every label the nodes know, evenly)", dest='label_mix')
+op.add_argument('--synthetic-train', type=int, metavar='N', help="fit the nodes on N synthetic rows instead of loading or training them from the configured train files", dest='synthetic_train', default=0)
+op.add_argument('-s', '--seed', type=int, help="random seed", dest='seed', default=0)
+op.add_argument('-o', '--output', metavar='FILE', help="json file with the results", dest='output', default='benchmark.json')
+op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
+args = op.parse_args()
+
+# =====================
+#   SYNTHETIC DATASET
+# =====================
+
+def label_mix(cascade):
+    '''{label: weight} of the synthetic rows, labels must be known by every node'''
+    if args.label_mix:
+        mix = {label: float(weight) for label, weight in [item.split('=') for item in args.label_mix.split(',')]}
+    else:
+        l1 = cascade.l1
+        mix = {label: 1.0 for label in list(l1.outputs) + list(l1.label_map) if label != 'unknown'}
+    unknown = [label for label in mix if not all([label in node.outputs or label in node.label_map for node in cascade.nodes])]
+    if unknown:
+        print("Labels %s aren't known by every node of %s" % (','.join(unknown), args.config_file), file=sys.stderr)
+        exit()
+    return mix
+
+def synthetic_dataset(n_rows, mix, rng):
+    '''csv text with the columns of flows.py, the features of every label are drawn around their own random centers'''
+    labels = list(mix)
+    weights = np.array([mix[label] for label in labels])
+    row_labels = rng.choice(len(labels), size=n_rows, p=weights / weights.sum())
+    n_features = len(FEATURE_NAMES) - 2
+    centers = rng.lognormal(2, 1.5, size=(len(labels), n_features))
+    x = centers[row_labels] * rng.lognormal(0, 0.3, size=(n_rows, n_features))
+    out = io.StringIO()
+    out.write(','.join(FEATURE_NAMES) + '\n')
+    for i in range(n_rows):
+        out.write('10.0.%d.%d-%d-192.168.0.1-80-6-0,' % (i // 256 % 256, i % 256, 1024 + i % 60000))
+        out.write(','.join(['%.6g' % v for v in x[i]]))
+        out.write(',%s\n' % labels[row_labels[i]])
+    return out.getvalue()
+
+# =====================
+#      SWEEP POINT
+# =====================
+
+cascade = None # trained cascade and test dataset inherited by the forked sweep points
+dataset = None
+
+def run(chunk_size, max_threads):
+    '''Classify the dataset as classifier.py does with the given chunk size and threads, returns the measures'''
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for node in cascade.nodes:
+        node.timer = StageTimer()
+    l1 = cascade.l1
+    sizer = ChunkSizer.from_config(conf, 'ids', chunk_size) if cascade.chunk_sizer else None # adaptive-chunks: chunk_size is the initial size
+    semaphore = threading.BoundedSemaphore(value=max_threads)
+    latencies = []
+
+    def predict_chunk(test_data, read_time):
+        with semaphore:
+            start_time = time.perf_counter()
+            cascade.predict_chunk(test_data)
+            seconds = time.perf_counter() - start_time
+        latencies.append(time.perf_counter() - read_time)
+        if sizer: sizer.update(len(test_data[0]), seconds)
+
+    threads = []
+    start_time = time.perf_counter()
+    chunks = l1.yield_csvdataset(io.StringIO(dataset), sizer or chunk_size)
+    while True:
+        read_time = time.perf_counter()
+        test_data = next(chunks, None)
+        if test_data is None:
+            break
+        l1.timer.add('ingest', time.perf_counter() - read_time - l1.timer.times['encode'][-1]) # parsing, without the encode stage
+        threads.append(threading.Thread(target=predict_chunk, args=(test_data, time.perf_counter())))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start_time
+
+    n = l1.stats.n
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'chunk_size': chunk_size, 'max_threads': max_threads, 'flows': n, 'seconds': seconds,
+            'flows_per_sec': n / seconds, 'chunks': len(latencies),
+            'latency_p50': float(np.percentile(latencies, 50)), 'latency_p99': float(np.percentile(latencies, 99)),
+            'peak_rss_mb': peak_rss, 'peak_rss_growth_mb': peak_rss - start_rss,
+            'adaptive_chunk_size': {'final': sizer.size, 'smallest': sizer.smallest, 'largest': sizer.largest, 'adjustments': sizer.adjustments} if sizer else None,
+            'nodes': {node.node_name: {'flows': node.stats.n, 'stages': node.timer.summary(),
+                                       'batch_size': node.batch_sizer.size if node.batch_sizer else None} for node in cascade.nodes}}
+
+# =====================
+#         RUN
+# =====================
+
+if __name__ == '__main__':
+    conf = read_config(args.config_file)
+    rng = np.random.default_rng(args.seed)
+
+    cascade = Cascade(conf, args.config_file, verbose=args.verbose)
+    mix = label_mix(cascade)
+    if args.synthetic_train:
+        train_data = synthetic_dataset(args.synthetic_train, mix, rng)
+        for node in cascade.nodes:
+            X_train, y_train, _, _ = node.parse_csvdataset(io.StringIO(train_data))
+            node.fit(X_train, y_train)
+    else:
+        cascade.train()
+
+    start_time = time.time()
+    dataset = synthetic_dataset(args.rows, mix, rng)
+    print("%d synthetic rows (%s) generated in %f seconds" % (args.rows, ', '.join(['%s=%g' % item for item in mix.items()]), time.time() - start_time), file=sys.stderr)
+
+    chunk_sizes = [int(v) for v in args.chunk_sizes.split(',')] if args.chunk_sizes else [cascade.chunk_size]
+    max_threads = [int(v) for v in args.max_threads.split(',')] if args.max_threads else [cascade.max_threads]
+    points = [(c, t) for c in chunk_sizes for t in max_threads]
+    # one process per point, run one at a time so they don't compete for the cores
+    with multiprocessing.get_context('fork').Pool(1, maxtasksperchild=1) as pool:
+        results = pool.starmap(run, points, chunksize=1)
+
+    print("%10s %11s %12s %12s %12s %10s" % ('chunk-size', 'max-threads', 'flows/sec', 'p50 (s)', 'p99 (s)', 'peak MB'), file=sys.stderr)
+    for r in results:
+        print("%10d %11d %12.1f %12.6f %12.6f %10.1f" % (r['chunk_size'], r['max_threads'], r['flows_per_sec'], r['latency_p50'], r['latency_p99'], r['peak_rss_mb']), file=sys.stderr)
+
+    with open(args.output, 'w') as fd:
+        json.dump({'config': args.config_file, 'rows': args.rows, 'label_mix': mix, 'seed': args.seed,
+                   'synthetic_train': args.synthetic_train, 'results': results}, fd, indent=2)
+    print("Results in %s" % args.output, file=sys.stderr)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""This file contains the training sets builder: the layer 1 and layer 2 training datasets
+are sampled from the malign and benign datasets generated by flows.py
+
+  <train dir>/malign/*-<attack>*.csv  +  <train dir>/benign/Monday-WorkingHours*.csv
+      -> <train dir>/layer1/training_L1.csv  and  <train dir>/layer2/benign-<l2 node>.csv
+
+Balancing rules:
+  - every malign file of an attack contributes as many rows as the smallest file of that attack
+  - layer 1 gets the same number of rows of every attack (the smallest attack total), split evenly by its files
+  - layer 2 of an attack gets its malign rows (at most as many as benign rows, split evenly by its files)
+    and as many benign rows
+
+Every file is read once: rows are sampled while streaming with bottom-k sampling (each row gets a random key
+and the rows with the k smallest keys are kept), a fixed seed makes the training sets reproducible.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, argparse, sys, time, glob, heapq, random, hashlib
+
+# attack name in the malign dataset filenames -> layer 2 node
+ATTACKS = [('dos', 'fastdos'), ('patator', 'bruteforce'), ('portscan', 'portscan')]
+
+# =====================
+#     CLI OPTIONS
+# =====================
+
+op = argparse.ArgumentParser(description="Build the layer 1 and layer 2 training datasets")
+op.add_argument('traindir', nargs='?', default='DATA/train', help='train directory, with malign/ and benign/ datasets (e.g. DATA/train/early for the datasets of flows.py --early-packets/--early-seconds)')
+op.add_argument('-s', '--seed', type=int, help="random seed", dest='seed', default=0)
+op.add_argument('--dedup', action='store_true', help="drop rows whose features and label repeat an earlier row of the same file", dest='dedup')
+op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
+args = op.parse_args()
+
+# =====================
+#       SAMPLING
+# =====================
+
+class RowSampler:
+    '''Uniform sample of at most k rows of a stream (bottom-k), k can be lowered while and after streaming'''
+
+    def __init__(self, k, rng):
+        self.k = k
+        self.rng = rng
+        self.heap = []      # (-key, row), the largest key on top
+        self.n = 0
+
+    def add(self, row):
+        self.n += 1
+        key = self.rng.random()
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (-key, row))
+        elif key < -self.heap[0][0]:
+            heapq.heapreplace(self.heap, (-key, row))
+
+    def shrink(self, k):
+        self.k = min(self.k, k)
+        while len(self.heap) > self.k:
+            heapq.heappop(self.heap)
+
+    def rows(self):
+        '''Sampled rows, in random (key) order'''
+        return [row for _, row in sorted(self.heap, reverse=True)]
+
+def read_rows(filename):
+    '''Data rows of a dataset (header skipped), without the repeated ones with --dedup'''
+    seen = set()
+    with open(filename, 'r') as fd:
+        fd.readline()
+        for row in fd:
+            if not row.endswith('\n'): row += '\n'
+            if args.dedup:
+                digest = hashlib.blake2b(row.split(',', 1)[-1].encode('utf-8'), digest_size=16).digest() # flow_id left out
+                if digest in seen:
+                    continue
+                seen.add(digest)
+            yield row
+
+def sample_files(filenames, rng):
+    '''Sample as many rows from every file as the smallest one has, reading each file once
+
+        The smallest files (in bytes) are read first so the sample size is bounded early
+    '''
+    samplers = []
+    bound = float('inf')
+    for filename in filenames:
+        sampler = RowSampler(bound, rng)
+        for row in read_rows(filename):
+            sampler.add(row)
+        bound = min(bound, sampler.n)
+        samplers.append(sampler)
+        if args.verbose: print("%s: %d rows" % (filename, sampler.n), file=sys.stderr)
+    for sampler in samplers:
+        sampler.shrink(bound)
+    return [sampler.rows() for sampler in samplers]
+
+def write_rows(filename, header, groups):
+    with open(filename, 'w') as of:
+        of.write(header)
+        for rows in groups:
+            of.writelines(rows)
+
+# =====================
+#         RUN
+# =====================
+
+if __name__ == '__main__':
+    start_time = time.time()
+    rng = random.Random(args.seed)
+    malign_dir, benign_dir = os.path.join(args.traindir, 'malign'), os.path.join(args.traindir, 'benign')
+    l1_dir, l2_dir = os.path.join(args.traindir, 'layer1'), os.path.join(args.traindir, 'layer2')
+    benign_files = sorted(glob.glob(os.path.join(glob.escape(benign_dir), 'Monday-WorkingHours*.csv')))   # Monday-WorkingHours.csv or Monday-WorkingHours_early.csv
+    if not benign_files:
+        print("No benign dataset Monday-WorkingHours*.csv in %s" % benign_dir, file=sys.stderr)
+        exit()
+    benign_file = benign_files[0]
+    with open(benign_file, 'r') as fd:
+        header = fd.readline()
+
+    # malign rows of every file, as many as the smallest file of the attack
+    malign = []
+    for attack, _ in ATTACKS:
+        filenames = sorted(glob.glob(os.path.join(glob.escape(malign_dir), '*-%s*.csv' % attack)), key=lambda f: (os.path.getsize(f), f))
+        if not filenames:
+            print("No %s datasets (*-%s*.csv) in %s" % (attack, attack, malign_dir), file=sys.stderr)
+            exit()
+        malign.append(sample_files(filenames, rng))
+        print("%s: %d files, %d rows each" % (attack, len(filenames), len(malign[-1][0])), file=sys.stderr)
+    attack_flows = [sum([len(rows) for rows in samples]) for samples in malign]
+
+    # benign rows: every layer 2 set needs at most as many as its attack has
+    benign_samplers = [RowSampler(n, rng) for n in attack_flows]
+    n_benign = 0
+    for row in read_rows(benign_file):
+        n_benign += 1
+        for sampler in benign_samplers:
+            sampler.add(row)
+    print("benign: %d rows" % n_benign, file=sys.stderr)
+
+    os.makedirs(l1_dir, exist_ok=True)
+    os.makedirs(l2_dir, exist_ok=True)
+
+    # layer 1: the same number of rows of every attack
+    min_attack_flows = min(attack_flows)
+    l1_rows = [rng.sample(rows, min(min_attack_flows // len(samples), len(rows))) for samples in malign for rows in samples]
+    write_rows(os.path.join(l1_dir, 'training_L1.csv'), header, l1_rows)
+    print("%s: %d rows" % (os.path.join(l1_dir, 'training_L1.csv'), sum([len(rows) for rows in l1_rows])), file=sys.stderr)
+
+    # layer 2: malign rows of the attack and as many benign rows
+    for (attack, l2_name), samples, n_flows, benign_sampler in zip(ATTACKS, malign, attack_flows, benign_samplers):
+        per_file = min(n_flows, n_benign) // len(samples)
+        l2_rows = [rng.sample(rows, min(per_file, len(rows))) for rows in samples]
+        benign_sampler.shrink(sum([len(rows) for rows in l2_rows]))
+        l2_rows.append(benign_sampler.rows())
+        l2_file = os.path.join(l2_dir, 'benign-%s.csv' % l2_name)
+        write_rows(l2_file, header, l2_rows)
+        print("%s: %d rows" % (l2_file, sum([len(rows) for rows in l2_rows])), file=sys.stderr)
+
+    print("Training sets built in " + str(time.time() - start_time) + " seconds", file=sys.stderr)
@@ -8,22 +8,31 @@ Joao Meira <joao.meira@tekever.com>
 Fabio Almeida <fabio4335@gmail.com>
 """
 
-import os, argparse, re, sys, time
-import numpy as np
-from lib.node import NodeModel
+import os, argparse, sys, time, glob
+startup_time = time.time()
+from lib.cascade import Cascade
+from lib.overload import LoadShedder
+from lib.log import Stats
+from lib.checkpoint import Checkpoint, OffsetReader, OrderedCommits
+from lib.config import read_config
 import threading
-import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 # =====================
 #     CLI OPTIONS
 # =====================
 
 op = argparse.ArgumentParser(description="Multilayered AI traffic classifier")
-op.add_argument('-i', '--input', metavar='FILE', dest='input', help='csv file with test data. If none is given stdin is read')
+op.add_argument('-i', '--input', metavar='FILE', nargs='+', dest='inputs', help='csv files (or globs, e.g. "DATA/test/*.csv") with test data, classified in parallel with per file and total stats. If none is given stdin is read')
+op.add_argument('-j', '--jobs', type=int, help="input files read at the same time (defaults to max-threads)", dest='jobs')
 op.add_argument('-d', '--disable-load', action='store_true', help="disable loading of previously created models", dest='disable_load')
 op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
 op.add_argument('-c', '--config-file', help="configuration file", dest='config_file', default='configs/ids.cfg')
-op.add_argument('-a', '--alert-file', help="alert file", dest='alert_file', default='alerts')
+op.add_argument('-s', '--snapshot', metavar='FILE', help="load the trained cascade from FILE, creating it if missing or outdated", dest='snapshot')
+op.add_argument('-a', '--alert-file', help="csv file with the flow_id, layer 1 label and layer 2 verdict of every flow not classified BENIGN, in input order", dest='alert_file')
+op.add_argument('--checkpoint', metavar='FILE', help="save the progress of the run (input offsets, stats and alert file position) to FILE every --checkpoint-interval seconds", dest='checkpoint')
+op.add_argument('--checkpoint-interval', type=float, metavar='SECONDS', help="seconds between checkpoints", dest='checkpoint_interval', default=60)
+op.add_argument('--resume', action='store_true', help="continue the run saved in the --checkpoint file, with the same inputs and options", dest='resume')
 args = op.parse_args()
 
 # =====================
@@ -31,104 +40,231 @@ args = op.parse_args()
 # =====================
 flow_results = dict()
 # load config file settings
-conf = configparser.ConfigParser(allow_no_value=True)
-conf.optionxform=str
-conf.read(args.config_file)
+conf = read_config(args.config_file)
 
-# load train files
-L1_TRAIN_FILE = conf.get('ids', 'l1')
-L2_NODE_NAMES = [op for op in conf.options('ids') if re.match('l2-.+', op)]
-L2_TRAIN_FILES = [conf.get('ids', node_name) for node_name in L2_NODE_NAMES]
-
-CHUNK_SIZE = conf.getint('ids', 'chunk-size')
-MAX_THREADS = conf.getint('ids', 'max-threads')
 ALERT_LOWER_BOUND_FLOWS = conf.getint('ids', 'lower-bound-flows')
 
-# verifiy configuration integrity
-l2_sections = [s for s in conf.sections() if re.match('l2-.+', s)]
-if l2_sections and not len(L2_NODE_NAMES) == len(conf.options('labels-l1')) == len(l2_sections):
-    print("Number of l1 output labels and l2 nodes don't match in config file %s" % args.config_file)
-    exit()
-if not all([(item[0] == item[1][item[1].find('-')+1:] == item[2][item[2].find('-')+1:]) for item in zip(conf.options('labels-l1'), L2_NODE_NAMES, l2_sections)]):
-    print("Names of l1 output labels do not match l2 node names in config file %s" % args.config_file)
-    exit()
-
 # =====================
 #   CREATE AND TRAIN
 # =====================
 
-# LAYER 1
-l1 = NodeModel('l1', conf, verbose=args.verbose)
-l1.train(L1_TRAIN_FILE, args.disable_load)
-
-# LAYER 2
-l2_nodes = [NodeModel(node_name, conf, verbose=args.verbose) for node_name in L2_NODE_NAMES]
-for node in range(len(l2_nodes)):
-    l2_nodes[node].train(L2_TRAIN_FILES[node], args.disable_load)
+cascade = None
+if args.snapshot and os.path.isfile(args.snapshot) and not args.disable_load:
+    cascade = Cascade.load_snapshot(args.snapshot, conf, args.config_file, verbose=args.verbose)
+    if cascade is None: print("Snapshot %s is outdated, rebuilding it" % args.snapshot, file=sys.stderr)
+if cascade is None:
+    cascade = Cascade(conf, args.config_file, verbose=args.verbose)
+    cascade.train(args.disable_load)
+    if args.snapshot: cascade.save_snapshot(args.snapshot)
+l1, l2_nodes = cascade.l1, cascade.l2_nodes
+L2_NODE_NAMES = cascade.l2_node_names
+CHUNK_SIZE = cascade.chunk_sizer or cascade.chunk_size # adaptive sizer or fixed size
+MAX_THREADS = cascade.max_threads
+print("Startup done in " + str(time.time() - startup_time) + " seconds", file=sys.stderr)
+shedder = LoadShedder(conf)
 
 # =====================
 #   THREAD TEST CHUNK
 # =====================
 
-def predict_chunk(test_data):
+def predict_chunk(test_data, read_time, stats, commit=None):
+    '''Classify a chunk, with commit (OrderedCommits, chunk number, input offset after the chunk, rows read) its
+    results are counted in stats and its alerts written only when every previous chunk of the input was'''
     thread_semaphore.acquire()
-    # LAYER 1
-    y_predicted, flow_ids = l1.predict(test_data)
+    start_time = time.time()
+    if commit is None:
+        cascade.predict_chunk(test_data, stats)
+    else:
+        chunk_stats = {node.node_name: Stats(node) for node in cascade.nodes}
+        results = cascade.predict_chunk(test_data, chunk_stats)
+    thread_semaphore.release()
+    shedder.done(time.time() - read_time)
+    if cascade.chunk_sizer: cascade.chunk_sizer.update(len(test_data[0]), time.time() - start_time)
+    if commit is not None:
+        commits, number, offset, rows = commit
+        alerts = ['%s,%s,%s\n' % result for result in results if result[2] and result[2].lower() != 'benign']
+        commits.add(number, (offset, rows, chunk_stats, alerts))
 
-    # OUTPUT DATA PARTITION TO FEED LAYER 2
-    labels_index = np.argmax(y_predicted, axis=1) if not l1.use_regressor else y_predicted
 
-    # ignore test_data[1] since its only used for l1 crossvalidation
-    filter_labels = lambda x: [np.take(test_data[0], np.where(labels_index == x)[0], axis=0), # x
-                               np.take(test_data[2], np.where(labels_index == x)[0], axis=0), # labels
-                               np.take(test_data[3], np.where(labels_index == x)[0], axis=0)] # flow_ids
-    l2_inputs = [filter_labels(x) for x in range(len(L2_NODE_NAMES))]
+# =====================
+#  CHECKPOINT / ALERTS
+# =====================
 
-    # LAYER 2
-    for node in range(len(l2_nodes)):
-        if len(l2_inputs[node][0]) != 0:
-            current_test_data = l2_nodes[node].process_data(l2_inputs[node][0], l2_inputs[node][1],l2_inputs[node][2])
-            y_predicted, flow_ids = l2_nodes[node].predict(current_test_data)
-            labels_index = np.argmax(y_predicted, axis=1)
-    thread_semaphore.release()
+commit_lock = threading.Lock()
+progress = dict() # filename (None for stdin) -> committed progress, when results are committed in input order (--checkpoint, --alert-file)
+input_stats = dict() # filename -> stats the results of the input are counted in ({node name: Stats})
+checkpoint = Checkpoint(args.checkpoint, args.checkpoint_interval) if args.checkpoint else None
+alert_file = None
+
+def commit_chunk(entry, offset, rows, chunk_stats, alerts):
+    '''Count the results of the next chunk of an input and write its alerts, saving a checkpoint when one is due (commit_lock held)'''
+    stats = input_stats[entry['file']]
+    if chunk_stats is not None:
+        for name, node_stats in chunk_stats.items():
+            stats[name].merge(node_stats)
+    if alerts and alert_file:
+        alert_file.writelines(alerts)
+    entry['offset'] = offset
+    entry['flows'] += rows
+    if checkpoint and checkpoint.due():
+        save_checkpoint()
+
+def save_checkpoint():
+    '''Save the committed progress of every input, their stats and the alert file position (commit_lock held)'''
+    if alert_file:
+        alert_file.flush()
+        os.fsync(alert_file.fileno())
+    checkpoint.save({'config_file': args.config_file, 'alert_file': args.alert_file, 'alert_position': alert_file.tell() if alert_file else None,
+                     'inputs': [dict(entry, stats={name: node_stats.counts_list() for name, node_stats in input_stats[filename].items()})
+                                for filename, entry in progress.items()]})
+
+def resume_checkpoint():
+    '''Restore the progress, stats and alert file of the --checkpoint file, exits if it is not a checkpoint of this run'''
+    global alert_file
+    state = checkpoint.load()
+    if state is None:
+        print("No checkpoint to resume in %s" % args.checkpoint, file=sys.stderr)
+        exit()
+    entries = state['inputs']
+    if state['config_file'] != args.config_file or state['alert_file'] != args.alert_file or [entry['file'] for entry in entries] != inputs:
+        print("Checkpoint %s is of another run (%s -i %s -a %s)" % (args.checkpoint, state['config_file'], ' '.join([entry['file'] for entry in entries]), state['alert_file']), file=sys.stderr)
+        exit()
+    for entry in entries:
+        stat = os.stat(entry['file'])
+        if (entry['size'], entry['mtime']) != (stat.st_size, stat.st_mtime):
+            print("%s changed since checkpoint %s was saved" % (entry['file'], args.checkpoint), file=sys.stderr)
+            exit()
+        for name, counts in entry.pop('stats').items():
+            try:
+                input_stats[entry['file']][name].add_counts(counts)
+            except (KeyError, ValueError) as err:
+                print("Checkpoint %s doesn't match the nodes of %s: %s %s" % (args.checkpoint, args.config_file, name, err), file=sys.stderr)
+                exit()
+        progress[entry['file']] = entry
+    if args.alert_file:
+        alert_file = open(args.alert_file, 'r+')
+        alert_file.truncate(state['alert_position']) # alerts written after the checkpoint are written again
+        alert_file.seek(state['alert_position'])
 
 
 # =====================
 #  LAUNCH TEST THREADS
 # =====================
 
+def classify_input(filename, stats=None):
+    '''Classify a csv file (stdin if None) in chunks, counting the results in stats ({node name: Stats}, the node stats if None)'''
+    entry = progress.get(filename)
+    if entry and entry['done']:
+        print("%s: %d flows predicted before the checkpoint" % (filename, entry['flows']), file=sys.stderr)
+        return entry['flows']
+    if checkpoint:
+        fd = OffsetReader(open(filename, 'rb'), entry['offset'])
+        if entry['offset']: print("%s: resuming at byte %d after %d flows" % (filename, entry['offset'], entry['flows']), file=sys.stderr)
+    else:
+        fd = open(filename, 'r') if filename else sys.stdin
+    commits = OrderedCommits(lambda *chunk: commit_chunk(entry, *chunk), commit_lock) if entry else None
+    start_time = time.time()
+    acc = 0
+    threads = []
+    for number, test_data in enumerate(l1.yield_csvdataset(fd, CHUNK_SIZE)): # launch threads
+        rows = len(test_data[0])
+        acc += rows
+        commit = (commits, number, getattr(fd, 'offset', None), rows) if commits else None
+        test_data = shedder.admit(test_data, l1.input_names) # drops rows when overloaded
+        if test_data is None:
+            if commits: commits.add(number, commit[2:] + (None, []))
+            continue
+        thread = threading.Thread(target=predict_chunk,args=(test_data,time.time(),stats,commit))
+        thread.start()
+        threads.append(thread)
+        threads = [t for t in threads if t.is_alive()]
+
+    if fd != sys.stdin: fd.close()
+    for t in threads: # wait for the remaining threads
+        t.join()
+    if entry:
+        with commit_lock:
+            entry['done'] = True
+            if checkpoint: save_checkpoint()
+    print("%s%d flows predicted in " % ('%s: ' % filename if stats else '', acc) + str(time.time() - start_time) + " seconds", file=sys.stderr)
+    return entry['flows'] if entry else acc # with the flows read before a resumed checkpoint
+
 thread_semaphore = threading.BoundedSemaphore(value=MAX_THREADS)
+inputs = []
+for pattern in args.inputs or []: # expand globs, keeping the given order
+    for filename in sorted(glob.glob(pattern)) or [pattern]:
+        if filename not in inputs: inputs.append(filename)
+missing = [f for f in inputs if not os.path.isfile(f)]
+if missing:
+    print("Input files not found: %s" % ', '.join(missing), file=sys.stderr)
+    exit()
+
+if args.checkpoint and not inputs:
+    print("--checkpoint needs input files (-i), stdin can't be resumed", file=sys.stderr)
+    exit()
+if args.resume and not args.checkpoint:
+    print("--resume needs the --checkpoint file of the run", file=sys.stderr)
+    exit()
+
+# every file has its own stats, the node stats get their sum
+file_stats = [{node.node_name: Stats(node) for node in cascade.nodes} for _ in inputs] if len(inputs) > 1 else [{node.node_name: node.stats for node in cascade.nodes}]
+if checkpoint or args.alert_file:
+    for filename, stats in zip(inputs or [None], file_stats):
+        input_stats[filename] = stats
+    if args.resume:
+        resume_checkpoint()
+    else:
+        for filename in inputs or [None]:
+            stat = os.stat(filename) if filename else None
+            progress[filename] = {'file': filename, 'size': stat and stat.st_size, 'mtime': stat and stat.st_mtime, 'offset': 0, 'flows': 0, 'done': False}
+        if args.alert_file:
+            alert_file = open(args.alert_file, 'w')
+            alert_file.write('flow_id,l1_label,l2_verdict\n')
 
 if args.verbose: print("Reading Test Dataset in chunks...")
-fd = open(args.input, 'r') if args.input else sys.stdin
 start_time = time.time()
-acc = 0
-for test_data in l1.yield_csvdataset(fd, CHUNK_SIZE): # launch threads
-    acc += len(test_data[0])
-    thread = threading.Thread(target=predict_chunk,args=(test_data,))
-    thread.start()
-
-if fd != sys.stdin: fd.close()
-for t in threading.enumerate(): # wait for the remaining threads
-    if t.getName()!="MainThread":
-        t.join()
-print("%d flows predicted in " % acc + str(time.time() - start_time) + " seconds", file=sys.stderr)
+if len(inputs) > 1:
+    with ThreadPoolExecutor(max_workers=args.jobs or MAX_THREADS) as executor:
+        acc = sum(executor.map(classify_input, inputs, file_stats))
+    for stats in file_stats:
+        for node in cascade.nodes:
+            node.stats.merge(stats[node.node_name])
+    print("%d flows of %d files predicted in " % (acc, len(inputs)) + str(time.time() - start_time) + " seconds", file=sys.stderr)
+else:
+    classify_input(inputs[0] if inputs else None)
+if alert_file: alert_file.close()
+if checkpoint and args.verbose: print(checkpoint, file=sys.stderr)
 
 # =====================
 #   PRINT FINAL STATS
 # =====================
 
-if args.input: print(os.path.basename(args.input))
-print("\033[1;36m    LAYER 1\033[m")
-print(l1.stats)
-l1.logger.log("%s\n" % l1.node_name + str(l1.stats))
-# output counter for l2
-print("\033[1;36m    LAYER 2\033[m")
-total = total_correct = total_fp = 0
-for node in range(len(l2_nodes)):
-    if l2_nodes[node].stats.n > 0:
-        total += l2_nodes[node].stats.n
-        total_correct += l2_nodes[node].stats.total_correct
-        print(L2_NODE_NAMES[node])
-        print(l2_nodes[node].stats)
-        l2_nodes[node].logger.log("%s\n" % l2_nodes[node].node_name + str(l2_nodes[node].stats))
+def print_stats(stats, name=''):
+    '''Print and log the stats of both layers ({node name: Stats}), process wide counters only with the node stats (name empty)'''
+    print("\033[1;36m    LAYER 1\033[m")
+    print(stats[l1.node_name])
+    l1.logger.log("%s%s\n" % (name, l1.node_name) + str(stats[l1.node_name]))
+    if not name and l1.prediction_cache: print(l1.prediction_cache)
+    if not name and l1.batch_sizer: print("Batch size: %s\n" % l1.batch_sizer)
+    # output counter for l2
+    print("\033[1;36m    LAYER 2\033[m")
+    for node in range(len(l2_nodes)):
+        node_stats = stats[l2_nodes[node].node_name]
+        if node_stats.n > 0:
+            print(L2_NODE_NAMES[node])
+            print(node_stats)
+            l2_nodes[node].logger.log("%s%s\n" % (name, l2_nodes[node].node_name) + str(node_stats))
+            if not name and l2_nodes[node].prediction_cache: print(l2_nodes[node].prediction_cache)
+            if not name and l2_nodes[node].batch_sizer: print("Batch size: %s\n" % l2_nodes[node].batch_sizer)
+
+if len(inputs) > 1:
+    for filename, stats in zip(inputs, file_stats):
+        print("\033[1;35m%s\033[m" % os.path.basename(filename))
+        print_stats(stats, "%s " % filename)
+    print("\033[1;35mTOTAL (%d files)\033[m" % len(inputs))
+elif inputs: print(os.path.basename(inputs[0]))
+if shedder.enabled: print(shedder)
+if cascade.chunk_sizer:
+    print("Adaptive chunk size: %s" % cascade.chunk_sizer)
+    l1.logger.log("Adaptive chunk size: %s" % cascade.chunk_sizer)
+print_stats({node.node_name: node.stats for node in cascade.nodes})
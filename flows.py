@@ -9,11 +9,14 @@ Fabio Almeida <fabio4335@gmail.com>
 """
 
 import dpkt
-import numpy as np
-import os, sys, time, datetime, socket, argparse
+import os, sys, time, datetime, socket, argparse, pickle, tempfile, heapq, zlib, shutil, bisect
 
 from dpkt.compat import compat_ord
 from collections import OrderedDict
+from multiprocessing import Pool
+from lib.flowstats import FlowAccumulator, FEATURE_NAMES, projection, accumulator_stats
+from lib.cache import FeatureCache
+from lib.checkpoint import Checkpoint
 
 
 # =====================
@@ -26,19 +29,62 @@ op.add_argument('-l', '--label', help="label all the flows", dest='label', defau
 op.add_argument('-o', '--out-dir', help="output directory", dest='outdir')
 op.add_argument('-c', '--check-transport-data-length', action='store_true', help='verbose output', dest='check_transport_data_length')
 op.add_argument('-v', '--verbose', action='store_true', help='verbose output', dest='verbose')
+op.add_argument('-p', '--partitions', type=int, metavar='N', help='out-of-core mode: spill the packets to N partition files by flow, then build the flows of one partition at a time', dest='partitions', default=0)
+op.add_argument('-j', '--jobs', type=int, metavar='N', help='number of partitions processed in parallel (out-of-core mode)', dest='jobs', default=1)
+op.add_argument('--tmp-dir', help='directory for the partition files (out-of-core mode)', dest='tmpdir')
+op.add_argument('--sample-rate', type=float, metavar='R', help='keep only this fraction of the communications (hash based, both directions kept or dropped together)', dest='sample_rate', default=1.0)
+op.add_argument('--max-lag', type=float, metavar='SECONDS', help='overload mode: halve the sample rate while processing lags the capture time by more than SECONDS (live captures), restoring it when the lag drops under half of it', dest='max_lag')
+op.add_argument('--min-sample-rate', type=float, metavar='R', help='lowest sample rate of the overload mode', dest='min_sample_rate', default=1/64.)
+op.add_argument('--index', action='store_true', help='build (or refresh) the seek index of every pcap, <file>.idx, while extracting it', dest='index')
+op.add_argument('--start', metavar='TIME', help='only packets captured at or after TIME (unix time or "YYYY-MM-DD HH:MM:SS[.ffffff]" UTC), seeking with <file>.idx if there is one', dest='start')
+op.add_argument('--end', metavar='TIME', help='only packets captured at or before TIME', dest='end')
+op.add_argument('--host', metavar='IP', help='only packets from or to IP, seeking with <file>.idx if there is one', dest='host')
+op.add_argument('--cache-dir', metavar='DIR', help='cache the extracted datasets in DIR, keyed by the capture and the extraction options, and reuse them', dest='cache_dir')
+op.add_argument('--cache-mb', type=int, metavar='MB', help='remove the least recently used cached datasets past this size (0 = no limit)', dest='cache_mb', default=0)
+op.add_argument('--features', metavar='LIST', help='comma separated features to compute and write (flow_id and label are always written)', dest='features')
+op.add_argument('--model-features', action='store_true', help='compute and write only the features read by the classifier models (time related features are skipped)', dest='model_features')
+op.add_argument('--early-packets', type=int, metavar='N', help='also write provisional features of every flow longer than N packets, computed on its first N packets, to <name>_early.csv while the capture is read', dest='early_packets')
+op.add_argument('--early-seconds', type=float, metavar='T', help='also write provisional features of every flow lasting more than T seconds, computed on its packets up to T seconds, to <name>_early.csv', dest='early_seconds')
+op.add_argument('--checkpoint', metavar='DIR', help='save the progress of every pcap to DIR every --checkpoint-interval seconds (needs --out-dir): the read offset, the sampler decisions, index entries and open flows changed since the previous checkpoint and the dataset lines of the flows ended, in DIR (with --partitions, the packets spilled so far too)', dest='checkpoint')
+op.add_argument('--checkpoint-interval', type=float, metavar='SECONDS', help='seconds between checkpoints', dest='checkpoint_interval', default=60)
+op.add_argument('--resume', action='store_true', help='continue the pcaps from their checkpoint in the --checkpoint directory, skipping the ones already extracted', dest='resume')
 
 args = op.parse_args()
 
+EXTRACTOR_VERSION = 1  # bump when a change in this file changes the extracted datasets, invalidates the feature cache
+
 datetime_format1 = "%Y-%m-%d %H:%M:%S.%f"
 datetime_format2 = "%Y-%m-%d %H:%M:%S"
 scale_factor = 0.001    # milliseconds --> seconds
 packet_len_minimum = 64
 
+def selected_columns():
+    '''Indexes of the FEATURE_NAMES columns to write, None for all of them'''
+    if args.model_features:
+        from lib.node import NodeModel
+        header = (','.join(FEATURE_NAMES) + '\n').split(',')       # as NodeModel reads it
+        return [0] + NodeModel.feature_indexes(header) + [len(FEATURE_NAMES)-1]
+    if args.features:
+        try:
+            return projection(args.features.split(','))
+        except ValueError as err:
+            print(err, file=sys.stderr)
+            exit()
+    return None
+
+feature_columns = selected_columns()
+# the accumulators only keep the statistics read by the columns written, and packet timestamps
+# are only parsed when a time feature (or the early seconds trigger) needs them
+flow_stats = accumulator_stats([FEATURE_NAMES[i] for i in (feature_columns if feature_columns is not None else range(len(FEATURE_NAMES)))])
+parse_times = 'time' in flow_stats or args.early_seconds is not None
+
 def flow_id_to_communication_id(flow_id):
     splitted_flow_id = flow_id.split('-')
     return splitted_flow_id[0] + '-' + splitted_flow_id[2]
 
 def gen_flow_str(flow_features):
+    if feature_columns is not None:
+        flow_features = [flow_features[i] for i in feature_columns]
     return flow_id_to_str(flow_features[0]) + ',' + ','.join(map(str,flow_features[1:])) + '\n'
 
 def flow_id_to_str(flow_id):
@@ -48,6 +94,18 @@ def unix_time_millis(dt):
     epoch = datetime.datetime.utcfromtimestamp(0)
     return (dt - epoch).total_seconds() * 1000.0
 
+def packet_time_millis(pkt_time):
+    '''Timestamp of a packet (its datetime string) in milliseconds'''
+    try:
+        return unix_time_millis(datetime.datetime.strptime(pkt_time, datetime_format1))
+    except ValueError:
+        return unix_time_millis(datetime.datetime.strptime(pkt_time, datetime_format2))
+
+def packet_string_millis(pkt_time):
+    '''packet_time_millis of the datetime strings of process_pcap ("YYYY-MM-DD HH:MM:SS[.ffffff]"), without strptime'''
+    return unix_time_millis(datetime.datetime(int(pkt_time[0:4]), int(pkt_time[5:7]), int(pkt_time[8:10]), int(pkt_time[11:13]),
+                                              int(pkt_time[14:16]), int(pkt_time[17:19]), int(pkt_time[20:26]) if len(pkt_time) > 19 else 0))
+
 def mac_addr(address):
     '''Convert a MAC address to a readable/printable string
        Args:
@@ -71,14 +129,370 @@ def inet_to_str(inet):
     except ValueError:
         return socket.inet_ntop(socket.AF_INET6, inet)
 
+def communication_key(direction_id):
+    '''Key of a packet shared by both directions of its communication'''
+    endpoints = sorted([(direction_id[0],direction_id[1]),(direction_id[2],direction_id[3])])
+    return repr((endpoints,direction_id[4]))
+
+class FlowSampler:
+    '''Deterministic hash based sampling of communications
+
+    A communication is kept if the hash of its key is under the sample rate in effect when its first packet
+    is seen, and then keeps that decision. With max_lag the rate is halved (down to min_rate) while the
+    processing time lags the capture time by more than max_lag seconds and doubled back when the lag drops
+    under max_lag/2. Every rate change starts a period, periods record the exact number of communications
+    and packets seen and kept so downstream counts can be scaled
+
+    Decisions are remembered for the max_decisions communications seen most recently: a communication idle
+    for longer is decided again (the same way unless the rate changed since) and counted again as seen'''
+
+    def __init__(self, rate=1.0, max_lag=None, min_rate=1/64., check_every=1000, max_decisions=1<<20):
+        self.rate = self.max_rate = rate
+        self.max_lag = max_lag
+        self.min_rate = min(min_rate, rate)
+        self.check_every = check_every
+        self.max_decisions = max_decisions
+        self.decisions = OrderedDict()  # communication key -> kept, least recently seen first
+        self.periods = []       # [first packet time, last packet time, sample rate, communications seen, kept, packets seen, kept]
+        self.first_time = self.wall_start = None
+        self.n_packets = 0
+        self.journal = None     # with a list, (key, kept) of every new decision is appended to it (see ExtractionProgress)
+
+    def keep(self, direction_id, timestamp):
+        if self.first_time is None:
+            self.first_time, self.wall_start = timestamp, time.time()
+        if not self.periods or self.periods[-1][2] != self.rate:
+            self.periods.append([timestamp, timestamp, self.rate, 0, 0, 0, 0])
+        period = self.periods[-1]
+        period[1] = timestamp
+
+        key = communication_key(direction_id)
+        kept = self.decisions.get(key)
+        if kept is None:
+            kept = self.decisions[key] = zlib.crc32(key.encode('utf-8')) < self.rate * 2**32
+            if self.journal is not None:
+                self.journal.append((key, kept))
+            if len(self.decisions) > self.max_decisions:
+                self.decisions.popitem(last=False)
+            period[3] += 1
+            period[4] += kept
+        else:
+            self.decisions.move_to_end(key)
+        period[5] += 1
+        period[6] += kept
+
+        self.n_packets += 1
+        if self.max_lag is not None and self.n_packets % self.check_every == 0:
+            lag = (time.time() - self.wall_start) - (timestamp - self.first_time)
+            if lag > self.max_lag:
+                self.rate = max(self.rate/2, self.min_rate)
+            elif lag < self.max_lag/2:
+                self.rate = min(self.rate*2, self.max_rate)
+        return kept
+
+    def lines(self):
+        yield 'first_packet_time,last_packet_time,sample_rate,communications_seen,communications_kept,packets_seen,packets_kept\n'
+        for period in self.periods:
+            yield ','.join(map(str, period)) + '\n'
+
+def parse_time(value):
+    '''Unix time of a --start/--end value'''
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return packet_time_millis(value)*scale_factor
+    except ValueError:
+        print('Invalid time %s, use unix time or "YYYY-MM-DD HH:MM:SS[.ffffff]"' % value, file=sys.stderr)
+        exit()
+
+class PacketWindow:
+    '''Packets between start and end (unix times, None for no limit) from or to host (None for any)
+
+    region is the (first offset, stop offset) of the capture holding all of them, when known from an index'''
+
+    def __init__(self, start=None, end=None, host=None):
+        self.start = start if start is not None else float('-inf')
+        self.end = end if end is not None else float('inf')
+        self.host = host
+        self.region = None
+
+    def in_time(self, timestamp):
+        return self.start <= timestamp <= self.end
+
+class PcapIndex:
+    '''Seek index of a pcap file: capture segments (offset of the first record, min and max timestamp) every
+    segment_size records, and the offsets of the first and last packets of every communication'''
+
+    VERSION = 1
+
+    def __init__(self, filename, segment_size=10000):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        self.segment_size = segment_size
+        self.segments = []      # [offset, min timestamp, max timestamp]
+        self.flows = dict()     # (ip, port, ip, port, protocol) -> [first offset, last offset]
+        self.n_records = 0
+        self.changed = None     # with a dict, the flows added or updated go to it too (see ExtractionProgress)
+
+    @staticmethod
+    def index_filename(filename):
+        return filename + '.idx'
+
+    def add_record(self, offset, timestamp):
+        if self.n_records % self.segment_size == 0:
+            self.segments.append([offset, timestamp, timestamp])
+        segment = self.segments[-1]
+        segment[1] = min(segment[1], timestamp)
+        segment[2] = max(segment[2], timestamp)
+        self.n_records += 1
+
+    def add_packet(self, offset, direction_id):
+        endpoints = sorted([(direction_id[0],direction_id[1]),(direction_id[2],direction_id[3])])
+        key = endpoints[0] + endpoints[1] + (direction_id[4],)
+        if key in self.flows:
+            self.flows[key][1] = offset
+        else:
+            self.flows[key] = [offset, offset]
+        if self.changed is not None:
+            self.changed[key] = self.flows[key]
+
+    def save(self):
+        with open(self.index_filename(self.filename), 'wb') as fd:
+            pickle.dump((self.VERSION, dict(self.__dict__, changed=None)), fd, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        '''Index of filename, None if there is none or the pcap changed since it was built'''
+        try:
+            with open(cls.index_filename(filename), 'rb') as fd:
+                version, state = pickle.load(fd)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        stat = os.stat(filename)
+        if version != cls.VERSION or state['size'] != stat.st_size or state['mtime'] != stat.st_mtime:
+            print('Index of %s is outdated, reading the whole file' % filename, file=sys.stderr)
+            return None
+        index = cls.__new__(cls)
+        index.__dict__.update(state, changed=None)
+        return index
+
+    def region(self, window):
+        '''(first offset, stop offset) of the capture holding every packet in window, stop is None for the end of file'''
+        overlapping = [i for i, (_, min_ts, max_ts) in enumerate(self.segments) if min_ts <= window.end and max_ts >= window.start]
+        if not overlapping:
+            return (0, 0)
+        first = self.segments[overlapping[0]][0]
+        stop = self.segments[overlapping[-1]+1][0] if overlapping[-1]+1 < len(self.segments) else None
+        if window.host is not None:
+            offsets = [offsets for key, offsets in self.flows.items() if window.host in (key[0], key[2])]
+            if not offsets:
+                return (0, 0)
+            first = max(first, min([o[0] for o in offsets]))
+            last = max([o[1] for o in offsets]) + 1
+            stop = last if stop is None else min(stop, last)
+        return (first, stop)
+
+class ExtractionProgress:
+    '''Checkpoint of the extraction of a pcap, <checkpoint dir>/<pcap name>.ckpt, with the files it continues in <pcap name>.state
+
+    The packets read go through the sampler, the index and the flow builder as without a checkpoint, so a checkpoint holds the
+    offset of the next record, the counters of those and the size of every file appended to (a resume truncates them back,
+    so nothing written after the checkpoint is written twice):
+    - journal-<n>.pkl: the sampler decisions, index segments and flows and builder communications (open flows with the few
+      packets their rules still need, and the inflow counter of closed ones) new or changed since the previous checkpoint.
+      Once it is twice as large as when it was last written whole, the next checkpoint writes a new one with their state only
+    - rows.pkl: the dataset lines of the flows ended, the ones since the previous checkpoint appended to it
+    - <name>_early.csv: the provisional rows written as soon as they are known
+    - with --partitions, the partition files the packets are spilled to (their flows are built once all of them are spilled,
+      the builder of the checkpoint only writes the provisional rows)
+    stage is read, spilled (partitions written) or done (datasets written). Decisions are restored in the order they were
+    taken, so after a resume the sampler may forget (see FlowSampler) a communication seen again since a bit earlier'''
+
+    VERSION = 3
+    STATE = ('stage', 'offset', 'n_packets', 'sizes', 'journal', 'journal_size', 'compacted_size', 'rows_size', 'early_size')
+    BUILDER_STATE = ('latest', 'n_packets', 'n_communications', 'n_flow_pkts', 'n_early')
+    MIN_COMPACTED_SIZE = 1 << 24  # bytes, the journal is not rewritten before it is twice this size
+
+    def __init__(self, filename, keep_rows=True):
+        name = os.path.join(args.checkpoint, os.path.basename(filename))
+        self.checkpoint = Checkpoint(name + '.ckpt', args.checkpoint_interval, pickle)
+        self.directory = name + '.state'
+        self.filename, self.keep_rows = filename, keep_rows
+        stat = os.stat(filename)
+        self.key = (self.VERSION, os.path.abspath(filename), stat.st_size, stat.st_mtime, extraction_settings(), args.partitions)
+        self.stage, self.offset, self.n_packets, self.sizes = 'read', None, 0, None
+        self.journal, self.journal_size, self.compacted_size, self.rows_size, self.early_size = None, 0, 0, 0, None
+        self.sampler = self.index = self.builder = self.early_file = None
+        self.n_segments = self.n_rows = 0 # index segments and builder rows saved, the last segment may have changed since
+
+    def start(self):
+        '''Start the extraction over'''
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self.sampler, self.index = new_sampler(), new_index(self.filename)
+        self.early_file = new_early_file(self.filename)
+        self.builder = new_builder(self.early_file, self.keep_rows)
+        self.track()
+
+    def track(self):
+        '''Collect the sampler decisions, index flows and builder communications changed from now on'''
+        if self.sampler: self.sampler.journal = []
+        if self.index:
+            self.index.changed = dict()
+            self.n_segments = len(self.index.segments)
+        if self.builder:
+            self.builder.changed = dict()
+            self.n_rows = len(self.builder.rows)
+
+    def resume(self):
+        '''Restore the saved progress, False if there is none (or it is of another capture or other options)'''
+        state = self.checkpoint.load()
+        if state is None:
+            return False
+        if state['key'] != self.key:
+            print('Checkpoint %s is of another capture or other options, starting over' % self.checkpoint.filename, file=sys.stderr)
+            return False
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        if self.stage != 'read':
+            return True
+        for name, cls in (('sampler', FlowSampler), ('index', PcapIndex)):
+            obj = None
+            if state[name] is not None:
+                obj = cls.__new__(cls)
+                obj.__dict__.update(state[name])
+            setattr(self, name, obj)
+        self.early_file = new_early_file(self.filename, self.early_size)
+        self.builder = new_builder(self.early_file, self.keep_rows)
+        if self.builder:
+            for name in self.BUILDER_STATE:
+                setattr(self.builder, name, state['builder'][name])
+        if self.journal:
+            with open(os.path.join(self.directory, self.journal), 'r+b') as fd:
+                fd.truncate(self.journal_size)  # changes saved after the checkpoint are read again
+                while fd.tell() < self.journal_size:
+                    self.replay(*pickle.load(fd))
+        if self.rows_size:
+            with open(os.path.join(self.directory, 'rows.pkl'), 'r+b') as fd:
+                fd.truncate(self.rows_size)
+                while fd.tell() < self.rows_size:
+                    self.builder.rows.extend(pickle.load(fd))
+        self.track()
+        if self.sampler:
+            self.sampler.first_time = None     # the processing lag is measured again from the first packet read
+        return True
+
+    def replay(self, decisions, first_segment, segments, flows, communications):
+        '''Apply a journal record'''
+        if self.sampler:
+            for key, kept in decisions:
+                self.sampler.decisions[key] = kept
+                self.sampler.decisions.move_to_end(key)
+                if len(self.sampler.decisions) > self.sampler.max_decisions:
+                    self.sampler.decisions.popitem(last=False)
+        if self.index:
+            self.index.segments[first_segment:] = segments
+            self.index.flows.update(flows)
+        if self.builder:
+            for c in communications:
+                self.builder.restore(c)
+
+    def write_journal(self):
+        '''Append the changes since the last checkpoint to the journal, or write a new journal with the whole state'''
+        if self.sampler is None and self.index is None and self.builder is None:
+            return
+        if self.journal is None or self.journal_size > 2 * max(self.compacted_size, self.MIN_COMPACTED_SIZE):
+            record = (list(self.sampler.decisions.items()) if self.sampler else [], 0,
+                      self.index.segments if self.index else [], self.index.flows if self.index else dict(),
+                      self.builder.all_communications() if self.builder else [])
+            generation = int(self.journal[8:-4]) + 1 if self.journal else 0
+            self.journal, mode = 'journal-%d.pkl' % generation, 'wb'
+        else:
+            first_segment = max(self.n_segments - 1, 0)
+            record = (self.sampler.journal if self.sampler else [], first_segment,
+                      self.index.segments[first_segment:] if self.index else [], self.index.changed if self.index else dict(),
+                      list(self.builder.changed.values()) if self.builder else [])
+            mode = 'ab'
+        with open(os.path.join(self.directory, self.journal), mode) as fd:
+            pickle.dump(record, fd, pickle.HIGHEST_PROTOCOL)
+            fd.flush()
+            os.fsync(fd.fileno())
+            self.journal_size = fd.tell()
+        if mode == 'wb':
+            self.compacted_size = self.journal_size
+
+    def write_rows(self):
+        '''Append the rows of the flows ended since the last checkpoint to rows.pkl'''
+        if self.builder is None or len(self.builder.rows) == self.n_rows:
+            return
+        with open(os.path.join(self.directory, 'rows.pkl'), 'ab') as fd:
+            pickle.dump(self.builder.rows[self.n_rows:], fd, pickle.HIGHEST_PROTOCOL)
+            fd.flush()
+            os.fsync(fd.fileno())
+            self.rows_size = fd.tell()
+
+    def due(self):
+        return self.checkpoint.due()
+
+    def save(self, stage, sizes=None, n_packets=None):
+        self.stage = stage
+        if sizes is not None:
+            self.sizes = sizes
+        if n_packets is not None:
+            self.n_packets = n_packets
+        journals = [f for f in os.listdir(self.directory) if f.startswith('journal-')] if os.path.isdir(self.directory) else []
+        if stage == 'read':
+            self.write_journal()
+            self.write_rows()
+            if self.early_file:
+                self.early_size = self.early_file.sync()
+            self.track()
+        else:   # the provisional rows, sampling periods and index are written, only the partitions may still be needed
+            self.sampler = self.index = self.builder = self.early_file = self.journal = None
+            self.journal_size = self.compacted_size = self.rows_size = 0
+        sampler = dict(self.sampler.__dict__, decisions=OrderedDict(), journal=None) if self.sampler else None
+        index = dict(self.index.__dict__, segments=[], flows=dict(), changed=None) if self.index else None
+        builder = dict([(name, getattr(self.builder, name)) for name in self.BUILDER_STATE]) if self.builder else None
+        self.checkpoint.save(dict([(name, getattr(self, name)) for name in self.STATE], key=self.key, sampler=sampler, index=index, builder=builder))
+        for journal in journals:
+            if journal != self.journal:
+                os.remove(os.path.join(self.directory, journal))
+        if stage != 'read' and os.path.isfile(os.path.join(self.directory, 'rows.pkl')):
+            os.remove(os.path.join(self.directory, 'rows.pkl'))
+
 # PROCESS PCAP
-def process_pcap(file):
+def process_pcap(file, sampler=None, window=None, index=None, progress=None):
+    '''This function is a generator of the packet properties of every tcp packet, in capture order
+
+    Packets of communications left out by sampler (a FlowSampler) and packets out of window (a PacketWindow)
+    are skipped, index (a PcapIndex) is filled with every record. With progress (an ExtractionProgress) reading
+    starts at its offset when it has one, and its offset is the one of the record after every packet yielded'''
     pcap = dpkt.pcap.Reader(file)
     n_tcp=0
     n_udp=0
-    packet_properties=[]
 
+    offset = file.tell()        # after the pcap header
+    stop = None
+    if window and window.region:
+        offset, stop = window.region
+        file.seek(offset)
+    if progress and progress.offset is not None:
+        offset = progress.offset
+        file.seek(offset)
     for timestamp, buf in pcap:
+        record_offset, offset = offset, file.tell()
+        if stop is not None and record_offset >= stop:
+            break
+        if index:
+            index.add_record(record_offset, timestamp)
+        elif window and not window.in_time(timestamp):
+            continue
+
         # Unpack the Ethernet frame (mac src/dst, ethertype)
         eth = dpkt.ethernet.Ethernet(buf)
 
@@ -134,373 +548,562 @@ def process_pcap(file):
                 exit()
 
             direction_id=(inet_to_str(ip.src),transport_layer.sport,inet_to_str(ip.dst),transport_layer.dport,transport_protocol_code,0)          # src ip, src port, dst ip, dst port, protocol, inflow_counter
+            if index:
+                index.add_packet(record_offset, direction_id)
+            if window and (not window.in_time(timestamp) or (window.host is not None and window.host not in (direction_id[0], direction_id[2]))):
+                continue
+            if sampler and not sampler.keep(direction_id, timestamp):
+                continue
             packet_info = (direction_id,str(datetime.datetime.utcfromtimestamp(timestamp)),pkt_len,header_len,pkt_size,do_not_fragment,more_fragments,          \
                 fin_flag,syn_flag,rst_flag,psh_flag,ack_flag,urg_flag,ece_flag,cwr_flag) if transport_protocol_name=='TCP'\
                 else (direction_id,str(datetime.datetime.utcfromtimestamp(timestamp)),pkt_len,header_len,pkt_size,do_not_fragment,more_fragments)
-            packet_properties.append(packet_info)
+            if progress:
+                progress.offset = offset
+            yield packet_info
             # eventually_useful = (mac_addr(eth.src),mac_addr(eth.dst),eth.type,fragment_offset)
     if args.verbose:
         print('Total number of packets: %d [TCP %d | UDP %d ]' % (n_udp + n_tcp, n_tcp, n_udp), file=sys.stderr)
-    return packet_properties
-
-def build_uniflows(packet_properties):
-    #associate uniflow_ids to packets
-    uniflows = dict()
-    uniflow_ids = []
-    for prop in packet_properties:
-        uniflow_ids.append(prop[0])
-        if prop[0] in uniflows:
-            uniflows[prop[0]].append(prop)
-        else:
-            uniflows[prop[0]]=[prop]
-    uniflow_ids=list(OrderedDict.fromkeys(uniflow_ids))             #remove duplicates mantaining order
-    if args.verbose:
-        print('Number of unidirectional flows (w/o flag separation):',len(uniflow_ids), file=sys.stderr)
-    return uniflows,uniflow_ids
-
-def parse_duplicates(uniflow_ids):
-    #join unidirectional flows with their counterpart (flows/conversations)
-    duplicates_parsed = []
-    for uniflow_id in uniflow_ids:
-        try:
-            custom_items = [ duplicates_parsed[i] for i in range(5) ]
-        except IndexError:
-            custom_items = []
-        if uniflow_id[0:-1] not in custom_items:
-            duplicates_parsed.append(uniflow_id)
-            duplicates_parsed.append((uniflow_id[2],uniflow_id[3],uniflow_id[0],uniflow_id[1],uniflow_id[4],uniflow_id[5]))
-    return list(OrderedDict.fromkeys(duplicates_parsed))
-
-def build_nsp_flows(uniflows, duplicates_parsed):
-    #join unidirectional flow information into its bidirectional flow equivalent
-    nsp_flows=dict()
-    #non-separated flow ids (flows that haven't yet taken into account the begin/end flow flags)
-    nsp_flow_ids=[]
-    j=0
-    while(j<len(duplicates_parsed)):
-        nsp_flow_id = duplicates_parsed[j]
-        duplicate_id = duplicates_parsed[j+1]
-        # have in mind every flow_id in this list will constitute the first packet ever recorded in that flow,
-        # which is assumed to be the first request, i.e., a 'forward' packet
-        nsp_flow_ids.append(nsp_flow_id)
-        try:
-            nsp_flows[nsp_flow_id] = uniflows[nsp_flow_id] + uniflows[duplicate_id]
-        except KeyError:
-            nsp_flows[nsp_flow_id] = uniflows[nsp_flow_id]
-        j+=2
-    if args.verbose:
-        print('Number of bidirectional flows (w/o flag separation):',len(nsp_flow_ids), file=sys.stderr)
-    return nsp_flows, nsp_flow_ids
-
-def build_tcpflows(nsp_flows,nsp_flow_ids):
-    # TODO: separate using tcp_seq too
-    # fin,syn,rst,psh,ack,urg,ece,cwr (2,...,9)
-    flows=dict()
-    flow_ids=[]         # ordered flow keys (by flow start time)
-
-    # create conventionally correct flows (conversations)
-    for key in nsp_flow_ids:
-        flow = nsp_flows[key]
-        flow.sort(key=lambda x: x[1])       # sorting the packets in each flow by date-and-time
-        if key[4]==17: #udp flow
-            flows[key] = flow
-            flow_ids.append(key)
-            continue
-        flow_n_pkts = len(flow)
 
-        if flow_n_pkts==0:
-            raise ValueError('The flow can\'t have 0 packets.')
-        elif flow_n_pkts in (1,2,3):     #1/2/3 pacotes num so nsp_flow_id perfazem no maximo 1 e 1 so flow
-            flows[key] = flow
-            flow_ids.append(key)
-        else:
-            i=0
-            last_i=0
-            flow_begin=False
-            inflow_counter=0
-            while i<flow_n_pkts:
-                fin1,syn1,rst1,psh1,ack1,urg1,ece1,cwr1=flow[i][-8:]
-                if i==flow_n_pkts-2:   # penultimate packet
-                    fin2,syn2,rst2,psh2,ack2,urg2,ece2,cwr2=flow[i+1][-8:]
-                    fin3,syn3,rst3,psh3,ack3,urg3,ece3,cwr3=[False]*8
-                elif i==flow_n_pkts-1: # last packet
-                    fin2,syn2,rst2,psh2,ack2,urg2,ece2,cwr2=[False]*8
-                    fin3,syn3,rst3,psh3,ack3,urg2,ece3,cwr3=[False]*8
-                else:               # other packets
-                    fin2,syn2,rst2,psh2,ack2,urg2,ece2,cwr2=flow[i+1][-8:]
-                    fin3,syn3,rst3,psh3,ack3,urg3,ece3,cwr3=flow[i+2][-8:]
-
-                ###### TCP FLOW RULES ######
-                # r1,r2: begin flow
-                r1 = (syn1 and not ack1) and (syn2 and ack2) and ack3           # 3-way handshake (full-duplex), syn+syn-ack+ack / syn+syn-ack+syn-ack
-                r2 = (syn1 and not ack1) and ack2                               # 2-way handshake (half-duplex), syn+syn-ack / syn+ack
-                # r3,r4: end flow
-                r3 = fin1 and (fin2 and ack2) and ack3
-                r4 = rst1 and not rst2
-
-                # consider flow begin or ignore it (considering it is safer, but not considering it will leave out flows that have started before the capture)
-                # the only rule used will be the half-duplex handshake rule because it is inclusive of the full-duplex handshake rule
-                if r2:
-                    flow_begin=True
-
-                # we consider flows only the ones that start with a 2 or 3-way handshake (r1,r2)
-                # the flow end conditions are r3 and r4, (fin,fin-ack,ack)/(rst,!rst,---), or if the packet is the last one of the existing communication
-                if flow_begin:
-                    if r3:
-                        new_key=(key[0],key[1],key[2],key[3],key[4],key[5]+inflow_counter)
-                        flows[new_key] = flow[last_i:i+3]
-                        flow_ids.append(new_key)
-                        flow_begin=False
-                        last_i=i+3
-                        inflow_counter+=1
-                    elif r4 or i==flow_n_pkts-1:
-                        new_key=(key[0],key[1],key[2],key[3],key[4],key[5]+inflow_counter)
-                        flows[new_key] = flow[last_i:i+1]
-                        flow_ids.append(new_key)
-                        flow_begin=False
-                        last_i=i+1
-                        inflow_counter+=1
-                i+=1
-    return flows,flow_ids
-
-def calculate_flows_features(flows,flow_ids,label):
-    '''This function is a generator'''
-    flow_properties=[]
-    for flow_id in flow_ids:
-        flow_n_pkts = len(flows[flow_id])
-        direction_id = flows[flow_id][0][0]
-        flow_iats = []
-        fwd_iats = []
-        bwd_iats = []
-        flow_pkt_lens = []
-        fwd_pkt_lens = []
-        bwd_pkt_lens = []
-        flow_header_lens = []
-        fwd_header_lens = []
-        bwd_header_lens = []
-        flow_pkt_sizes = []
-        fwd_pkt_sizes = []
-        bwd_pkt_sizes = []
-        flow_n_data_pkts = 0
-        fwd_n_data_pkts = 0
-        bwd_n_data_pkts = 0
-        flow_flags = []
-
-        i = 0
-        while i<flow_n_pkts:
-            if i>=1:
-                try:
-                    first_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][i-1][1], datetime_format1))
-                except ValueError:
-                    first_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][i-1][1], datetime_format2))
-                try:
-                    second_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][i][1], datetime_format1))
-                except ValueError:
-                    second_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][i][1], datetime_format2))
-                current_iat = scale_factor*(second_pkt_time - first_pkt_time)
-                flow_iats.append(current_iat)
-                if flows[flow_id][i-1][0]==direction_id:
-                    fwd_iats.append(current_iat)
-                else:
-                    bwd_iats.append(current_iat)
-
-            current_pkt_len = flows[flow_id][i][2]
-            current_header_len = flows[flow_id][i][3]
-            current_pkt_size = flows[flow_id][i][4]
-            current_flags = flows[flow_id][i][-10:]
-
-            flow_flags.append(current_flags)
-            flow_pkt_lens.append(current_pkt_len)
-            flow_header_lens.append(current_header_len)
-            flow_pkt_sizes.append(current_pkt_size)
-
-            if flows[flow_id][i][0]==direction_id:
-                fwd_pkt_lens.append(current_pkt_len)
-                fwd_header_lens.append(current_header_len)
-                fwd_pkt_sizes.append(current_pkt_size)
-                if current_header_len != current_pkt_len:
-                    flow_n_data_pkts+=1
-                    fwd_n_data_pkts+=1
-            else:
-                bwd_pkt_lens.append(current_pkt_len)
-                bwd_header_lens.append(current_header_len)
-                bwd_pkt_sizes.append(current_pkt_size)
-                if current_header_len != current_pkt_len:
-                    flow_n_data_pkts+=1
-                    bwd_n_data_pkts+=1
-            i+=1
-
-        # number of packets (all times in seconds)
-        try:
-            first_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][0][1], datetime_format1))
-        except ValueError:
-            first_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][0][1], datetime_format2))
+class Communication:
+    '''Both directions of a communication (see FlowBuilder), with at most the packets its flow rules still need'''
+    __slots__ = ('index', 'key', 'pending', 'window', 'base', 'n_pkts', 'i', 'last_i', 'n_added',
+                 'flow_begin', 'inflow_counter', 'accumulator', 'early_row')
+
+    def __init__(self, index, key):
+        self.index = index          # capture index of its first packet, its flows are written in this order
+        self.key = key              # direction_id of its first packet, which is assumed to be the first request ('forward')
+        self.pending = []           # (time, direction rank, sequence, packet) of the packets not yet known to be in time order, sorted
+        self.window = []            # packets in time order from packet number base on
+        self.base = 0
+        self.n_pkts = 0             # packets in time order so far
+        self.i = 0                  # next packet the flow rules look at
+        self.last_i = 0             # first packet of the current flow
+        self.n_added = 0            # packets last_i to n_added-1 are in accumulator
+        self.flow_begin = False
+        self.inflow_counter = 0
+        self.accumulator = None
+        self.early_row = None       # provisional row of the current flow, kept until the flow begins, True once written
+
+class FlowBuilder:
+    '''Builds the flows of the packets of a capture while they are read, and their dataset lines
+
+    Packets are grouped by communication (both directions, in order of first appearance) and ordered by timestamp,
+    forward packets first on ties, and the flow rules below split every communication into flows. A reverse packet is
+    only taken in time order once a later timestamp is read, and the rules look two packets ahead, so each communication
+    keeps a few packets and the accumulator of its current flow instead of all its packets: the flows are the ones
+    of the list based extraction as long as the capture is in time order (pcap files are written as packets are
+    captured, packets going back in time are taken once read). Dataset lines of the flows ended are kept in rows
+    (unless keep_rows is False) until finish, which returns them in the order of the start of their communication.
+    With early_packets or early_seconds on_early is called with the provisional row of every flow still going on
+    at that point as soon as it is known, i.e. once the flow has begun and a packet after that point was read'''
+
+    def __init__(self, label, early_packets=None, early_seconds=None, on_early=None, keep_rows=True):
+        self.label = label
+        self.early_packets, self.early_seconds = early_packets, early_seconds
+        self.early = on_early is not None and (bool(early_packets) or early_seconds is not None)
+        self.on_early = on_early
+        self.keep_rows = keep_rows
+        self.communications = dict()    # direction_id (of both directions) -> Communication
+        self.rows = []                  # (communication index, inflow counter, dataset line) of every flow ended
+        self.n_early = 0                # provisional rows written
+        self.latest = ''                # latest packet time read
+        self.n_packets = self.n_communications = 0
+        self.n_flow_pkts = 0            # packets in the flows ended
+        self.changed = None             # with a dict, the communications packets are added to go to it too (see ExtractionProgress)
+
+    def add(self, index, packet):
+        '''Add the packet properties yielded by process_pcap, index is its position in the capture'''
+        direction_id, pkt_time = packet[0], packet[1]
+        c = self.communications.get(direction_id)
+        if c is None:
+            c = Communication(index, direction_id)
+            self.restore(c)
+            self.n_communications += 1
+        if self.changed is not None:
+            self.changed[c.key] = c
+        if pkt_time > self.latest:
+            self.latest = pkt_time
+        if c.pending or direction_id != c.key:
+            bisect.insort(c.pending, (pkt_time, 0 if direction_id == c.key else 1, self.n_packets, packet))
+            self.release(c)
+        else:   # no later packet goes before a forward one
+            c.window.append(packet)
+            c.n_pkts += 1
+        self.n_packets += 1
+        if c.i < c.n_pkts - 2 and c.n_pkts > 3:
+            self.apply_rules(c)
+
+    def restore(self, c):
+        '''Add the Communication c, new or saved by a checkpoint'''
+        self.communications[c.key] = self.communications[c.key[2:4] + c.key[0:2] + c.key[4:]] = c
+
+    def all_communications(self):
+        '''Every Communication, in the order of their first packet'''
+        return sorted([c for direction_id, c in self.communications.items() if direction_id == c.key], key=lambda c: c.index)
+
+    def finish(self):
+        '''Apply the flow rules to the last packets of every communication, returns the dataset lines
+        of the flows ordered by the start of their communication (and their inflow counter)'''
+        for c in self.all_communications():
+            self.release(c, True)
+            self.apply_rules(c, True)
+        self.communications = dict()
+        self.rows.sort()
+        return [line for _, _, line in self.rows]
+
+    def release(self, c, last=False):
+        '''Move the pending packets no later packet can go before (all of them if last) to the window:
+        forward packets and packets timed before the latest one read'''
+        pending = c.pending
+        while pending and (last or pending[0][1] == 0 or pending[0][0] < self.latest):
+            c.window.append(pending.pop(0)[3])
+            c.n_pkts += 1
+
+    def apply_rules(self, c, last=False):
+        '''Run the flow rules on every packet of c followed by two more packets, or by the end of the capture if last'''
+        if c.n_pkts <= 3:
+            if last and c.n_pkts:   # 1/2/3 packets make at most 1 flow, whatever their flags
+                self.begin(c)
+                self.end(c, c.n_pkts)
+            return
+
+        # TODO: separate using tcp_seq too
+        # fin,syn,rst,psh,ack (2,...,6) of packets i, i+1 and i+2, all False after the last packet
+        no_flags = (False,)*5
+        while c.i < c.n_pkts - (0 if last else 2):
+            i = c.i
+            fin1,syn1,rst1,psh1,ack1 = c.window[i-c.base][-8:-3]
+            fin2,syn2,rst2,psh2,ack2 = c.window[i+1-c.base][-8:-3] if i+1 < c.n_pkts else no_flags
+            fin3,syn3,rst3,psh3,ack3 = c.window[i+2-c.base][-8:-3] if i+2 < c.n_pkts else no_flags
+            self.accumulate(c, i+1)
+
+            ###### TCP FLOW RULES ######
+            # r1,r2: begin flow
+            # r1 = (syn1 and not ack1) and (syn2 and ack2) and ack3         # 3-way handshake (full-duplex), syn+syn-ack+ack / syn+syn-ack+syn-ack
+            r2 = (syn1 and not ack1) and ack2                               # 2-way handshake (half-duplex), syn+syn-ack / syn+ack
+            # r3,r4: end flow
+            r3 = fin1 and (fin2 and ack2) and ack3
+            r4 = rst1 and not rst2
+
+            # the only rule used to begin a flow is the half-duplex handshake rule because it is inclusive of the full-duplex handshake rule
+            if r2:
+                self.begin(c)
+
+            # we consider flows only the ones that start with a 2 or 3-way handshake (r1,r2)
+            # the flow end conditions are r3 and r4, (fin,fin-ack,ack)/(rst,!rst,---), or if the packet is the last one of the existing communication
+            # packets before the begin of a flow are part of it, the ones after the last flow are left out
+            if c.flow_begin:
+                if r3:
+                    self.end(c, i+3)
+                elif r4 or i == c.n_pkts-1:
+                    self.end(c, i+1)
+            c.i += 1
+
+        # the packets before both the next one to look at and the next one to accumulate are not needed anymore
+        drop = min(c.i, max(c.n_added, c.last_i)) - c.base
+        if drop > 0:
+            del c.window[:drop]
+            c.base += drop
+
+    def flow_id(self, c):
+        return c.key[:5] + (c.key[5] + c.inflow_counter,)
+
+    def accumulate(self, c, stop):
+        '''Add the packets of the current flow of c up to stop (excluded) to its accumulator'''
+        for j in range(max(c.n_added, c.last_i), stop):
+            if c.accumulator is None:
+                c.accumulator = FlowAccumulator(flow_stats)
+            elif self.early and c.early_row is None and self.early_point(c.accumulator):
+                # the flow goes on after its early classification point
+                c.early_row = gen_flow_str(c.accumulator.row(self.flow_id(c), self.label, scale_factor))
+                if c.flow_begin:
+                    self.begin(c)
+            packet = c.window[j-c.base]
+            c.accumulator.add(packet, packet_string_millis(packet[1]) if parse_times else None, scale_factor)
+            c.n_added = j+1
+
+    def early_point(self, accumulator):
+        n_pkts = accumulator.n_pkts
+        return (self.early_packets and n_pkts == self.early_packets) or \
+               (self.early_seconds is not None and n_pkts >= 2 and scale_factor*(accumulator.last_time - accumulator.first_time) >= self.early_seconds)
+
+    def begin(self, c):
+        c.flow_begin = True
+        if isinstance(c.early_row, str):
+            self.on_early(c.early_row)
+            self.n_early += 1
+            c.early_row = True
+
+    def end(self, c, stop):
+        '''End the current flow of c at packet stop (excluded)'''
+        self.accumulate(c, stop)
+        if stop > c.last_i:
+            if self.keep_rows:
+                self.rows.append((c.index, c.inflow_counter, gen_flow_str(c.accumulator.row(self.flow_id(c), self.label, scale_factor))))
+            self.n_flow_pkts += stop - c.last_i
+        c.flow_begin = False
+        c.last_i = c.n_added = stop
+        c.inflow_counter += 1
+        c.accumulator = c.early_row = None
+
+def features_header():
+    return ','.join(FEATURE_NAMES if feature_columns is None else [FEATURE_NAMES[i] for i in feature_columns]) + '\n'
+
+def write_dataset(filename, flow_lines, suffix=''):
+    write_output(filename, [features_header()], suffix)
+    write_output(filename, flow_lines, suffix, append=True)
+
+def output_filename(filename, suffix=''):
+    '''Path of the output of filename with suffix, None for stdout'''
+    outfilename, _ = os.path.splitext(os.path.basename(filename))
+    if suffix or args.outdir: # provisional datasets never go to stdout, they would be mixed with the final one
+        return '%s/%s%s.csv' % (args.outdir or '.', outfilename, suffix)
+    return stdout_file
+
+def write_output(filename, lines, suffix='', append=False):
+    '''Write lines to the output of filename with suffix, noting it for the feature cache when it is used'''
+    outfilename = output_filename(filename, suffix)
+    of = open(outfilename, 'a' if append else 'w') if outfilename else sys.stdout
+    for line in lines:
+        of.write(line)
+    if of != sys.stdout: of.close()
+    if written_outputs is not None:
+        written_outputs.add(suffix)
 
-        try:
-            last_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][flow_n_pkts-1][1], datetime_format1))
-        except ValueError:
-            last_pkt_time = unix_time_millis(datetime.datetime.strptime(flows[flow_id][flow_n_pkts-1][1], datetime_format2))
-        flow_duration = scale_factor*(last_pkt_time - first_pkt_time)
+class RowWriter:
+    '''Dataset of filename with suffix written a row at a time, as the rows are produced
 
-        fwd_n_pkts = len(fwd_pkt_lens)
-        bwd_n_pkts = len(bwd_pkt_lens)
+    The file is line buffered, so every row can be read (and classified) as soon as it is written.
+    With size the file written up to a checkpoint is continued from that size'''
 
-        if flow_duration==0:
-            flow_pkts_per_sec = fwd_pkts_per_sec = bwd_pkts_per_sec = 0
-        else:
-            flow_pkts_per_sec = flow_n_pkts/flow_duration
-            fwd_pkts_per_sec = fwd_n_pkts/flow_duration
-            bwd_pkts_per_sec = bwd_n_pkts/flow_duration
-
-        # packet lengths
-        flow_pkt_len_total = float(np.sum(flow_pkt_lens))           # to add and test x
-        flow_bytes_per_sec = 0 if flow_duration==0 else float(flow_pkt_len_total/flow_duration)
-        flow_pkt_len_mean = float(np.mean(flow_pkt_lens))
-        flow_pkt_len_std = float(np.std(flow_pkt_lens))
-        flow_pkt_len_var = float(np.var(flow_pkt_lens))
-        flow_pkt_len_max = float(np.max(flow_pkt_lens))
-        flow_pkt_len_min = float(np.min(flow_pkt_lens))
-
-        fwd_pkt_len_total = float(np.sum(fwd_pkt_lens))
-        fwd_pkt_len_mean = float(np.mean(fwd_pkt_lens))
-        fwd_pkt_len_std = float(np.std(fwd_pkt_lens))
-        fwd_pkt_len_var = float(np.var(fwd_pkt_lens))               # to add and test x
-        fwd_pkt_len_max = float(np.max(fwd_pkt_lens))
-        fwd_pkt_len_min = float(np.min(fwd_pkt_lens))
-
-        if len(bwd_pkt_lens)!=0:
-            bwd_pkt_len_total = float(np.sum(bwd_pkt_lens))
-            bwd_pkt_len_mean = float(np.mean(bwd_pkt_lens))
-            bwd_pkt_len_std = float(np.std(bwd_pkt_lens))
-            bwd_pkt_len_var = float(np.var(bwd_pkt_lens))           # to add and test x
-            bwd_pkt_len_max = float(np.max(bwd_pkt_lens))
-            bwd_pkt_len_min = float(np.min(bwd_pkt_lens))
+    def __init__(self, filename, suffix, size=None):
+        if size is None:
+            self.of = open(output_filename(filename, suffix), 'w', buffering=1)
+            self.write(features_header())
         else:
-            bwd_pkt_len_total = bwd_pkt_len_mean = bwd_pkt_len_std = bwd_pkt_len_var = bwd_pkt_len_max = bwd_pkt_len_min = 0
-
-        # header lengths
-        fwd_header_len_total = float(np.sum(fwd_header_lens))                                    # 14 byte Ether header + ip header + tcp/udp header
-        bwd_header_len_total = float(np.sum(bwd_header_lens)) if len(bwd_header_lens)!=0 else 0  # 14 byte Ether header + ip header + tcp/udp header
-
-        # packet size
-        flow_pkt_size_mean = float(np.mean(flow_pkt_sizes))
-        flow_pkt_size_std = float(np.std(flow_pkt_sizes))       # to add and test x
-        flow_pkt_size_max = float(np.max(flow_pkt_sizes))       # to add and test x
-        flow_pkt_size_min = float(np.min(flow_pkt_sizes))       # to add and test x
-
-        fwd_pkt_size_mean = float(np.mean(fwd_pkt_sizes))
-        fwd_pkt_size_std = float(np.std(fwd_pkt_sizes))         # to add and test x
-        fwd_pkt_size_max = float(np.max(fwd_pkt_sizes))         # to add and test x
-        fwd_pkt_size_min = float(np.min(fwd_pkt_sizes))
-
-        if len(bwd_pkt_sizes)!=0:
-            bwd_pkt_size_mean = float(np.mean(bwd_pkt_sizes))
-            bwd_pkt_size_std = float(np.std(bwd_pkt_sizes))     # to add and test x
-            bwd_pkt_size_max = float(np.max(bwd_pkt_sizes))     # to add and test x
-            bwd_pkt_size_min = float(np.min(bwd_pkt_sizes))     # to add and test x
-        else:
-            bwd_pkt_size_mean = bwd_pkt_size_std = bwd_pkt_size_max = bwd_pkt_size_min = 0
+            with open(output_filename(filename, suffix), 'r+') as of:
+                of.truncate(size)   # rows written after the checkpoint are written again
+            self.of = open(output_filename(filename, suffix), 'a', buffering=1)
+        if written_outputs is not None:
+            written_outputs.add(suffix)
 
+    def write(self, line):
+        self.of.write(line)
 
-        # packet inter-arrival times
-        if len(flow_iats)!=0:
-            flow_iat_total = float(np.sum(flow_iats))           # to add and test x
-            flow_iat_mean = float(np.mean(flow_iats))
-            flow_iat_std = float(np.std(flow_iats))
-            flow_iat_max = float(np.max(flow_iats))
-            flow_iat_min = float(np.min(flow_iats))
-        else:
-            flow_iat_total = flow_iat_mean = flow_iat_std = flow_iat_max = flow_iat_min = 0
+    def sync(self):
+        '''Write the rows to disk, returns the size of the file'''
+        self.of.flush()
+        os.fsync(self.of.fileno())
+        return self.of.tell()
 
+    def close(self):
+        self.of.close()
 
-        if len(fwd_iats)!=0:
-            fwd_iat_total = float(np.sum(fwd_iats))
-            fwd_iat_mean = float(np.mean(fwd_iats))
-            fwd_iat_std = float(np.std(fwd_iats))
-            fwd_iat_max = float(np.max(fwd_iats))
-            fwd_iat_min = float(np.min(fwd_iats))
+# =====================
+#  OUT-OF-CORE FLOWS
+# =====================
+
+def partition_of(direction_id, n_partitions):
+    '''Partition of a packet: both directions of a communication go to the same one'''
+    return zlib.crc32(communication_key(direction_id).encode('utf-8')) % n_partitions
+
+def spill_partitions(packets, n_partitions, tmpdir, batch_size=10000, progress=None):
+    '''Write the (capture index, packet properties) records of packets to n_partitions files, returns their filenames
+
+    With progress (an ExtractionProgress) the files are appended to from their size at its last checkpoint,
+    and the batches are written and a checkpoint saved whenever one is due (checked every 1000 packets)'''
+    filenames = [os.path.join(tmpdir, 'partition-%d.pkl' % i) for i in range(n_partitions)]
+    if progress and progress.sizes:
+        for filename, size in zip(filenames, progress.sizes):
+            with open(filename, 'ab') as partition_file:
+                partition_file.truncate(size)   # packets spilled after the checkpoint are read again
+    partition_files = [open(filename, 'ab' if progress else 'wb') for filename in filenames]
+    batches = [[] for _ in range(n_partitions)]
+    for index, packet in packets:
+        i = partition_of(packet[0], n_partitions)
+        batches[i].append((index, packet))
+        if len(batches[i]) == batch_size:
+            pickle.dump(batches[i], partition_files[i], pickle.HIGHEST_PROTOCOL)
+            batches[i] = []
+        if progress and index % 1000 == 0 and progress.due():
+            for i, partition_file in enumerate(partition_files):
+                if batches[i]: pickle.dump(batches[i], partition_file, pickle.HIGHEST_PROTOCOL)
+                batches[i] = []
+                partition_file.flush()
+                os.fsync(partition_file.fileno())
+            progress.save('read', [partition_file.tell() for partition_file in partition_files], index + 1)
+    for batch, partition_file in zip(batches, partition_files):
+        if batch: pickle.dump(batch, partition_file, pickle.HIGHEST_PROTOCOL)
+        partition_file.close()
+    return filenames
+
+def read_partition(filename):
+    with open(filename, 'rb') as fd:
+        while True:
+            try:
+                yield from pickle.load(fd)
+            except EOFError:
+                return
+
+def process_partition(filename):
+    '''Build the flows of a partition and write their dataset lines, each prefixed by the capture index
+    of the first packet of its communication, to <partition>.csv
+
+        Returns the filename and the number of flows
+    '''
+    builder = FlowBuilder(args.label, args.early_packets, args.early_seconds)
+    for index, packet in read_partition(filename):
+        builder.add(index, packet)
+    if not args.checkpoint: # checkpointed partitions are removed once the datasets are written
+        os.remove(filename)
+    builder.finish()
+
+    out_filename = filename[:-4] + '.csv'
+    with open(out_filename, 'w') as of:
+        for index, _, line in builder.rows:
+            of.write('%d\t%s' % (index, line))
+    return out_filename, len(builder.rows)
+
+def with_early_rows(packets, builder):
+    '''Pass the (capture index, packet properties) records on, after adding them to builder, which writes
+    the provisional rows of their flows as they are produced'''
+    for index, packet in packets:
+        builder.add(index, packet)
+        yield index, packet
+
+def merge_partitions(filenames):
+    '''Dataset lines of all partitions ordered like the in-memory path (by the start of their communication)'''
+    partition_files = [open(filename, 'r') for filename in filenames]
+    try:
+        for line in heapq.merge(*partition_files, key=lambda line: int(line[:line.index('\t')])):
+            yield line[line.index('\t')+1:]
+    finally:
+        for partition_file in partition_files:
+            partition_file.close()
+
+def new_sampler():
+    if args.sample_rate < 1 or args.max_lag is not None:
+        return FlowSampler(args.sample_rate, args.max_lag, args.min_sample_rate)
+    return None
+
+def new_window(filename):
+    '''PacketWindow of the --start/--end/--host options, with the region to read from the index of filename'''
+    if args.start is None and args.end is None and args.host is None:
+        return None
+    window = PacketWindow(parse_time(args.start), parse_time(args.end), args.host)
+    index = None if args.index else PcapIndex.load(filename)
+    if index:
+        window.region = index.region(window)
+        if args.verbose:
+            print('Reading bytes %d to %s of %d' % (window.region[0], window.region[1] if window.region[1] is not None else 'end', index.size), file=sys.stderr)
+    return window
+
+def new_index(filename):
+    return PcapIndex(filename) if args.index else None
+
+def new_early_file(filename, size=None):
+    '''RowWriter of the provisional rows, None without --early-packets/--early-seconds'''
+    if args.early_packets or args.early_seconds is not None:
+        return RowWriter(filename, '_early', size)
+    return None
+
+def new_builder(early_file, keep_rows=True):
+    '''FlowBuilder writing the provisional rows to early_file, None if it would neither write nor keep any row'''
+    if not keep_rows and early_file is None:
+        return None
+    return FlowBuilder(args.label, args.early_packets, args.early_seconds, early_file.write if early_file else None, keep_rows)
+
+def write_sampling(filename, sampler):
+    '''Write the sampling periods next to the dataset, in <name>_sampling.csv'''
+    if sampler is None:
+        return
+    write_output(filename, sampler.lines(), '_sampling')
+    seen = sum([period[3] for period in sampler.periods])
+    kept = sum([period[4] for period in sampler.periods])
+    print('Sampling: %d of %d communications kept, in %d periods' % (kept, seen, len(sampler.periods)), file=sys.stderr)
+
+def start_checkpoint(file, keep_rows=True):
+    '''ExtractionProgress of file (see ExtractionProgress), continuing the saved progress with --resume,
+    None if file was already extracted'''
+    progress = ExtractionProgress(file.name, keep_rows)
+    if args.resume and progress.resume():
+        if progress.stage == 'done':
+            print('%s was already extracted, skipping it' % file.name, file=sys.stderr)
+            return None
+        if progress.stage == 'read':
+            print('Resuming at byte %d after %d packets' % (progress.offset or 0, progress.n_packets), file=sys.stderr)
+    else:
+        progress.start()
+    return progress
+
+def finish_reading(file, sampler, index, builder, early_file):
+    '''All packets of file read: write the last provisional rows, the sampling periods and the index,
+    returns the dataset lines of builder'''
+    flow_lines = builder.finish() if builder else None
+    if early_file:
+        early_file.close()
+    write_sampling(file.name, sampler)
+    if index: index.save()
+    return flow_lines
+
+def finish_checkpoint(progress):
+    '''Datasets of the checkpointed pcap written: its state is removed and --resume skips it'''
+    if progress:
+        progress.save('done')
+        shutil.rmtree(progress.directory, ignore_errors=True)
+
+def print_partitioned_flows(file):
+    '''Out-of-core print_flows: memory is bounded by the largest partition (times the parallel jobs)'''
+    start_time = time.time()
+    progress = None
+    with tempfile.TemporaryDirectory(dir=args.tmpdir, prefix='flows-') as tmpdir:
+        if args.checkpoint:
+            progress = start_checkpoint(file, keep_rows=False)
+            if progress is None:
+                return
+            tmpdir = progress.directory
+            sampler, index, builder, early_file = progress.sampler, progress.index, progress.builder, progress.early_file
+            start = progress.n_packets
         else:
-            fwd_iat_total = fwd_iat_mean = fwd_iat_std = fwd_iat_max = fwd_iat_min = 0
+            sampler, index = new_sampler(), new_index(file.name)
+            early_file = new_early_file(file.name)
+            builder = new_builder(early_file, keep_rows=False)
+            start = 0
+        filenames = [os.path.join(tmpdir, 'partition-%d.pkl' % i) for i in range(args.partitions)]
+        if progress is None or progress.stage == 'read':
+            packets = enumerate(process_pcap(file, sampler, new_window(file.name), index, progress), start)
+            # the provisional rows are written while reading, the flows of the partitions are built after it
+            if builder:
+                packets = with_early_rows(packets, builder)
+            spill_partitions(packets, args.partitions, tmpdir, progress=progress)
+            finish_reading(file, sampler, index, builder, early_file)
+            if progress:
+                progress.save('spilled', [os.path.getsize(filename) for filename in filenames])
+        print("File processed in \033[34m" + str(time.time() - start_time) + "\033[m seconds", file=sys.stderr)
+        start_time = time.time()
+        if args.jobs > 1:
+            with Pool(args.jobs) as pool:
+                results = pool.map(process_partition, filenames, chunksize=1)
+        else:
+            results = [process_partition(filename) for filename in filenames]
 
+        if args.verbose:
+            print('Number of bidirectional flows (w/ flag separation):',sum([n_flows for _, n_flows in results]), file=sys.stderr)
+        # Error case
+        if sum([n_flows for _, n_flows in results])==0:
+            print('This pcap doesn\'t have any communication that satisfies our flow definition. Abort.', file=sys.stderr)
+            finish_checkpoint(progress)
+            return
 
-        if len(bwd_iats)!=0:
-            bwd_iat_total = float(np.sum(bwd_iats))
-            bwd_iat_mean = float(np.mean(bwd_iats))
-            bwd_iat_std = float(np.std(bwd_iats))
-            bwd_iat_max = float(np.max(bwd_iats))
-            bwd_iat_min = float(np.min(bwd_iats))
-        else:
-            bwd_iat_total = bwd_iat_mean = bwd_iat_std = bwd_iat_max = bwd_iat_min = 0
+        write_dataset(file.name, merge_partitions([out_filename for out_filename, _ in results]))
+        finish_checkpoint(progress)
 
+    print("Dataset generated in \033[34m" + str(time.time() - start_time) + "\033[m seconds", file=sys.stderr)
 
-        # flag counts (ip/tcp)
-        flow_flag_counts = [0]*10           # to add and test x
 
-        for flags in flow_flags:
-            for i,flag in enumerate(flags):
-                if flag:
-                    flow_flag_counts[i]+=1
+# =====================
+#     FEATURE CACHE
+# =====================
 
-        flow_properties = \
-            [flow_id,fwd_header_len_total,bwd_header_len_total,flow_pkt_size_mean,flow_pkt_size_std,flow_pkt_size_max,flow_pkt_size_min,\
-            fwd_pkt_size_mean,fwd_pkt_size_std,fwd_pkt_size_max,bwd_pkt_size_mean,bwd_pkt_size_std,bwd_pkt_size_max,bwd_pkt_size_min,fwd_pkt_size_min,flow_duration,\
-            fwd_n_pkts,bwd_n_pkts,flow_pkts_per_sec,fwd_pkts_per_sec,bwd_pkts_per_sec,flow_bytes_per_sec,\
-            flow_pkt_len_total,flow_pkt_len_mean,flow_pkt_len_std,flow_pkt_len_var,flow_pkt_len_max,flow_pkt_len_min,\
-            fwd_pkt_len_total,fwd_pkt_len_mean,fwd_pkt_len_std,fwd_pkt_len_var,fwd_pkt_len_max,fwd_pkt_len_min,\
-            bwd_pkt_len_total,bwd_pkt_len_mean,bwd_pkt_len_std,bwd_pkt_len_var,bwd_pkt_len_max,bwd_pkt_len_min,\
-            flow_iat_total,flow_iat_mean,flow_iat_std,flow_iat_max,flow_iat_min,\
-            fwd_iat_total,fwd_iat_mean,fwd_iat_std,fwd_iat_max,fwd_iat_min,\
-            bwd_iat_total,bwd_iat_mean,bwd_iat_std,bwd_iat_max,bwd_iat_min,\
-            flow_n_data_pkts,fwd_n_data_pkts,bwd_n_data_pkts] + flow_flag_counts + [label]
-        yield flow_properties
+feature_cache = FeatureCache(args.cache_dir, args.cache_mb * 2**20) if args.cache_dir else None
+written_outputs = None  # suffixes of the outputs written for the file being extracted
+stdout_file = None      # file the dataset goes to instead of stdout while it is extracted for the feature cache
 
-def generate_dataset(filename, flow_features_generator):
-    features_header = 'flow_id,fwd_header_len_total,bwd_header_len_total,flow_pkt_size_mean,flow_pkt_size_std,flow_pkt_size_max,flow_pkt_size_min,fwd_pkt_size_mean,fwd_pkt_size_std,fwd_pkt_size_max,bwd_pkt_size_mean,bwd_pkt_size_std,bwd_pkt_size_max,bwd_pkt_size_min,fwd_pkt_size_min,flow_duration,fwd_n_pkts,bwd_n_pkts,flow_pkts_per_sec,fwd_pkts_per_sec,bwd_pkts_per_sec,flow_bytes_per_sec,flow_pkt_len_total,flow_pkt_len_mean,flow_pkt_len_std,flow_pkt_len_var,flow_pkt_len_max,flow_pkt_len_min,fwd_pkt_len_total,fwd_pkt_len_mean,fwd_pkt_len_std,fwd_pkt_len_var,fwd_pkt_len_max,fwd_pkt_len_min,bwd_pkt_len_total,bwd_pkt_len_mean,bwd_pkt_len_std,bwd_pkt_len_var,bwd_pkt_len_max,bwd_pkt_len_min,flow_iat_total,flow_iat_mean,flow_iat_std,flow_iat_max,flow_iat_min,fwd_iat_total,fwd_iat_mean,fwd_iat_std,fwd_iat_max,fwd_iat_min,bwd_iat_total,bwd_iat_mean,bwd_iat_std,bwd_iat_max,bwd_iat_min,flow_n_data_pkts,fwd_n_data_pkts,bwd_n_data_pkts,flow_df_count,flow_mf_count,flow_fin_count,flow_syn_count,flow_rst_count,flow_psh_count,flow_ack_count,flow_urg_count,flow_ece_count,flow_cwr_count,label\n'
+def extraction_settings():
+    '''String with every option that changes the extracted datasets'''
+    return repr([EXTRACTOR_VERSION, args.label, args.check_transport_data_length, feature_columns, args.early_packets, args.early_seconds,
+                 args.sample_rate, args.min_sample_rate, parse_time(args.start), parse_time(args.end), args.host])
 
-    outfilename, _ = os.path.splitext(os.path.basename(filename))
-    of = open('%s/%s.csv' % (args.outdir, outfilename),'w') if args.outdir else sys.stdout
-    of.write(features_header)
-    for flow_features in flow_features_generator:
-        of.write(gen_flow_str(flow_features))
-    if of != sys.stdout: of.close()
+def copy_output(filename, cached_file, suffix):
+    '''Write the output of filename with suffix from cached_file'''
+    outfilename = output_filename(filename, suffix)
+    if outfilename:
+        shutil.copyfile(cached_file, outfilename)
+    else:
+        with open(cached_file, 'r') as fd:
+            shutil.copyfileobj(fd, sys.stdout)
 
+def print_flows(file):
+    '''Extract the datasets of file, or write them from the feature cache'''
+    global written_outputs, stdout_file
+    # adaptive sampling depends on the processing speed and --index must read the file
+    if feature_cache is None or args.max_lag is not None or args.index:
+        return extract_flows(file)
+    start_time = time.time()
+    entry_file = feature_cache.entry_file(file.name, extraction_settings())
+    outputs = feature_cache.get(entry_file)
+    if outputs is not None:
+        for suffix, cached_file in outputs.items():
+            copy_output(file.name, cached_file, suffix)
+        print("Dataset loaded from cache in \033[34m" + str(time.time() - start_time) + "\033[m seconds", file=sys.stderr)
+        return
+    # the output files are copied to the cache once written, the dataset for stdout goes through a temporary file
+    with tempfile.TemporaryDirectory(dir=args.tmpdir, prefix='flows-') as tmpdir:
+        written_outputs = set()
+        if output_filename(file.name) is None:
+            stdout_file = os.path.join(tmpdir, 'dataset.csv')
+        try:
+            extract_flows(file)
+            outputs = {suffix: output_filename(file.name, suffix) for suffix in written_outputs}
+        finally:
+            written_outputs = stdout_file = None
+        if '' in outputs and output_filename(file.name) is None:
+            copy_output(file.name, outputs[''], '')
+        if outputs:
+            feature_cache.put(entry_file, outputs)
 
 # PRINT FLOWS
-def print_flows(file):
+def extract_flows(file):
+    if args.partitions:
+        return print_partitioned_flows(file)
     start_time = time.time()
 
-    packet_properties = process_pcap(file)
+    progress = None
+    if args.checkpoint:
+        progress = start_checkpoint(file)
+        if progress is None:
+            return
+        sampler, index, builder, early_file = progress.sampler, progress.index, progress.builder, progress.early_file
+    else:
+        sampler, index = new_sampler(), new_index(file.name)
+        # Provisional features of the flows still going on after the early classification point are written as soon as they are known
+        early_file = new_early_file(file.name)
+        builder = new_builder(early_file)
+    for i, packet in enumerate(process_pcap(file, sampler, new_window(file.name), index, progress), progress.n_packets if progress else 0):
+        builder.add(i, packet)
+        if progress and i % 1000 == 0 and progress.due():
+            progress.save('read', n_packets=i+1)
+    flow_lines = finish_reading(file, sampler, index, builder, early_file)
     print("File processed in \033[34m" + str(time.time() - start_time) + "\033[m seconds", file=sys.stderr)
     start_time = time.time()
-    uniflows,uniflow_ids = build_uniflows(packet_properties)
-    del(packet_properties)
-    duplicates_parsed = parse_duplicates(uniflow_ids)
-    del(uniflow_ids)
-    flows,flow_ids = build_nsp_flows(uniflows, duplicates_parsed)
-    del(uniflows)
-    del(duplicates_parsed)
-    flows,flow_ids = build_tcpflows(flows, flow_ids) # At this point, flow_ids are ordered by the flow start time and the packets in each flow are internally ordered by their timestamp
 
     # Print some information about the selected flows
     if args.verbose:
-        all_pkts=0
-        for flow_id in flow_ids:
-            all_pkts+=len(flows[flow_id])
-        print('Number of packets included in the flows\' analysis:',all_pkts, file=sys.stderr)
-        print('Number of bidirectional flows (w/ flag separation):',len(flows), file=sys.stderr)
+        print('Number of bidirectional flows (w/o flag separation):',builder.n_communications, file=sys.stderr)
+        print('Number of packets included in the flows\' analysis:',builder.n_flow_pkts, file=sys.stderr)
+        print('Number of bidirectional flows (w/ flag separation):',len(flow_lines), file=sys.stderr)
+        if early_file:
+            print('Number of flows with early features:',builder.n_early, file=sys.stderr)
 
     # Error case
-    if len(flows)==0:
+    if len(flow_lines)==0:
         print('This pcap doesn\'t have any communication that satisfies our flow definition. Abort.', file=sys.stderr)
+        finish_checkpoint(progress)
         return
 
-    flow_features_generator = calculate_flows_features(flows, flow_ids, args.label)
     # Generate csv file
-    generate_dataset(file.name, flow_features_generator)
+    write_dataset(file.name, flow_lines)
+    finish_checkpoint(progress)
 
     print("Dataset generated in \033[34m" + str(time.time() - start_time) + "\033[m seconds", file=sys.stderr)
 
 if __name__ == '__main__':
+    if args.checkpoint and not args.outdir:
+        print('--checkpoint needs --out-dir, datasets written to stdout can\'t be resumed', file=sys.stderr)
+        exit()
+    if args.resume and not args.checkpoint:
+        print('--resume needs the --checkpoint directory of the run', file=sys.stderr)
+        exit()
     filenames = args.files
     for filename in filenames:
         print("Parsing " + filename + "...", file=sys.stderr)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""This file contains the classifier service: the double layered classifier is loaded once
+and feature batches are classified on request through a unix domain socket
+
+Protocol (one or more requests per connection):
+
+  request     <CSV|NPY> <payload length>\\n<payload>
+              CSV payload: dataset in the format generated by flows.py (header included)
+              NPY payload: numpy .npy 2D float array with the columns used by the classifier
+  response    OK <payload length>\\n<flow_id,l1 label,l2 verdict lines>
+              ERR <message>\\n
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, argparse, sys, time, io, asyncio, signal, socket
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from lib.cascade import Cascade
+from lib.config import read_config, config_files
+
+# =====================
+#     CLI OPTIONS
+# =====================
+
+op = argparse.ArgumentParser(description="Multilayered AI traffic classifier service")
+op.add_argument('-s', '--socket', help="unix socket path", dest='socket', default='/tmp/aids.sock')
+op.add_argument('-c', '--config-file', help="configuration file", dest='config_file', default='configs/ids.cfg')
+op.add_argument('-d', '--disable-load', action='store_true', help="disable loading of previously created models on startup", dest='disable_load')
+op.add_argument('-r', '--reload-interval', type=float, help="seconds between checks for changed model files", dest='reload_interval', default=5.0)
+op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
+op.add_argument('--send', metavar='FILE', help="client mode: send FILE (csv, or npy with --binary) to a running service and print the verdicts", dest='send')
+op.add_argument('--binary', action='store_true', help="client mode: FILE is a .npy array", dest='binary')
+args = op.parse_args()
+
+# =====================
+#       CASCADE
+# =====================
+
+def load_cascade(disable_load=False):
+    '''Read the configuration file and create (or load) every node model'''
+    conf = read_config(args.config_file)
+    cascade = Cascade(conf, args.config_file, verbose=args.verbose)
+    cascade.train(disable_load)
+    return cascade
+
+def artifacts_mtime(cascade):
+    '''Modification times of the configuration and saved model files, used to detect changes'''
+    return {f: os.path.getmtime(f) for f in cascade.artifact_files() + config_files(args.config_file) if os.path.isfile(f)}
+
+def classify(cascade, fmt, payload):
+    '''Classify a request payload, returning the response lines'''
+    if fmt == b'CSV':
+        chunks = cascade.l1.yield_csvdataset(io.StringIO(payload.decode('utf-8')), cascade.chunk_size)
+    elif fmt == b'NPY':
+        x = np.load(io.BytesIO(payload), allow_pickle=False)
+        if len(x.shape) != 2:
+            raise ValueError('NPY payload must be a 2D array')
+        chunks = [cascade.l1.process_data(x, None, [str(i) for i in range(len(x))])] # unlabelled: no label encoding, no stats
+    else:
+        raise ValueError('Unknown payload format %s' % fmt.decode('utf-8', 'replace'))
+    return ''.join(['%s,%s,%s\n' % verdict for test_data in chunks for verdict in cascade.predict_chunk(test_data)])
+
+# =====================
+#       SERVICE
+# =====================
+
+class Service:
+    '''Asyncio front end, predictions run on a thread pool with max-threads workers'''
+
+    def __init__(self, cascade):
+        self.cascade = cascade
+        self.mtimes = artifacts_mtime(cascade)
+        self.executor = ThreadPoolExecutor(max_workers=cascade.max_threads)
+        self.n_requests = 0
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                try:
+                    fmt, length = header.split()
+                    payload = await reader.readexactly(int(length))
+                except (ValueError, asyncio.IncompleteReadError) as err:
+                    writer.write(b'ERR bad request: %s\n' % str(err).encode('utf-8'))
+                    break
+                start_time = time.time()
+                cascade = self.cascade # requests keep the cascade they started with during a reload
+                try:
+                    response = await loop.run_in_executor(self.executor, classify, cascade, fmt, payload)
+                except (Exception, SystemExit) as err:
+                    writer.write(b'ERR %s\n' % repr(err).encode('utf-8'))
+                else:
+                    response = response.encode('utf-8')
+                    writer.write(b'OK %d\n' % len(response) + response)
+                    self.n_requests += 1
+                    cascade.l1.logger.log("request %d classified in %f seconds" % (self.n_requests, time.time() - start_time), cascade.l1.logger.normal, args.verbose)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def watch_models(self):
+        '''Reload the cascade when the configuration or any saved model file changes'''
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(args.reload_interval)
+            mtimes = artifacts_mtime(self.cascade)
+            if mtimes == self.mtimes:
+                continue
+            print("Model files changed, reloading...", file=sys.stderr)
+            try:
+                cascade = await loop.run_in_executor(None, load_cascade)
+            except (Exception, SystemExit) as err:
+                print("Reload failed, keeping previous models: %r" % err, file=sys.stderr)
+                self.mtimes = mtimes
+                continue
+            self.cascade = cascade
+            self.mtimes = artifacts_mtime(cascade)
+            print("Models reloaded", file=sys.stderr)
+
+    async def serve(self):
+        if os.path.exists(args.socket): os.unlink(args.socket)
+        server = await asyncio.start_unix_server(self.handle, path=args.socket)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        watcher = asyncio.ensure_future(self.watch_models())
+        print("Listening on %s" % args.socket, file=sys.stderr)
+        async with server:
+            await stop.wait()
+        watcher.cancel()
+        self.executor.shutdown()
+        if os.path.exists(args.socket): os.unlink(args.socket)
+
+# =====================
+#        CLIENT
+# =====================
+
+def send(filename):
+    with open(filename, 'rb') as fd:
+        payload = fd.read()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.socket)
+        sock.sendall(b'%s %d\n' % (b'NPY' if args.binary else b'CSV', len(payload)) + payload)
+        fd = sock.makefile('rb')
+        status = fd.readline().split()
+        if status[0] != b'OK':
+            print(b' '.join(status[1:]).decode('utf-8'), file=sys.stderr)
+            exit(1)
+        sys.stdout.write(fd.read(int(status[1])).decode('utf-8'))
+
+if __name__ == '__main__':
+    if args.send:
+        send(args.send)
+    else:
+        start_time = time.time()
+        service = Service(load_cascade(args.disable_load))
+        print("Models loaded in " + str(time.time() - start_time) + " seconds", file=sys.stderr)
+        asyncio.run(service.serve())
@@ -0,0 +1,76 @@
+"""This file contains the class ChunkSizer
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import threading
+
+class ChunkSizer:
+	'''Chunk (or batch) size adjusted online from the measured latency and throughput of the chunks
+
+		The size is halved while chunks take longer than the latency target; otherwise, after a few chunks
+		at a size, it moves by a factor of step in the direction that last raised the throughput (rows per second),
+		turning back when the throughput drops. It always stays within [min_size, max_size]
+	'''
+
+	SAMPLES = 3 # full chunks measured at a size before moving it
+
+	def __init__(self, size, min_size, max_size, target=0, step=1.25):
+		self.min_size = max(1, min_size)
+		self.max_size = max(self.min_size, max_size)
+		self.target = target
+		self.step = step
+		self.size = self.clamp(size)
+		self.lock = threading.Lock()
+		self.direction = 1
+		self.throughput = self.previous_throughput = None
+		self.samples = 0
+		self.chunks = self.adjustments = 0
+		self.smallest = self.largest = self.size
+
+	@classmethod
+	def from_config(cls, config, section, size, latency=True):
+		'''Sizer with the chunk-size-min, chunk-size-max and chunk-latency (unless latency is False) of a config section, falling back to [ids]'''
+		option = lambda name, default: config.get(section, name, fallback=config.get('ids', name, fallback=default))
+		return cls(size, int(option('chunk-size-min', 1)), int(option('chunk-size-max', size)), float(option('chunk-latency', 0)) if latency else 0)
+
+	def clamp(self, size):
+		return min(self.max_size, max(self.min_size, int(size)))
+
+	def resize(self, size):
+		size = self.clamp(size)
+		if size != self.size:
+			self.size = size
+			self.adjustments += 1
+			self.smallest, self.largest = min(self.smallest, size), max(self.largest, size)
+		self.throughput = None
+		self.samples = 0
+
+	def update(self, rows, seconds):
+		'''A chunk of rows was processed in seconds (time waiting for a thread left out, chunk size doesn't change it)'''
+		with self.lock:
+			self.chunks += 1
+			if self.target and seconds > self.target:
+				self.direction = -1
+				self.previous_throughput = None
+				self.resize(self.size / 2)
+				return
+			if rows < self.size: # partial chunks (end of input, few routed rows) say nothing about the size
+				return
+			throughput = rows / max(seconds, 1e-9)
+			self.throughput = throughput if self.throughput is None else 0.5 * (self.throughput + throughput)
+			self.samples += 1
+			if self.samples < self.SAMPLES:
+				return
+			if self.previous_throughput is not None and self.throughput < self.previous_throughput:
+				self.direction = -self.direction
+			self.previous_throughput = self.throughput
+			self.resize(self.size * self.step if self.direction > 0 else self.size / self.step)
+
+	def __repr__(self):
+		with self.lock:
+			return "size %d (range %d-%d, bounds %d-%d), %d adjustments in %d chunks" % \
+				(self.size, self.smallest, self.largest, self.min_size, self.max_size, self.adjustments, self.chunks)
@@ -0,0 +1,238 @@
+"""This file contains the classes PredictionCache, ArtifactCache and FeatureCache
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, threading, hashlib, pickle, glob, tempfile, shutil, time
+import numpy as np
+from collections import OrderedDict
+
+class PredictionCache:
+	'''Bounded LRU cache of feature vector -> prediction
+
+		Flood traffic (DoS, port scans) yields many flows with identical features, so every chunk
+		is deduplicated and only rows neither repeated in the chunk nor seen recently are predicted
+	'''
+
+	def __init__(self, size):
+		self.size = size
+		self.cache = OrderedDict()
+		self.lock = threading.Lock()
+		self.lookups = self.hits = 0
+
+	@staticmethod
+	def row_keys(X):
+		'''View each row of X as a single bytes-like value so rows can be hashed and compared at once'''
+		X = np.ascontiguousarray(X)
+		return X.view(np.dtype((np.void, X.dtype.itemsize * X.shape[1]))).ravel()
+
+	def predict(self, X, predict_rows):
+		'''Return predict_rows(X) calling predict_rows only on the rows that aren't cached'''
+		if len(X) == 0:
+			return predict_rows(X)
+		unique_rows, first_index, inverse = np.unique(self.row_keys(X), return_index=True, return_inverse=True)
+		keys = [row.tobytes() for row in unique_rows]
+
+		with self.lock:
+			cached = [self.cache.get(key) for key in keys]
+			for key, y in zip(keys, cached):
+				if y is not None: self.cache.move_to_end(key)
+		missing = [i for i, y in enumerate(cached) if y is None]
+
+		if missing:
+			y_missing = predict_rows(np.take(X, first_index[missing], axis=0))
+			for i, y in zip(missing, y_missing):
+				cached[i] = y
+			with self.lock:
+				for i in missing:
+					self.cache[keys[i]] = cached[i]
+				while len(self.cache) > self.size:
+					self.cache.popitem(last=False)
+
+		with self.lock:
+			self.lookups += len(X)
+			self.hits += len(X) - len(missing)
+		return np.array(cached)[inverse.ravel()]
+
+	def __repr__(self):
+		with self.lock:
+			return "Prediction cache: %d/%d rows served without predicting (hit rate %4f), %d entries\n" % \
+				(self.hits, self.lookups, float(self.hits)/self.lookups if self.lookups else 0, len(self.cache))
+
+class ArtifactCache:
+	'''Directory of fitted node pipelines (model, scaler, feature selection) stored in a single file each
+
+		Entries are named after the train file, a hash of the node settings and a hash of the train data
+		content, so changing any of them never reuses a stale artifact. Files are written atomically and
+		the least recently used ones are removed when the directory grows past max_size bytes (0 = no limit)
+
+		The last use of an entry is its access time, its modification time is the one of its last write only:
+		ids_daemon.py reloads the models when their files are modified, not when another run loads them
+	'''
+
+	SUFFIX = '.pipeline'
+	LINEAGE_SUFFIX = '.lineage.json' # data an entry was refreshed with (see refresh.py), removed with the entry
+
+	def __init__(self, path, max_size=0):
+		self.path = path
+		self.max_size = max_size
+
+	@staticmethod
+	def digest(string):
+		return hashlib.md5(string.encode('utf-8')).hexdigest()[:16]
+
+	def fingerprint(self, filename):
+		'''Hash of size, mtime and content of filename, the content hash is only recomputed when size or mtime change'''
+		stat = os.stat(filename)
+		memo_file = os.path.join(self.path, '.fingerprints', self.digest(os.path.abspath(filename)))
+		if os.path.isfile(memo_file):
+			with open(memo_file, 'r') as fd:
+				size, mtime, content_hash = fd.read().split()
+			if int(size) == stat.st_size and float(mtime) == stat.st_mtime:
+				return content_hash
+		content_md5 = hashlib.md5()
+		with open(filename, 'rb') as fd:
+			for block in iter(lambda: fd.read(1 << 20), b''):
+				content_md5.update(block)
+		content_hash = self.digest('%d %s' % (stat.st_size, content_md5.hexdigest()))
+		self.write_atomic(memo_file, ('%d %r %s' % (stat.st_size, stat.st_mtime, content_hash)).encode('utf-8'))
+		return content_hash
+
+	def entry_file(self, train_filename, settings):
+		'''Cache file of the pipeline fitted with settings (string) on train_filename
+
+			When the train file is not available (e.g. deployed models only) the most recently
+			used entry fitted with the same settings on a file with the same name is returned
+		'''
+		prefix = os.path.join(self.path, '%s-%s-' % (os.path.splitext(train_filename)[0].replace('/','-'), self.digest(settings)))
+		if os.path.isfile(train_filename):
+			return prefix + self.fingerprint(train_filename) + self.SUFFIX
+		entries = sorted(glob.glob(glob.escape(prefix) + '*' + self.SUFFIX), key=os.path.getatime)
+		return entries[-1] if entries else prefix + 'missing' + self.SUFFIX
+
+	@staticmethod
+	def write_atomic(filename, data):
+		if not os.path.isdir(os.path.dirname(filename)):
+			os.makedirs(os.path.dirname(filename), exist_ok=True)
+		fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+		with os.fdopen(fd, 'wb') as tmp_file:
+			tmp_file.write(data)
+		os.chmod(tmp_filename, 0o644) # mkstemp creates files readable only by the owner
+		os.replace(tmp_filename, filename)
+
+	def lineage_file(self, entry_file):
+		return entry_file[:-len(self.SUFFIX)] + self.LINEAGE_SUFFIX
+
+	def get(self, entry_file):
+		'''Return the cached pipeline or None, marking the entry as recently used'''
+		try:
+			with open(entry_file, 'rb') as fd:
+				pipeline = pickle.loads(fd.read())
+		except (OSError, pickle.UnpicklingError, EOFError):
+			return None
+		self.touch(entry_file)
+		return pipeline
+
+	@staticmethod
+	def touch(entry_file):
+		'''Mark the entry as used now, keeping its modification time'''
+		os.utime(entry_file, ns=(time.time_ns(), os.stat(entry_file).st_mtime_ns))
+
+	def put(self, entry_file, pipeline, refreshed=False):
+		'''Store the pipeline of entry_file, fitted on its train file only unless refreshed (see refresh.py): the lineage of
+		previous refreshes is then removed, the pipeline doesn't contain them anymore'''
+		self.write_atomic(entry_file, pickle.dumps(pipeline))
+		if not refreshed and os.path.isfile(self.lineage_file(entry_file)):
+			os.remove(self.lineage_file(entry_file))
+		self.evict(keep=entry_file)
+
+	def evict(self, keep=None):
+		'''Remove least recently used entries until the cache fits in max_size'''
+		if not self.max_size:
+			return
+		entries = sorted(glob.glob(os.path.join(glob.escape(self.path), '*' + self.SUFFIX)), key=os.path.getatime)
+		total = sum([self.entry_size(f) for f in entries])
+		for entry_file in entries:
+			if total <= self.max_size:
+				break
+			if entry_file != keep:
+				try:
+					total -= self.entry_size(entry_file)
+					self.remove(entry_file)
+				except OSError: # already removed by another process
+					pass
+
+	@staticmethod
+	def entry_size(entry_file):
+		return os.path.getsize(entry_file)
+
+	def remove(self, entry_file):
+		os.remove(entry_file)
+		if os.path.isfile(self.lineage_file(entry_file)):
+			os.remove(self.lineage_file(entry_file))
+
+class FeatureCache(ArtifactCache):
+	'''Directory of the datasets extracted by flows.py from a capture, keyed by the capture fingerprint and the extraction settings
+
+		Captures can be tens of GB, so the fingerprint hashes the size, mtime and sampled blocks of the file instead of its whole content.
+		Datasets can be as large, so an entry is a directory with a copy of each output file (<suffix>.csv, dataset.csv for
+		the one without suffix), copied in and out a block at a time
+	'''
+
+	SUFFIX = '.features'
+	BLOCK_SIZE = 1 << 16
+	N_BLOCKS = 64
+
+	def fingerprint(self, filename):
+		stat = os.stat(filename)
+		content_md5 = hashlib.md5()
+		with open(filename, 'rb') as fd:
+			for i in range(self.N_BLOCKS):
+				fd.seek(max(stat.st_size - self.BLOCK_SIZE, 0) * i // (self.N_BLOCKS - 1))
+				content_md5.update(fd.read(self.BLOCK_SIZE))
+		return self.digest('%d %r %s' % (stat.st_size, stat.st_mtime, content_md5.hexdigest()))
+
+	@staticmethod
+	def output_name(suffix):
+		return (suffix or 'dataset') + '.csv'
+
+	def get(self, entry_file):
+		'''Return the cached output files by suffix or None, marking the entry as recently used'''
+		if not os.path.isdir(entry_file):
+			return None
+		outputs = dict()
+		for name in os.listdir(entry_file):
+			suffix = os.path.splitext(name)[0]
+			outputs['' if suffix == 'dataset' else suffix] = os.path.join(entry_file, name)
+		self.touch(entry_file)
+		return outputs
+
+	def put(self, entry_file, outputs):
+		'''Copy the output files (by suffix) to the entry, which replaces the previous one atomically'''
+		os.makedirs(self.path, exist_ok=True)
+		tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+		try:
+			for suffix, filename in outputs.items():
+				shutil.copyfile(filename, os.path.join(tmp_dir, self.output_name(suffix)))
+			os.chmod(tmp_dir, 0o755) # mkdtemp creates directories readable only by the owner
+			if os.path.lexists(entry_file):
+				self.remove(entry_file)
+			os.replace(tmp_dir, entry_file)
+		except OSError: # the entry was written by another process meanwhile
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+		self.evict(keep=entry_file)
+
+	@staticmethod
+	def entry_size(entry_file):
+		if not os.path.isdir(entry_file): # entry of a previous version, a single file
+			return os.path.getsize(entry_file)
+		return sum([os.path.getsize(os.path.join(entry_file, name)) for name in os.listdir(entry_file)])
+
+	def remove(self, entry_file):
+		if os.path.isdir(entry_file):
+			shutil.rmtree(entry_file)
+		else:
+			os.remove(entry_file)
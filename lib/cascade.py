@@ -0,0 +1,240 @@
+"""This file contains the class Cascade
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, re, pickle, sys, time, resource, multiprocessing, io, itertools
+import numpy as np
+from lib.node import NodeModel
+from lib.adaptive import ChunkSizer
+
+training = None # (nodes, train files, threads per worker) inherited by the forked training workers
+
+def limit_threads(n_threads):
+	'''Limit the threads of BLAS/OpenMP backed estimators so parallel training workers don't oversubscribe the cores'''
+	for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+		os.environ[var] = str(n_threads)
+	try:
+		from threadpoolctl import threadpool_limits # optional, libraries already loaded ignore the variables above
+		threadpool_limits(limits=n_threads)
+	except ImportError:
+		pass
+
+def rss_mb():
+	'''Current resident memory of this process in MB'''
+	with open('/proc/self/statm') as fd:
+		return int(fd.read().split()[1]) * resource.getpagesize() / 2**20
+
+def fit_node(index):
+	'''Training worker: fit and save a node, returns its training time, peak memory growth (MB) and None,
+	or (None, None, error) if training failed'''
+	nodes, train_files, n_threads = training
+	try:
+		limit_threads(n_threads)
+		start_time, start_rss = time.time(), rss_mb()
+		node = nodes[index]
+		with open(train_files[index], 'r') as fd:
+			X_train, y_train, _, _ = node.parse_csvdataset(fd)
+		node.fit(X_train, y_train)
+		node.artifacts.put(node.saved_model_file, node.pipeline())
+		return time.time() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - start_rss, None
+	except BaseException as err: # exit() on training errors too: a worker killed by SystemExit would leave pool.map waiting forever
+		sys.stdout.flush()
+		return None, None, 'see the error above' if isinstance(err, SystemExit) else repr(err)
+
+class Cascade:
+	'''Double layered classifier: the l1 node routes each flow to the l2 node named after its output label'''
+
+	SNAPSHOT_VERSION = 1
+
+	def __init__(self, config, config_file='', verbose=False):
+		'''Create the l1 and l2 nodes described in config (a loaded configparser object)'''
+
+		self.config = config
+		self.config_file = config_file
+		self.verbose = verbose
+
+		# load train files
+		self.l1_train_file = config.get('ids', 'l1')
+		self.l2_node_names = self.l2_names(config)
+		self.l2_train_files = [config.get('ids', node_name) for node_name in self.l2_node_names]
+
+		self.chunk_size = config.getint('ids', 'chunk-size')
+		self.max_threads = config.getint('ids', 'max-threads')
+		# read chunk size adjusted online by latency and throughput (adaptive-chunks), None keeps chunk-size
+		self.chunk_sizer = ChunkSizer.from_config(config, 'ids', self.chunk_size) if config.getboolean('ids', 'adaptive-chunks', fallback=False) else None
+		self.train_workers = config.getint('ids', 'train-workers', fallback=os.cpu_count())
+		self.dtype_check_rows = config.getint('ids', 'compute-dtype-check-rows', fallback=10000)
+		self.check_config()
+
+		self.l1 = NodeModel('l1', config, verbose=verbose)
+		self.l2_nodes = [NodeModel(node_name, config, verbose=verbose) for node_name in self.l2_node_names]
+
+	@staticmethod
+	def l2_names(config):
+		'''Names of the l2 nodes, the [ids] options matching l2-.+'''
+		return [op for op in config.options('ids') if re.match('l2-.+', op)]
+
+	def check_config(self):
+		'''Verify configuration integrity, l1 output labels must match l2 node names and sections'''
+		conf = self.config
+		l2_sections = [s for s in conf.sections() if re.match('l2-.+', s)]
+		if l2_sections and not len(self.l2_node_names) == len(conf.options('labels-l1')) == len(l2_sections):
+			print("Number of l1 output labels and l2 nodes don't match in config file %s" % self.config_file)
+			exit()
+		if not all([(item[0] == item[1][item[1].find('-')+1:] == item[2][item[2].find('-')+1:]) for item in zip(conf.options('labels-l1'), self.l2_node_names, l2_sections)]):
+			print("Names of l1 output labels do not match l2 node names in config file %s" % self.config_file)
+			exit()
+
+	@property
+	def nodes(self):
+		return [self.l1] + self.l2_nodes
+
+	@property
+	def train_files(self):
+		return [self.l1_train_file] + self.l2_train_files
+
+	def train(self, disable_load=False):
+		'''Create or load the models of every node, nodes without a saved model are trained in parallel processes'''
+		global training
+		pending = [i for i, (node, train_file) in enumerate(zip(self.nodes, self.train_files)) if disable_load or node.force_train or not node.load(train_file)]
+		workers = min(self.train_workers, len(pending))
+		if workers <= 1:
+			for i, (node, train_file) in enumerate(zip(self.nodes, self.train_files)):
+				if i in pending:
+					node.train(train_file, disable_load=True)
+				else:
+					node.logger.log("%s model: %s" % (node.node_name, node.classifier), node.logger.normal, True)
+			self.check_dtypes()
+			return
+
+		start_time = time.time()
+		for i in pending: # model file names are needed by the workers
+			self.nodes[i].saved_model_file = self.nodes[i].artifacts.entry_file(self.train_files[i], self.nodes[i].settings())
+		training = (self.nodes, self.train_files, max(1, os.cpu_count() // workers))
+		# fork: workers inherit the nodes, one process per node so peak memory is measured per node
+		with multiprocessing.get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+			results = pool.map(fit_node, pending, chunksize=1)
+		training = None
+		failed = [(self.nodes[i], error) for i, (_, _, error) in zip(pending, results) if error is not None]
+		for node, error in failed:
+			node.logger.log("%s : Training failed, %s" % (node.node_name, error), node.logger.error)
+		if failed:
+			exit()
+		for i, (seconds, memory, _) in zip(pending, results):
+			print("%s trained in %f seconds, peak memory +%.1f MB" % (self.nodes[i].node_name, seconds, memory), file=sys.stderr)
+		print("%d nodes trained in %f seconds by %d processes (%f seconds sequentially)" % (len(pending), time.time() - start_time, workers, sum([r[0] for r in results])), file=sys.stderr)
+
+		for i, (node, train_file) in enumerate(zip(self.nodes, self.train_files)):
+			if i in pending and not node.load(train_file):
+				node.logger.log("%s : Model trained by worker process not found in %s" % (node.node_name, node.saved_model_file), node.logger.error)
+				exit()
+			node.logger.log("%s model: %s" % (node.node_name, node.classifier), node.logger.normal, True)
+		self.check_dtypes()
+
+	def check_dtypes(self):
+		'''Compare the verdicts of the nodes with a compute dtype other than float64 to the float64 ones on the first rows of their train files'''
+		for node, train_file in zip(self.nodes, self.train_files):
+			if node.inference_pipeline is None or not os.path.isfile(train_file):
+				continue
+			with open(train_file, 'r') as fd:
+				reference = io.StringIO(''.join(itertools.islice(fd, self.dtype_check_rows + 1))) # header and rows
+			x, _, _ = NodeModel.read_csvdataset(reference)
+			node.check_dtype(np.array(x, dtype='float64').reshape(len(x), -1))
+
+	@staticmethod
+	def config_dict(config):
+		'''Raw (not interpolated) contents of every config section'''
+		return {section: dict(config.items(section, raw=True)) for section in config.sections()}
+
+	def train_files_stat(self):
+		'''Size and modification time of the train files, a snapshot is outdated if they change'''
+		return {f: (os.path.getsize(f), os.path.getmtime(f)) if os.path.isfile(f) else None for f in self.train_files}
+
+	def lineage_stat(self):
+		'''Modification time of the lineage file of every node model (0 if it was never refreshed or retrained since, None if
+		there is no model file), a snapshot is outdated if they change'''
+		stats = {}
+		for node, train_file in zip(self.nodes, self.train_files):
+			entry_file = node.artifacts.entry_file(train_file, node.settings())
+			lineage_file = node.artifacts.lineage_file(entry_file)
+			stats[node.node_name] = os.path.getmtime(lineage_file) if os.path.isfile(lineage_file) else 0 if os.path.isfile(entry_file) else None
+		return stats
+
+	def save_snapshot(self, filename):
+		'''Save the configuration and the fitted pipelines of every node to a single file'''
+		snapshot = {'version': self.SNAPSHOT_VERSION,
+					'config': self.config_dict(self.config),
+					'train_files': self.train_files_stat(),
+					'lineage': self.lineage_stat(),
+					'nodes': {node.node_name: node.pipeline() for node in self.nodes}}
+		NodeModel.save_model(filename, snapshot)
+
+	@classmethod
+	def load_snapshot(cls, filename, config, config_file='', verbose=False):
+		'''Create a trained cascade from a snapshot file, returns None if it wasn't made with the same configuration'''
+		with open(filename, 'rb') as fd:
+			snapshot = pickle.loads(fd.read())
+		if snapshot.get('version') != cls.SNAPSHOT_VERSION or snapshot['config'] != cls.config_dict(config):
+			return None
+		cascade = cls(config, config_file, verbose)
+		if snapshot['train_files'] != cascade.train_files_stat():
+			return None
+		# models refreshed after the snapshot was saved (nodes without a lineage file, e.g. deployed snapshots only, are not checked)
+		if any([mtime is not None and snapshot.get('lineage', {}).get(name) != mtime for name, mtime in cascade.lineage_stat().items()]):
+			return None
+		for node in cascade.nodes:
+			node.set_pipeline(snapshot['nodes'][node.node_name])
+			node.logger.log("%s model: %s" % (node.node_name, node.classifier), node.logger.normal, True)
+		cascade.check_dtypes()
+		return cascade
+
+	def artifact_files(self):
+		'''Return every file the trained cascade depends on'''
+		return [f for node in self.nodes for f in node.artifact_files()]
+
+	@staticmethod
+	def labels_index(node, y_predicted):
+		'''Convert node predictions into indexes of node.attack_keys'''
+		return np.argmax(y_predicted, axis=1) if not node.use_regressor and not node.unsupervised else y_predicted
+
+	@staticmethod
+	def label_names(node, labels_index):
+		'''Convert indexes of node.attack_keys into label names, regressor outputs that aren't a valid index get an empty name'''
+		labels_index = np.asarray(labels_index)
+		names = np.full(len(labels_index), '', dtype=object)
+		valid = (labels_index == np.floor(labels_index)) & (labels_index >= 0) & (labels_index < len(node.attack_keys))
+		names[valid] = np.array(node.attack_keys, dtype=object)[labels_index[valid].astype(int)]
+		return names
+
+	def predict_chunk(self, test_data, stats=None):
+		'''Classify a chunk (as yielded by NodeModel.yield_csvdataset) through both layers
+
+			Results are counted in stats ({node name: Stats}, e.g. of one input file), in the stats of every node by default.
+			Returns a list of (flow_id, l1 label, l2 verdict) in the chunk order
+		'''
+		stats = stats or {}
+		# LAYER 1
+		y_predicted, flow_ids = self.l1.predict(test_data, stats.get(self.l1.node_name))
+
+		# OUTPUT DATA PARTITION TO FEED LAYER 2
+		labels_index = self.labels_index(self.l1, y_predicted)
+		l1_labels = self.label_names(self.l1, labels_index)
+		l2_verdicts = np.full(len(flow_ids), '', dtype=object)
+
+		# LAYER 2
+		for node in range(len(self.l2_nodes)):
+			with self.l2_nodes[node].stage('route'):
+				rows = np.where(labels_index == node)[0]
+				if len(rows) != 0:
+					labels = np.take(test_data[2], rows, axis=0) if test_data[2] is not None else None # unlabelled rows stay unlabelled
+					routed = np.take(test_data[0], rows, axis=0), labels, np.take(test_data[3], rows, axis=0) # x, labels, flow_ids
+			if len(rows) != 0:
+				# ignore test_data[1] since its only used for l1 crossvalidation
+				current_test_data = self.l2_nodes[node].process_data(*routed)
+				y_predicted, _ = self.l2_nodes[node].predict(current_test_data, stats.get(self.l2_nodes[node].node_name))
+				l2_verdicts[rows] = self.label_names(self.l2_nodes[node], self.labels_index(self.l2_nodes[node], y_predicted))
+		return list(zip(flow_ids, l1_labels, l2_verdicts))
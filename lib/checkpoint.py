@@ -0,0 +1,103 @@
+"""This file contains the classes Checkpoint, OffsetReader and OrderedCommits
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, time, json, tempfile
+
+class Checkpoint:
+	'''State of a long run (extraction, classification) saved to filename at most every interval seconds
+
+		The state is encoded with codec (json, pickle) and replaces the previous one atomically, synced to disk,
+		so the file always holds the last complete checkpoint even after a crash or a reboot
+	'''
+
+	def __init__(self, filename, interval=60, codec=json):
+		self.filename = os.path.abspath(filename)
+		self.interval = interval
+		self.codec = codec
+		self.last = time.time()
+		self.saves = 0
+		self.seconds = 0.0 # spent saving
+
+	def due(self):
+		return time.time() - self.last >= self.interval
+
+	def save(self, state):
+		start_time = time.time()
+		data = self.codec.dumps(state)
+		directory = os.path.dirname(self.filename)
+		os.makedirs(directory, exist_ok=True)
+		fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+		with os.fdopen(fd, 'wb') as tmp_file:
+			tmp_file.write(data.encode('utf-8') if isinstance(data, str) else data)
+			tmp_file.flush()
+			os.fsync(tmp_file.fileno())
+		os.chmod(tmp_filename, 0o644) # mkstemp creates files readable only by the owner
+		os.replace(tmp_filename, self.filename)
+		self.last = time.time()
+		self.saves += 1
+		self.seconds += self.last - start_time
+
+	def load(self):
+		'''The saved state, None if there is none'''
+		try:
+			with open(self.filename, 'rb') as fd:
+				return self.codec.loads(fd.read())
+		except FileNotFoundError:
+			return None
+
+	def __repr__(self):
+		return "%d checkpoints saved to %s in %f seconds" % (self.saves, self.filename, self.seconds)
+
+
+class OffsetReader:
+	'''Text lines of a file opened in binary mode, counting in offset the bytes read so far
+
+		The first line (the csv header) is always read from the start of the file, the lines after it from offset
+	'''
+
+	def __init__(self, fd, offset=0):
+		self.fd = fd
+		self.offset = offset
+
+	def readline(self):
+		line = self.fd.readline()
+		if self.offset > len(line):
+			self.fd.seek(self.offset)
+		else:
+			self.offset = len(line)
+		return line.decode('utf-8').replace('\r\n', '\n')
+
+	def __iter__(self):
+		for line in self.fd:
+			self.offset += len(line)
+			yield line.decode('utf-8') if not line.endswith(b'\r\n') else line[:-2].decode('utf-8') + '\n'
+
+	def close(self):
+		self.fd.close()
+
+
+class OrderedCommits:
+	'''Commit the results of chunks finished out of order (by several threads) in the order they were read
+
+		commit is called with the results of one chunk at a time, holding lock (shared by every OrderedCommits
+		whose commits must not interleave, e.g. the ones writing the same alert file)
+	'''
+
+	def __init__(self, commit, lock):
+		self.commit = commit
+		self.lock = lock
+		self.pending = dict() # chunk number -> results, of chunks finished before a previous one
+		self.next = 0
+
+	def add(self, number, results):
+		'''Results of the chunk number (0 for the first chunk read)'''
+		with self.lock:
+			self.pending[number] = results
+			while self.next in self.pending:
+				self.commit(*self.pending.pop(self.next))
+				self.next += 1
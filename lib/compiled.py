@@ -0,0 +1,105 @@
+"""This file contains array based inference engines for decision tree and MLP nodes
+
+sklearn predict validates its input and dispatches through several layers on every call, which costs more
+than the computation itself on the small batches l1 routes to each l2 node. The fitted models are exported
+to flat numpy arrays here and evaluated directly on whole batches.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import numpy as np
+
+class CompiledTree:
+	'''DecisionTreeClassifier as node tables, evaluated one tree level at a time for the whole batch'''
+
+	def __init__(self, model):
+		tree = model.tree_
+		self.children_left = tree.children_left.astype(np.intp)
+		self.children_right = tree.children_right.astype(np.intp)
+		self.feature = np.maximum(tree.feature, 0).astype(np.intp) # leaves have feature -2, never used
+		self.threshold = tree.threshold.astype(np.float64)
+		self.is_leaf = self.children_left == -1
+		self.depth = tree.max_depth
+		# prediction of every node, as sklearn: classes_ of the argmax of the node value (per output)
+		if model.n_outputs_ == 1:
+			self.node_output = np.asarray(model.classes_).take(np.argmax(tree.value[:, 0, :len(model.classes_)], axis=1))
+		else:
+			self.node_output = np.stack([np.asarray(classes).take(np.argmax(tree.value[:, k, :len(classes)], axis=1)) for k, classes in enumerate(model.classes_)], axis=1)
+
+	def predict(self, X):
+		X = np.asarray(X, dtype=np.float32) # sklearn trees compare float32 inputs with float64 thresholds
+		rows = np.arange(len(X))
+		node = np.zeros(len(X), dtype=np.intp)
+		for _ in range(self.depth):
+			go_left = X[rows, self.feature[node]] <= self.threshold[node]
+			node = np.where(self.is_leaf[node], node, np.where(go_left, self.children_left[node], self.children_right[node]))
+		return self.node_output[node]
+
+class CompiledMLP:
+	'''MLPClassifier as weight matrices, activations applied in place after each layer'''
+
+	def __init__(self, model):
+		from scipy.special import expit
+		self.coefs = [np.asarray(w) for w in model.coefs_]
+		self.intercepts = [np.asarray(b) for b in model.intercepts_]
+		activations = {'identity': lambda x: x,
+					   'logistic': lambda x: expit(x, out=x),
+					   'tanh': lambda x: np.tanh(x, out=x),
+					   'relu': lambda x: np.maximum(x, 0, out=x)}
+		self.hidden_activation = activations[model.activation]
+		self.out_activation = model.out_activation_
+		self.expit = expit
+		self.y_type = model._label_binarizer.y_type_
+		self.classes = np.asarray(model.classes_)
+
+	def predict(self, X):
+		activation = np.asarray(X)
+		for i, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+			activation = np.dot(activation, coef)
+			activation += intercept
+			if i != len(self.coefs) - 1:
+				activation = self.hidden_activation(activation)
+		# output layer, decoded like sklearn's LabelBinarizer.inverse_transform
+		if self.y_type == 'multiclass':
+			return self.classes.take(np.argmax(activation, axis=1)) # softmax is monotonic
+		activation = self.expit(activation) if self.out_activation == 'logistic' else activation
+		if self.y_type == 'multilabel-indicator':
+			return (activation > 0.5).astype(int)
+		return self.classes.take((activation.ravel() > 0.5).astype(int)) # binary
+
+def verification_rows(model, compiled, n_rows=2000, random_state=0):
+	'''Inputs exercising the model: tree thresholds (and values just around them) or standard normal rows'''
+	rng = np.random.RandomState(random_state)
+	n_features = model.n_features_in_
+	X = rng.normal(size=(n_rows, n_features))
+	if isinstance(compiled, CompiledTree):
+		internal = ~compiled.is_leaf
+		for feature in range(n_features):
+			thresholds = compiled.threshold[internal & (compiled.feature == feature)]
+			if len(thresholds):
+				X[:, feature] = rng.choice(thresholds, n_rows) + rng.choice([-1e-6, 0, 1e-6], n_rows)
+	return X
+
+def engine(model):
+	'''Array based engine class for model, None if the model isn't supported'''
+	from sklearn.tree import DecisionTreeClassifier
+	from sklearn.neural_network import MLPClassifier
+	if type(model) is DecisionTreeClassifier:
+		return CompiledTree
+	if type(model) is MLPClassifier:
+		return CompiledMLP
+	return None
+
+def compile_model(model):
+	'''Return the array based engine of model, or None if it isn't supported or gives different predictions than sklearn'''
+	if engine(model) is None:
+		return None
+	compiled = engine(model)(model)
+	# correctness check against sklearn
+	X = verification_rows(model, compiled)
+	if not np.array_equal(compiled.predict(X), model.predict(X)):
+		return None
+	return compiled
@@ -0,0 +1,35 @@
+"""This file contains the configuration files loader of the IDS tools
+
+A configuration file can extend another one with the base-config option of its [ids] section
+(a path relative to its own directory): the base is read first and the options of the file override it.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, configparser
+
+def config_files(filename):
+	'''filename and the configuration files it extends, in reading order (bases first)'''
+	filenames = [os.path.normpath(filename)]
+	while True:
+		conf = configparser.ConfigParser(allow_no_value=True, interpolation=None)
+		conf.optionxform=str
+		conf.read(filenames[0])
+		base = conf.get('ids', 'base-config', fallback=None)
+		if not base:
+			return filenames
+		base = os.path.normpath(os.path.join(os.path.dirname(filenames[0]), base))
+		if base in filenames:
+			print("Configuration file %s extends itself through %s" % (filename, base))
+			exit()
+		filenames.insert(0, base)
+
+def read_config(filename):
+	'''ConfigParser of filename (and the files it extends), option names are case sensitive'''
+	conf = configparser.ConfigParser(allow_no_value=True)
+	conf.optionxform=str
+	conf.read(config_files(filename))
+	return conf
@@ -0,0 +1,241 @@
+"""This file contains the flow features accumulators used by flows.py
+
+Every flow carries a fixed size FlowAccumulator updated in O(1) per packet, so the features
+of a flow don't need its packets kept in lists and can be read at any point of the flow.
+
+Counts, maxima, minima and the totals and means of lengths and sizes are the ones of the numpy
+reductions over the packet lists (np.sum, np.mean, np.std, np.var, np.max, np.min) of the first
+versions of flows.py. Standard deviations, variances and the inter-arrival time totals and means
+can only match them up to rounding, numpy sums floats pairwise and computes the variance in two
+passes: they agree with numpy.isclose(rtol=1e-12, atol=1e-12), the absolute part being for the
+deviations of nearly constant values (e.g. iats at the timestamp resolution), where both results
+are rounding noise.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import math
+
+# columns of the datasets generated by flows.py
+FEATURE_NAMES = ['flow_id','fwd_header_len_total','bwd_header_len_total','flow_pkt_size_mean','flow_pkt_size_std','flow_pkt_size_max','flow_pkt_size_min',
+	'fwd_pkt_size_mean','fwd_pkt_size_std','fwd_pkt_size_max','bwd_pkt_size_mean','bwd_pkt_size_std','bwd_pkt_size_max','bwd_pkt_size_min','fwd_pkt_size_min','flow_duration',
+	'fwd_n_pkts','bwd_n_pkts','flow_pkts_per_sec','fwd_pkts_per_sec','bwd_pkts_per_sec','flow_bytes_per_sec',
+	'flow_pkt_len_total','flow_pkt_len_mean','flow_pkt_len_std','flow_pkt_len_var','flow_pkt_len_max','flow_pkt_len_min',
+	'fwd_pkt_len_total','fwd_pkt_len_mean','fwd_pkt_len_std','fwd_pkt_len_var','fwd_pkt_len_max','fwd_pkt_len_min',
+	'bwd_pkt_len_total','bwd_pkt_len_mean','bwd_pkt_len_std','bwd_pkt_len_var','bwd_pkt_len_max','bwd_pkt_len_min',
+	'flow_iat_total','flow_iat_mean','flow_iat_std','flow_iat_max','flow_iat_min',
+	'fwd_iat_total','fwd_iat_mean','fwd_iat_std','fwd_iat_max','fwd_iat_min',
+	'bwd_iat_total','bwd_iat_mean','bwd_iat_std','bwd_iat_max','bwd_iat_min',
+	'flow_n_data_pkts','fwd_n_data_pkts','bwd_n_data_pkts',
+	'flow_df_count','flow_mf_count','flow_fin_count','flow_syn_count','flow_rst_count','flow_psh_count','flow_ack_count','flow_urg_count','flow_ece_count','flow_cwr_count','label']
+
+# features that need the packet timestamps
+TIME_FEATURES = [name for name in FEATURE_NAMES if 'iat' in name or 'duration' in name or 'per_sec' in name]
+
+def column_stats(name):
+	'''Statistics of FlowAccumulator (see FlowAccumulator.STATS) a FEATURE_NAMES column is computed from'''
+	direction = name.split('_')[0]
+	if name == 'flow_bytes_per_sec':
+		return ('time', 'flow_len')
+	if name in TIME_FEATURES and '_iat_' in name:
+		return ('time', direction + '_iat')
+	if name in TIME_FEATURES:
+		return ('time',)
+	if '_pkt_len_' in name:
+		return (direction + '_len',)
+	if '_pkt_size_' in name:
+		return (direction + '_size',)
+	if name.endswith('_n_data_pkts'):
+		return ('data',)
+	if name.endswith('_count'):
+		return ('flags',)
+	return () # flow_id, label, the packet counts and header totals are always kept
+
+def accumulator_stats(names):
+	'''Statistics a FlowAccumulator keeps for the columns names'''
+	return frozenset([stat for name in names for stat in column_stats(name)])
+
+def projection(names):
+	'''Indexes of the FEATURE_NAMES columns kept when only names are selected, in dataset order
+
+		flow_id and label are always kept, raises ValueError on unknown names
+	'''
+	unknown = set(names) - set(FEATURE_NAMES)
+	if unknown:
+		raise ValueError('unknown features: %s' % ','.join(sorted(unknown)))
+	return [i for i, name in enumerate(FEATURE_NAMES) if name in names or name in ('flow_id', 'label')]
+
+class IntStats:
+	'''Running count, sum, sum of squares, min and max of integer values (lengths and sizes)
+
+		Sums are exact python integers, so the mean and variance are correctly rounded
+	'''
+	__slots__ = ('n', 'total', 'total_sq', 'min', 'max')
+
+	def __init__(self):
+		self.n = self.total = self.total_sq = 0
+		self.min = self.max = None
+
+	def add(self, value):
+		self.n += 1
+		self.total += value
+		self.total_sq += value * value
+		if self.min is None or value < self.min: self.min = value
+		if self.max is None or value > self.max: self.max = value
+
+	def mean(self):
+		return self.total / self.n
+
+	def var(self):
+		return (self.n * self.total_sq - self.total * self.total) / (self.n * self.n)
+
+	def std(self):
+		return math.sqrt(self.var())
+
+class FloatStats:
+	'''Running count, sum, min and max of float values (inter-arrival times), with the variance by Welford's method'''
+	__slots__ = ('n', 'total', 'running_mean', 'm2', 'min', 'max')
+
+	def __init__(self):
+		self.n = 0
+		self.total = self.running_mean = self.m2 = 0.0
+		self.min = self.max = None
+
+	def add(self, value):
+		self.n += 1
+		self.total += value
+		delta = value - self.running_mean
+		self.running_mean += delta / self.n
+		self.m2 += delta * (value - self.running_mean)
+		if self.min is None or value < self.min: self.min = value
+		if self.max is None or value > self.max: self.max = value
+
+	def mean(self):
+		return self.total / self.n
+
+	def std(self):
+		return math.sqrt(self.m2 / self.n)
+
+class FlowAccumulator:
+	'''Features of a flow updated packet by packet
+
+		Packets are the tuples built by flows.py process_pcap, the first one added sets the forward direction.
+		Only the statistics in stats are computed, the columns read from the others are 0 (see column_stats)
+	'''
+	STATS = frozenset(['time', 'flow_len', 'fwd_len', 'bwd_len', 'flow_size', 'fwd_size', 'bwd_size',
+					   'flow_iat', 'fwd_iat', 'bwd_iat', 'data', 'flags'])
+
+	__slots__ = ('direction_id', 'first_time', 'last_time', 'last_fwd', 'n_pkts', 'fwd_n_pkts', 'bwd_n_pkts',
+				 'flow_len', 'fwd_len', 'bwd_len', 'flow_size', 'fwd_size', 'bwd_size',
+				 'fwd_header_total', 'bwd_header_total', 'flow_iat', 'fwd_iat', 'bwd_iat',
+				 'flow_n_data_pkts', 'fwd_n_data_pkts', 'bwd_n_data_pkts', 'flag_counts')
+
+	def __init__(self, stats=STATS):
+		self.direction_id = self.first_time = self.last_time = self.last_fwd = None
+		self.n_pkts = self.fwd_n_pkts = self.bwd_n_pkts = 0
+		self.fwd_header_total = self.bwd_header_total = 0
+		for name in ('flow_len', 'fwd_len', 'bwd_len', 'flow_size', 'fwd_size', 'bwd_size'):
+			setattr(self, name, IntStats() if name in stats else None)
+		for name in ('flow_iat', 'fwd_iat', 'bwd_iat'):
+			setattr(self, name, FloatStats() if name in stats else None)
+		self.flow_n_data_pkts = self.fwd_n_data_pkts = self.bwd_n_data_pkts = 0 if 'data' in stats else None
+		self.flag_counts = [0]*10 if 'flags' in stats else None
+
+	def add(self, packet, pkt_time=None, scale_factor=0.001):
+		'''Add a packet with timestamp pkt_time (milliseconds), inter-arrival times are scaled by scale_factor
+
+			Without pkt_time the time features (TIME_FEATURES) are left at 0
+		'''
+		if self.direction_id is None:
+			self.direction_id = packet[0]
+		if pkt_time is not None:
+			if self.first_time is None:
+				self.first_time = pkt_time
+			else:
+				current_iat = scale_factor*(pkt_time - self.last_time)
+				if self.flow_iat is not None:
+					self.flow_iat.add(current_iat)
+				# the iat goes to the direction of the previous packet
+				direction_iat = self.fwd_iat if self.last_fwd else self.bwd_iat
+				if direction_iat is not None:
+					direction_iat.add(current_iat)
+			self.last_time = pkt_time
+
+		pkt_len, header_len, pkt_size = packet[2], packet[3], packet[4]
+		self.n_pkts += 1
+		if self.flow_len is not None:
+			self.flow_len.add(pkt_len)
+		if self.flow_size is not None:
+			self.flow_size.add(pkt_size)
+		if self.flag_counts is not None:
+			for i, flag in enumerate(packet[-10:]):
+				if flag:
+					self.flag_counts[i] += 1
+
+		self.last_fwd = packet[0] == self.direction_id
+		if self.last_fwd:
+			self.fwd_n_pkts += 1
+			if self.fwd_len is not None:
+				self.fwd_len.add(pkt_len)
+			if self.fwd_size is not None:
+				self.fwd_size.add(pkt_size)
+			self.fwd_header_total += header_len
+			if self.flow_n_data_pkts is not None and header_len != pkt_len:
+				self.flow_n_data_pkts += 1
+				self.fwd_n_data_pkts += 1
+		else:
+			self.bwd_n_pkts += 1
+			if self.bwd_len is not None:
+				self.bwd_len.add(pkt_len)
+			if self.bwd_size is not None:
+				self.bwd_size.add(pkt_size)
+			self.bwd_header_total += header_len
+			if self.flow_n_data_pkts is not None and header_len != pkt_len:
+				self.flow_n_data_pkts += 1
+				self.bwd_n_data_pkts += 1
+
+	@staticmethod
+	def len_features(stats):
+		'''total, mean, std, var, max and min of a packet lengths direction, zeros if it has no packets'''
+		if stats is None or not stats.n:
+			return [0]*6
+		var = stats.var()
+		return [float(stats.total), stats.mean(), math.sqrt(var), var, float(stats.max), float(stats.min)]
+
+	@staticmethod
+	def size_features(stats):
+		'''mean, std, max and min of a packet sizes direction, zeros if it has no packets'''
+		if stats is None or not stats.n:
+			return [0]*4
+		return [stats.mean(), stats.std(), float(stats.max), float(stats.min)]
+
+	@staticmethod
+	def iat_features(stats):
+		'''total, mean, std, max and min of inter-arrival times, zeros if there are none'''
+		if stats is None or not stats.n:
+			return [0]*5
+		return [stats.total, stats.mean(), stats.std(), stats.max, stats.min]
+
+	def row(self, flow_id, label, scale_factor=0.001):
+		'''Dataset row (FEATURE_NAMES columns) of the packets added so far'''
+		flow_duration = scale_factor*(self.last_time - self.first_time) if self.first_time is not None else 0
+		flow_n_pkts, fwd_n_pkts, bwd_n_pkts = self.n_pkts, self.fwd_n_pkts, self.bwd_n_pkts
+		if flow_duration==0:
+			flow_pkts_per_sec = fwd_pkts_per_sec = bwd_pkts_per_sec = flow_bytes_per_sec = 0
+		else:
+			flow_pkts_per_sec = flow_n_pkts/flow_duration
+			fwd_pkts_per_sec = fwd_n_pkts/flow_duration
+			bwd_pkts_per_sec = bwd_n_pkts/flow_duration
+			flow_bytes_per_sec = float(self.flow_len.total)/flow_duration if self.flow_len is not None else 0
+
+		fwd_size_features = self.size_features(self.fwd_size)
+		data_counts = [self.flow_n_data_pkts, self.fwd_n_data_pkts, self.bwd_n_data_pkts] if self.flow_n_data_pkts is not None else [0]*3
+		return [flow_id, float(self.fwd_header_total), float(self.bwd_header_total) if bwd_n_pkts else 0] + \
+				self.size_features(self.flow_size) + fwd_size_features[:3] + self.size_features(self.bwd_size) + [fwd_size_features[3], flow_duration,
+				fwd_n_pkts, bwd_n_pkts, flow_pkts_per_sec, fwd_pkts_per_sec, bwd_pkts_per_sec, flow_bytes_per_sec] + \
+				self.len_features(self.flow_len) + self.len_features(self.fwd_len) + self.len_features(self.bwd_len) + \
+				self.iat_features(self.flow_iat) + self.iat_features(self.fwd_iat) + self.iat_features(self.bwd_iat) + \
+				data_counts + (self.flag_counts if self.flag_counts is not None else [0]*10) + [label]
@@ -0,0 +1,116 @@
+"""This file contains the incremental refresh of fitted nodes with newly labelled data
+
+Only the new rows are used whenever the classifier allows it:
+  - partial_fit classifiers (MLP with adam/sgd, SGD, naive bayes...) run refresh-epochs passes over the new rows,
+    the scaler (and an IncrementalPCA feature selection) statistics are updated first
+  - warm_start ensembles (random forests, extra trees, gradient boosting) grow refresh-estimators estimators on the new rows
+  - KNN classifiers append the new rows to their reference set
+Scaler and feature selection are kept frozen in the last two cases, so the space of the fitted model doesn't move.
+Other classifiers, or updates the estimator rejects, fall back to a full retrain on the train file, the datasets of the
+previous refreshes and the new rows.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import sys
+import numpy as np
+
+def method(model):
+	'''Refresh method supported by model: knn_append, partial_fit, warm_start or full_retrain'''
+	from sklearn.neighbors import KNeighborsClassifier
+	if isinstance(model, KNeighborsClassifier):
+		return 'knn_append'
+	if hasattr(model, 'partial_fit'): # only available for the stochastic solvers of MLPs
+		return 'partial_fit'
+	if hasattr(model, 'warm_start') and hasattr(model, 'n_estimators'):
+		return 'warm_start'
+	return 'full_retrain'
+
+def transform(node, X):
+	if node.scaler_model is not None:
+		X = node.scaler_model.transform(X)
+	if node.fs_model is not None:
+		X = node.fs_model.transform(X)
+	return X
+
+def partial_fit(node, X_new, y_new, epochs, random_state=0):
+	'''Update scaler, feature selection (when they support it) and classifier with passes over the new rows, returns the scaler update'''
+	scaler_update = 'frozen'
+	if hasattr(node.scaler_model, 'partial_fit') and (node.fs_model is None or hasattr(node.fs_model, 'partial_fit')):
+		node.scaler_model.partial_fit(X_new)
+		if node.fs_model is not None:
+			node.fs_model.partial_fit(node.scaler_model.transform(X_new))
+		scaler_update = 'partial_fit'
+	X = transform(node, X_new)
+	rng = np.random.RandomState(random_state)
+	for _ in range(epochs):
+		order = rng.permutation(len(X))
+		if node.unsupervised:
+			node.model.partial_fit(X[order])
+		else:
+			node.model.partial_fit(X[order], y_new[order])
+	return scaler_update
+
+def warm_start(node, X_new, y_new, n_estimators):
+	'''Grow n_estimators more estimators fitted on the new rows, every output must have all the classes the model was fitted with'''
+	model = node.model
+	classes = model.classes_ if isinstance(model.classes_, list) else [model.classes_]
+	y = y_new.reshape(len(y_new), -1)
+	if y.shape[1] != len(classes) or any([not np.array_equal(np.unique(y[:, k]), np.sort(classes[k])) for k in range(len(classes))]):
+		raise ValueError('the new rows do not have every class of the fitted %s' % type(model).__name__)
+	model.set_params(warm_start=True, n_estimators=model.n_estimators + n_estimators)
+	model.fit(transform(node, X_new), y_new)
+	model.set_params(warm_start=False)
+	return 'frozen'
+
+def knn_append(node, X_new, y_new):
+	'''Refit the KNN index on its reference set plus the new rows (with the same index algorithm)'''
+	from sklearn.base import clone
+	model = node.model
+	if isinstance(model.classes_, list): # multi output (one hot labels)
+		y_reference = np.stack([np.asarray(classes)[model._y[:, k]] for k, classes in enumerate(model.classes_)], axis=1)
+	else:
+		y_reference = np.asarray(model.classes_)[model._y]
+	X = np.concatenate([model._fit_X, transform(node, X_new).astype(model._fit_X.dtype)])
+	node.model = clone(model).set_params(algorithm=model._fit_method).fit(X, np.concatenate([y_reference, y_new.reshape((len(y_new),) + y_reference.shape[1:])]))
+	return 'frozen'
+
+def full_retrain(node, X_new, y_new, train_filename, refreshed_filenames=()):
+	'''Fit the node again on its train file, the datasets of previous refreshes and the new rows'''
+	X_train, y_train = [], []
+	for filename in [train_filename] + list(refreshed_filenames):
+		with open(filename, 'r') as fd:
+			x, y, _, _ = node.parse_csvdataset(fd)
+		X_train.append(x)
+		y_train.append(y)
+	node.fit(np.concatenate(X_train + [X_new]), np.concatenate(y_train + [y_new]))
+	print("%s retrained on %d rows (train file, %d refreshed datasets and the new rows)" % (node.node_name, sum([len(x) for x in X_train]) + len(X_new), len(refreshed_filenames)), file=sys.stderr)
+	return 'refit'
+
+def refresh(node, X_new, y_new, train_filename, full=False, epochs=5, n_estimators=10, refreshed_filenames=()):
+	'''Update the fitted pipeline of node with the new rows (float64), returns (method, scaler update) of the update applied
+
+		Falls back to a full retrain (full_retrain method) when the classifier or the new rows don't allow an incremental update,
+		the datasets of previous refreshes (refreshed_filenames) are fitted again with the train file then
+	'''
+	chosen = 'full_retrain' if full else method(node.model)
+	try:
+		if chosen == 'partial_fit':
+			scaler_update = partial_fit(node, X_new, y_new, epochs)
+		elif chosen == 'warm_start':
+			scaler_update = warm_start(node, X_new, y_new, n_estimators)
+		elif chosen == 'knn_append':
+			scaler_update = knn_append(node, X_new, y_new)
+	except (ValueError, TypeError) as err:
+		node.logger.log("%s : %s refresh failed (%s), retraining" % (node.node_name, chosen, err), node.logger.warning, True)
+		chosen = 'full_retrain'
+	if chosen == 'full_retrain':
+		scaler_update = full_retrain(node, X_new, y_new, train_filename, refreshed_filenames)
+	else:
+		node.compile()
+		node.cast()
+	print("%s refreshed with %d rows by %s (scaler %s)" % (node.node_name, len(X_new), chosen, scaler_update), file=sys.stderr)
+	return chosen, scaler_update
@@ -0,0 +1,106 @@
+"""This file contains the KNN node optimizations: neighbor index selection and training set condensation
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import sys, time
+import numpy as np
+
+INDEX_ALGORITHMS = ('ball_tree', 'kd_tree', 'brute')
+
+def correct(y_predicted, y):
+	'''Boolean array of correctly predicted rows (all outputs must match for one hot encoded labels)'''
+	matches = y_predicted == y
+	return matches.all(axis=1) if len(matches.shape) == 2 else matches
+
+def throughput(model, X):
+	'''Predicted rows per second on X'''
+	start_time = time.perf_counter()
+	model.predict(X)
+	return len(X) / max(time.perf_counter() - start_time, 1e-9)
+
+def choose_index(model, X, y, X_bench, algorithms=INDEX_ALGORITHMS, name='full'):
+	'''Fit model with every neighbor index in algorithms and return the one with the fastest predict on X_bench
+
+		The ball/kd tree is built at fit time and is pickled with the model, so it's saved with the node
+	'''
+	from sklearn.base import clone
+	best, best_rate = None, 0
+	for algorithm in algorithms:
+		candidate = clone(model).set_params(algorithm=algorithm).fit(X, y)
+		rate = throughput(candidate, X_bench)
+		print("  %s set, %s index: %d rows/s" % (name, algorithm, rate), file=sys.stderr)
+		if rate > best_rate:
+			best, best_rate = candidate, rate
+	return best
+
+def condense(model, X, y, seed_size=100, max_iter=10, random_state=0):
+	'''Batch condensed nearest neighbors: start from a random sample of every class and keep adding
+	the rows the current prototypes misclassify until they classify the whole set (or max_iter)
+
+		Returns a boolean mask of the rows kept as prototypes
+	'''
+	from sklearn.base import clone
+	rng = np.random.RandomState(random_state)
+	classes = np.argmax(y, axis=1) if len(y.shape) == 2 else y
+	keep = np.zeros(len(X), dtype=bool)
+	order = rng.permutation(len(X))
+	for label in np.unique(classes):
+		keep[order[classes[order] == label][:max(seed_size, model.n_neighbors)]] = True
+
+	for _ in range(max_iter):
+		prototypes = clone(model).fit(X[keep], y[keep])
+		rest = np.where(~keep)[0]
+		if not len(rest):
+			break
+		wrong = rest[~correct(prototypes.predict(X[rest]), y[rest])]
+		if not len(wrong):
+			break
+		keep[wrong] = True
+	return keep
+
+def optimize(node, X_train, y_train, validation_size=0.1, random_state=0):
+	'''Build the fastest neighbor index for node.model and, if node.knn_condense_tolerance is set,
+	replace the reference set by condensed prototypes when the validation accuracy drops at most by the tolerance
+
+		Returns the fitted model to use
+	'''
+	from sklearn.neighbors import KNeighborsClassifier
+	model = node.model
+	if not isinstance(model, KNeighborsClassifier):
+		node.logger.log("%s : knn options ignored, %s is not a KNeighborsClassifier" % (node.node_name, type(model).__name__), node.logger.warning, True)
+		return model
+	start_time = time.time()
+	algorithms = INDEX_ALGORITHMS if node.knn_index == 'auto' else (node.knn_index or model.algorithm,)
+
+	# held out rows to measure accuracy and predict throughput
+	rng = np.random.RandomState(random_state)
+	order = rng.permutation(len(X_train))
+	n_validation = max(1, int(len(X_train) * validation_size))
+	validation, reference = order[:n_validation], order[n_validation:]
+	X_bench = X_train[validation[:5000]]
+
+	print("%s choosing neighbor index on %d rows" % (node.node_name, len(X_train)), file=sys.stderr)
+	before_rate = throughput(model, X_bench) # as configured
+	full = choose_index(model, X_train, y_train, X_bench, algorithms)
+
+	if node.knn_condense_tolerance is not None and len(reference) > model.n_neighbors:
+		reference_model = choose_index(model, X_train[reference], y_train[reference], X_bench, (full.algorithm,), 'reference')
+		reference_accuracy = np.mean(correct(reference_model.predict(X_train[validation]), y_train[validation]))
+		keep = condense(model, X_train[reference], y_train[reference], random_state=random_state)
+		print("%s condensed %d reference rows to %d prototypes" % (node.node_name, len(reference), keep.sum()), file=sys.stderr)
+		condensed = choose_index(model, X_train[reference][keep], y_train[reference][keep], X_bench, algorithms, 'condensed')
+		condensed_accuracy = np.mean(correct(condensed.predict(X_train[validation]), y_train[validation]))
+		print("%s validation accuracy %f full, %f condensed (tolerance %f)" % (node.node_name, reference_accuracy, condensed_accuracy, node.knn_condense_tolerance), file=sys.stderr)
+		if reference_accuracy - condensed_accuracy <= node.knn_condense_tolerance:
+			print("%s predict throughput %d rows/s before, %d rows/s after (%s index, %d prototypes)" % (node.node_name, before_rate, throughput(condensed, X_bench), condensed.algorithm, keep.sum()), file=sys.stderr)
+			print("%s KNN optimized in %s seconds" % (node.node_name, time.time() - start_time), file=sys.stderr)
+			return condensed
+		node.logger.log("%s : condensation exceeds accuracy tolerance, keeping the full reference set" % node.node_name, node.logger.warning, True)
+
+	print("%s predict throughput %d rows/s before, %d rows/s after (%s index)" % (node.node_name, before_rate, throughput(full, X_bench), full.algorithm), file=sys.stderr)
+	print("%s KNN optimized in %s seconds" % (node.node_name, time.time() - start_time), file=sys.stderr)
+	return full
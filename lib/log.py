@@ -6,50 +6,243 @@ Joao Meira <joao.meira@tekever.com>
 Fabio Almeida <fabio4335@gmail.com>
 """
 
-from sklearn.metrics import accuracy_score, confusion_matrix
-import time, numpy, threading, os
+import time, numpy, threading, os, queue, atexit, logging, logging.handlers
+from contextlib import contextmanager
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler leaving the formatting (message % args) to the listener thread, records never leave the process'''
+
+    def prepare(self, record):
+        return record
+
+class LogSink:
+    '''Log file shared by every Logger of a log directory, rotated when it grows past max_bytes keeping backups old
+       files (never rotated if either is 0)
+
+       Records are queued without blocking by a QueueHandler, a QueueListener thread formats them and writes them with a
+       RotatingFileHandler, the queue is flushed at exit. Forked processes (training and sweep workers) have no listener
+       thread, they append their records to the same file directly'''
+
+    sinks = {}
+    sinks_lock = threading.Lock()
+    FORMAT = '%(asctime)s %(color)s %(threadName)s [%(logger)s] %(message)s'
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    @classmethod
+    def get(cls, log_path, max_bytes=0, backups=0):
+        '''Sink of log_path, created on first use'''
+        key = os.path.abspath(log_path)
+        with cls.sinks_lock:
+            if key not in cls.sinks:
+                cls.sinks[key] = cls(key, max_bytes, backups)
+            return cls.sinks[key]
+
+    def __init__(self, log_path, max_bytes=0, backups=0):
+        if not os.path.isdir(log_path): os.makedirs(log_path)
+        self.filename = os.path.join(log_path, 'classifier.log')
+        self.formatter = logging.Formatter(self.FORMAT, self.DATE_FORMAT)
+        file_handler = logging.handlers.RotatingFileHandler(self.filename, maxBytes=max_bytes if backups else 0, backupCount=backups)
+        file_handler.setFormatter(self.formatter)
+        records = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(records, file_handler)
+        self.logger = logging.getLogger('ids.sink.' + log_path)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.logger.handlers = [DeferredQueueHandler(records)]
+        self.listener.start()
+
+    def close(self):
+        '''Write the queued records and stop the listener thread'''
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    @classmethod
+    def close_all(cls):
+        for sink in list(cls.sinks.values()):
+            sink.close()
+
+    @classmethod
+    def after_fork(cls):
+        '''Forked child: there is no listener thread, records are appended directly to the shared log file'''
+        cls.sinks_lock = threading.Lock()
+        for sink in cls.sinks.values():
+            file_handler = logging.FileHandler(sink.filename, 'a')
+            file_handler.setFormatter(sink.formatter)
+            sink.logger.handlers = [file_handler]
+            sink.listener = None
+
+atexit.register(LogSink.close_all)
+os.register_at_fork(after_in_child=LogSink.after_fork)
 
 
 class Logger:
     error = '[\033[1;31mERROR\033[m]'
     warning = '[\033[1;33mWARNING\033[m]'
     normal = '[\033[1;34m LOG \033[m]'
+    levels = {error: logging.ERROR, warning: logging.WARNING}
 
-    def __init__(self, log_path, name, class_id):
-        if not os.path.isdir(log_path): os.makedirs(log_path)
-        self.log_file = open(log_path + '/classifier_%s_%s_%d.log' % (name, class_id, time.time()),'a')
+    def __init__(self, log_path, name, class_id, verbose=False, max_bytes=0, backups=0):
+        self.sink = LogSink.get(log_path, max_bytes, backups)
+        self.name = '%s %s' % (name, class_id)
+        self.verbose = verbose
+
+    def log(self, message, color='', verbose=False, args=()):
+        ''' Log messages to the shared log file and to screen if verbose
+
+            The record is queued and written by the sink listener thread, message % args is only formatted there'''
+        if verbose or color == self.error: print('%s %s %s' % (color, threading.current_thread().name, message % args if args else message))
+        self.sink.logger.log(self.levels.get(color, logging.INFO), message, *args, extra={'color': color, 'logger': self.name})
+
+    def debug(self, message, *args):
+        '''Log message % args only when verbose, for the hot paths (nothing is formatted or queued otherwise)'''
+        if self.verbose:
+            self.log(message, self.normal, True, args)
+
+class StageTimer:
+    '''Seconds spent in every call of the named stages of a node (encode, scale, predict...), thread safe'''
+
+    def __init__(self):
+        self.times = {}
         self.lock = threading.Lock()
 
-    def log(self, message, color='', verbose=False):
-        ''' Log messages to a the Logger file and to screen if verbose'''
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
         with self.lock:
-            string = '%s %s %s' % (color, threading.current_thread().getName(), message)
-            if verbose or color == self.error: print(string)
-            self.log_file.write(string + '\n')
+            self.times.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        '''{stage: {calls, total, p50, p99}} in seconds'''
+        with self.lock:
+            times = {name: numpy.array(values) for name, values in self.times.items()}
+        return {name: {'calls': len(values), 'total': float(values.sum()),
+                       'p50': float(numpy.percentile(values, 50)), 'p99': float(numpy.percentile(values, 99))} for name, values in times.items()}
 
 class Stats:
-    '''Holds stats from predictions. Can be updated multiple times to include more stats on tests with same labels'''
+    '''Holds stats from predictions. Can be updated multiple times to include more stats on tests with same labels
+
+       Each thread accumulates its counts in its own buffer, buffers are only merged when the stats are read'''
 
     def __init__(self, node):
         self.node = node
-        self.n = self.total_correct = 0
-        self.confusion_matrix = numpy.matrix([[0 for x in range(len(node.outputs))] for x in range(len(node.outputs))])
+        self.n_labels = len(node.outputs)
+        self.counts = numpy.zeros(self.n_labels * self.n_labels + 1, dtype=numpy.int64) # flat confusion matrix + total correct, from finished threads
+        self.buffers = [] # (thread, counts) of every thread that updated these stats
+        self.local = threading.local()
         self.lock = threading.Lock()
 
+    def thread_counts(self):
+        '''Counts buffer of the current thread, the lock is only taken the first time a thread updates the stats'''
+        try:
+            return self.local.counts
+        except AttributeError:
+            counts = self.local.counts = numpy.zeros_like(self.counts)
+            with self.lock:
+                self.merge_finished_threads()
+                self.buffers.append((threading.current_thread(), counts))
+            return counts
+
+    def merge_finished_threads(self):
+        '''Move the counts of threads that are no longer alive into self.counts (call with self.lock held)'''
+        alive = []
+        for thread, counts in self.buffers:
+            if thread.is_alive():
+                alive.append((thread, counts))
+            else:
+                self.counts += counts
+        self.buffers = alive
+
+    def merged(self):
+        '''Return the confusion matrix and the total of correct predictions of all threads'''
+        with self.lock:
+            self.merge_finished_threads()
+            counts = self.counts + sum([counts for _, counts in self.buffers], numpy.zeros_like(self.counts))
+        return counts[:-1].reshape(self.n_labels, self.n_labels), int(counts[-1])
+
+    def merge(self, other):
+        '''Add the counts of other, stats of the same node (e.g. of another input file)'''
+        confusion_matrix, total_correct = other.merged()
+        with self.lock:
+            self.counts[:-1] += confusion_matrix.ravel()
+            self.counts[-1] += total_correct
+
+    def counts_list(self):
+        '''Flat confusion matrix and total correct of all threads as a list of ints, e.g. to save them in a checkpoint'''
+        confusion_matrix, total_correct = self.merged()
+        return [int(v) for v in confusion_matrix.ravel()] + [total_correct]
+
+    def add_counts(self, counts):
+        '''Add counts returned by counts_list, raises ValueError if they aren't of a node with the same outputs'''
+        if len(counts) != len(self.counts):
+            raise ValueError('%d counts, expected %d (%d outputs)' % (len(counts), len(self.counts), self.n_labels))
+        with self.lock:
+            self.counts += numpy.asarray(counts, dtype=numpy.int64)
+
+    @property
+    def confusion_matrix(self):
+        return self.merged()[0]
+
+    @property
+    def total_correct(self):
+        return self.merged()[1]
+
+    @property
+    def n(self):
+        return int(self.merged()[0].sum())
+
     @staticmethod
-    def calculate_metrics(tp, tn, fp, fn, total, rep_str):
-        rep_str += "Overall Acc = \033[34m%4f\033[m\n" % (float(tp+tn)/total)
+    def binary_metrics(tp, tn, fp, fn, total):
+        '''Metrics of a label given its true/false positives/negatives, metrics that would divide by zero are left out'''
+        metrics = {'Overall Acc': float(tp+tn)/total}
         if tp+fn:
-            rep_str += "Recall = %4f\n" % (float(tp)/(tp+fn))
-            rep_str += "Miss Rate = %4f\n" % (float(fn)/(tp+fn))
+            metrics['Recall'] = float(tp)/(tp+fn)
+            metrics['Miss Rate'] = float(fn)/(tp+fn)
         if tn+fp:
-            rep_str += "Specificity = %4f\n" % (float(tn)/(tn+fp))
-            rep_str += "Fallout = %4f\n" % (float(fp)/(tn+fp))
-        if tp+fp: rep_str += "Precision = %4f\n" % (float(tp)/(tp+fp))
-        if tp+fp+fn: rep_str += "F1 score = %4f\n" % (float(2*tp)/(2*tp+fp+fn))
-        if (tp+fp)*(tp+fn)*(tn+fp)*(tn+fn): rep_str += "Mcc = %4f\n" % (float((tp*tn)-(fp*fn))/numpy.sqrt((tp+fp)*(tp+fn)*(tn+fp)*(tn+fn)))
+            metrics['Specificity'] = float(tn)/(tn+fp)
+            metrics['Fallout'] = float(fp)/(tn+fp)
+        if tp+fp: metrics['Precision'] = float(tp)/(tp+fp)
+        if tp+fp+fn: metrics['F1 score'] = float(2*tp)/(2*tp+fp+fn)
+        if (tp+fp)*(tp+fn)*(tn+fp)*(tn+fn): metrics['Mcc'] = float((tp*tn)-(fp*fn))/numpy.sqrt((tp+fp)*(tp+fn)*(tn+fp)*(tn+fn))
+        return metrics
+
+    @classmethod
+    def calculate_metrics(cls, tp, tn, fp, fn, total, rep_str):
+        for name, value in cls.binary_metrics(tp, tn, fp, fn, total).items():
+            rep_str += ("%s = \033[34m%4f\033[m\n" if name == 'Overall Acc' else "%s = %4f\n") % (name, value)
         return rep_str
 
+    def label_counts(self, confusion_matrix):
+        '''Return (label, tp, tn, fp, fn) for every label with stats: MALIGN on benign/malign nodes, each label on layer-1 three label nodes'''
+        if len(self.node.attack_keys) == 2: # MALIGN OR BENIGN
+            if numpy.argmax(self.node.outputs['MALIGN']) == 1:
+                tn, fp, fn, tp = numpy.ravel(confusion_matrix)
+            else:
+                tp, fn, fp, tn = numpy.ravel(confusion_matrix)
+            return [('MALIGN', tp, tn, fp, fn)]
+        elif len(self.node.attack_keys) == 3: # Layer-1 three labels
+            counts = []
+            for i, label in enumerate(self.node.attack_keys):
+                tp = confusion_matrix[i,i]
+                other_indexes = [k for k in range(len(self.node.attack_keys)) if k != i]
+                tn = sum([confusion_matrix[k,j] for k in other_indexes for j in other_indexes])
+                fp = sum([confusion_matrix[k,i] for k in other_indexes])
+                fn = sum([confusion_matrix[i,k] for k in other_indexes])
+                counts.append((label, tp, tn, fp, fn))
+            return counts
+        return []
+
+    def metrics(self):
+        '''Return {label: {metric name: value}} with the same metrics printed by repr'''
+        confusion_matrix, _ = self.merged()
+        n = confusion_matrix.sum()
+        return {label: self.binary_metrics(tp, tn, fp, fn, n) for label, tp, tn, fp, fn in self.label_counts(confusion_matrix)} if n else {}
+
     def update(self, y_predicted, y_test):
         '''Update stats values with more results. Thread safe.
 
@@ -58,48 +251,38 @@ class Stats:
             - y_predicted     numpy list of predict NN outputs
             - y_test          numpy list of target outputs
         '''
-
-        with self.lock:
-            self.total_correct += accuracy_score(y_test, y_predicted, normalize=False) # counts only elements not classified as [0,0..,0]
-            # TODO FIXME Using numpy.argmax puts unclassified entries ([0,0,...,0]) as label zero, see previous code to count those
-            x = numpy.argmax(y_test, axis=1) if len(y_test.shape) == 2 else y_test
-            y = numpy.argmax(y_predicted, axis=1) if len(y_predicted.shape) == 2 else y_predicted
-            self.confusion_matrix += numpy.matrix(confusion_matrix(x, y, labels=list(range(len(self.node.attack_keys)))))
-            self.n = self.confusion_matrix.sum()
+        y_predicted, y_test = numpy.asarray(y_predicted), numpy.asarray(y_test)
+        counts = self.thread_counts()
+        # counts only elements not classified as [0,0..,0]
+        correct = y_test == y_predicted
+        counts[-1] += numpy.count_nonzero(correct.all(axis=1) if len(correct.shape) == 2 else correct)
+        # TODO FIXME Using numpy.argmax puts unclassified entries ([0,0,...,0]) as label zero, see previous code to count those
+        x = (numpy.argmax(y_test, axis=1) if len(y_test.shape) == 2 else y_test).astype(numpy.int64)
+        y = (numpy.argmax(y_predicted, axis=1) if len(y_predicted.shape) == 2 else y_predicted).astype(numpy.int64)
+        k = self.n_labels
+        valid = (x >= 0) & (x < k) & (y >= 0) & (y < k) # same as confusion_matrix(labels=range(k)), other labels are ignored
+        counts[:-1] += numpy.bincount(x[valid] * k + y[valid], minlength=k * k)
 
     def __repr__(self):
-        with self.lock:
-            # confusion matrix
-            lmsize = max(map(len, self.node.attack_keys[:-1])) # for output formatting
-            rep_str = " Real\\Pred |" + ''.join([('%' + str(lmsize) + 's ') % label for label in self.node.attack_keys]) + "\n"
-            for i, label in enumerate(self.node.attack_keys):
-                rep_str += "%10s |" % label
-                for j in range(len(self.node.attack_keys)):
-                    rep_str += (("\033[1;32m" if i == j else '') + "%" + str(lmsize) + "d\033[m ") % self.confusion_matrix[i,j]
-                rep_str += "\n"
-
-            # stats
-            if len(self.node.attack_keys) == 2: # MALIGN OR BENIGN
-                if numpy.argmax(self.node.outputs['MALIGN']) == 1:
-                    tn, fp, fn, tp = numpy.ravel(self.confusion_matrix)
-                else:
-                    tp, fn, fp, tn = numpy.ravel(self.confusion_matrix)
-                rep_str = self.calculate_metrics(tp, tn, fp, fn, self.n, rep_str)
-
-            elif len(self.node.attack_keys) == 3: # Layer-1 three labels
-                #print(list(range(len(self.node.attack_keys))))
-                for i, label in enumerate(self.node.attack_keys):
-                   tp = self.confusion_matrix[i,i] 
-                   other_indexes = [k for k in range(len(self.node.attack_keys)) if k != i]
-                   tn = sum([self.confusion_matrix[k,j] for k in other_indexes for j in other_indexes])
-                   fp = sum([self.confusion_matrix[k,i] for k in other_indexes])
-                   fn = sum([self.confusion_matrix[i,k] for k in other_indexes])
-                   rep_str+= "\033[1;33m%s stats:\033[m\n" % label
-                   rep_str = self.calculate_metrics(tp, tn, fp, fn, self.n, rep_str)
-
-            # unidentified
-            diag = sum(numpy.diag(self.confusion_matrix))
-            if diag - self.total_correct:
-                rep_str += "Unidentified flows marked as \"%s\": \033[1;33m#%d\033[m\n" % \
-                    (self.node.attack_keys[0], diag - self.total_correct)
+        confusion_matrix, total_correct = self.merged()
+        n = confusion_matrix.sum()
+        # confusion matrix
+        lmsize = max(map(len, self.node.attack_keys[:-1])) # for output formatting
+        rep_str = " Real\\Pred |" + ''.join([('%' + str(lmsize) + 's ') % label for label in self.node.attack_keys]) + "\n"
+        for i, label in enumerate(self.node.attack_keys):
+            rep_str += "%10s |" % label
+            for j in range(len(self.node.attack_keys)):
+                rep_str += (("\033[1;32m" if i == j else '') + "%" + str(lmsize) + "d\033[m ") % confusion_matrix[i,j]
+            rep_str += "\n"
+
+        # stats
+        for label, tp, tn, fp, fn in self.label_counts(confusion_matrix):
+            if len(self.node.attack_keys) == 3: rep_str+= "\033[1;33m%s stats:\033[m\n" % label
+            rep_str = self.calculate_metrics(tp, tn, fp, fn, n, rep_str)
+
+        # unidentified
+        diag = sum(numpy.diag(confusion_matrix))
+        if diag - total_correct:
+            rep_str += "Unidentified flows marked as \"%s\": \033[1;33m#%d\033[m\n" % \
+                (self.node.attack_keys[0], diag - total_correct)
         return rep_str
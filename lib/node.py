@@ -6,8 +6,11 @@ Joao Meira <joao.meira@tekever.com>
 Fabio Almeida <fabio4335@gmail.com>
 """
 
-import os, pickle, hashlib, time, sys
+import os, pickle, hashlib, time, sys, importlib, contextlib
 from lib.log import Stats, Logger
+from lib.cache import PredictionCache, ArtifactCache
+from lib import knn, compiled, precision
+from lib.adaptive import ChunkSizer
 import numpy as np
 
 class NodeModel:
@@ -45,13 +48,35 @@ class NodeModel:
 		self.scaler					  = config.get(node_name, 'scaler') if config.has_option(node_name, 'scaler') else None
 		self.scaler_module			  = config.get(node_name, 'scaler-module') if config.has_option(node_name, 'scaler-module') else None
 
+		# KNN classifiers only: neighbor index (auto benchmarks them) and accuracy loss allowed to condense the reference set
+		self.knn_index				  = config.get(node_name, 'knn-index') if config.has_option(node_name, 'knn-index') else None
+		self.knn_condense_tolerance	  = config.getfloat(node_name, 'knn-condense-tolerance') if config.has_option(node_name, 'knn-condense-tolerance') else None
+
 
 		self.model = None # leave uninitialized (run self.train)
+		self.scaler_model = None
+		self.fs_model = None
 		self.saved_model_file = None
-		self.saved_feature_selection_file = None
-		self.saved_scaler_file = None
+		self.input_names = []
+		self.artifacts = ArtifactCache(self.save_path, config.getint('ids', 'model-cache-mb', fallback=0) * 2**20)
 		self.stats = Stats(self)
-		self.logger = Logger(config.get('ids', 'log-dir'), node_name, self.classifier.split('\n')[0].strip('()').split('.')[-1])
+		self.timer = None # StageTimer of the encode/scale/reduce/predict/stats stages, set to profile the node
+		# bounded cache of feature vector -> prediction, 0 disables it
+		cache_size = config.getint(node_name, 'prediction-cache', fallback=config.getint('ids', 'prediction-cache', fallback=0))
+		self.prediction_cache = PredictionCache(cache_size) if cache_size > 0 else None
+		# evaluate tree and MLP classifiers with the array based engines of lib/compiled.py instead of sklearn predict
+		self.compiled_inference = config.getboolean(node_name, 'compiled-inference', fallback=config.getboolean('ids', 'compiled-inference', fallback=False))
+		self.compiled_model = None
+		# dtype of the features from ingestion to predict; models are fitted in float64 and cast to it for inference,
+		# the node falls back to float64 if more than compute-dtype-tolerance of the reference verdicts change (Cascade.check_dtypes)
+		self.compute_dtype = np.dtype(config.get(node_name, 'compute-dtype', fallback=config.get('ids', 'compute-dtype', fallback='float64')))
+		self.dtype_tolerance = config.getfloat(node_name, 'compute-dtype-tolerance', fallback=config.getfloat('ids', 'compute-dtype-tolerance', fallback=0))
+		self.inference_pipeline = None # (scaler, feature selection, model) cast to compute_dtype, None to predict in float64
+		# predict in batches sized online by their throughput, within chunk-size-min and chunk-size-max (can be overridden in each node section)
+		adaptive = config.getboolean(node_name, 'adaptive-chunks', fallback=config.getboolean('ids', 'adaptive-chunks', fallback=False))
+		self.batch_sizer = ChunkSizer.from_config(config, node_name, config.getint('ids', 'chunk-size'), latency=False) if adaptive else None
+		self.logger = Logger(config.get('ids', 'log-dir'), node_name, self.classifier.split('\n')[0].strip('()').split('.')[-1], verbose,
+							 config.getint('ids', 'log-max-mb', fallback=0) * 2**20, config.getint('ids', 'log-backups', fallback=0))
 
 
 	@staticmethod
@@ -75,77 +100,106 @@ class NodeModel:
 		return loaded_model
 
 	@staticmethod
-	def gen_saved_model_pathname(base_path, train_filename, classifier_settings):
-		'''Generate name of saved model file
+	def build_estimator(settings, module=None):
+		'''Create the estimator described by a configuration string (e.g. sklearn.tree.DecisionTreeClassifier())
 
-			Parameters
-			----------
-			- base_path				   base path name
-			- train_filename		   train file name
-			- classifier_settings	   string for with classifier training settings
+			module is only imported here, so training dependencies aren't loaded by runs that load saved models
 		'''
-		used_model_md5 = hashlib.md5()
-		used_model_md5.update(classifier_settings.encode('utf-8'))
-		return base_path + '/%s-%s' % (train_filename[:-4].replace('/','-'), used_model_md5.hexdigest()[:7])
+		namespace = {}
+		if module:
+			importlib.import_module(module)
+			namespace[module.split('.')[0]] = sys.modules[module.split('.')[0]]
+		return eval(settings, namespace)
+
+	def settings(self):
+		'''String with every option that changes the fitted pipeline of this node'''
+		settings = [self.classifier, self.classifier_module, self.scaler, self.scaler_module,
+					self.feature_selection, self.feature_selection_module, self.use_regressor, self.unsupervised,
+					self.attack_keys, sorted(self.label_map.items())]
+		if self.knn_index or self.knn_condense_tolerance is not None: # only when set, so models fitted without them are still found
+			settings += [self.knn_index, self.knn_condense_tolerance]
+		return repr(settings)
 
-	# normal csvs
-	def parse_csvdataset(self, fd):
-		'''Parse entire dataset and return processed np.array with x and y'''
-		flow_ids, x_in, y_in = [], [], []
-		feature_string = fd.readline().split(',')
+	@staticmethod
+	def feature_indexes(feature_string):
+		'''Indexes of the header columns used as model inputs (time related columns, flow_id and label are left out)'''
 		index_subset=[]
 		for elem in feature_string:
 			if 'iat' not in elem and 'sec' not in elem and 'duration' not in elem and elem != 'label\n' and elem !='flow_id':
 				index_subset.append(feature_string.index(elem))
+		return index_subset
+
+	# normal csvs
+	@classmethod
+	def read_csvdataset(cls, fd):
+		'''Read entire dataset, returns the x rows (as strings), labels and flow ids without any label encoding'''
+		flow_ids, x_in, y_in = [], [], []
+		index_subset = cls.feature_indexes(fd.readline().split(','))
 		for line in fd:
 			tmp = line.strip('\n').split(',')
 			#x_in.append(tmp[1:-1])
 			x_in.append([tmp[i] for i in index_subset])
 			y_in.append(tmp[-1]) # choose result based on label
 			flow_ids.append(tmp[0])
-		return self.process_data(x_in, y_in, flow_ids)
+		return x_in, y_in, flow_ids
+
+	def parse_csvdataset(self, fd):
+		'''Parse entire dataset and return processed np.array with x and y, in float64 since it's used to fit the node'''
+		return self.process_data(*self.read_csvdataset(fd), dtype='float64')
 
 	def yield_csvdataset(self, fd, n_chunks):
-		'''Iterate over data, yielding np.array with x and y in chunks of size n_chunks'''
+		'''Iterate over data, yielding np.array with x and y in chunks of size n_chunks
+
+			n_chunks can also be a ChunkSizer, whose size is read before every chunk
+		'''
 		flow_ids, x_in, y_in = [], [], []
-		feature_string = fd.readline()
-		feature_string = feature_string.split(',')
-		index_subset=[]
-		for elem in feature_string:
-			if 'iat' not in elem and 'sec' not in elem and 'duration' not in elem and elem != 'label\n' and elem !='flow_id':
-				index_subset.append(feature_string.index(elem))
-		for i, line in enumerate(fd):
+		header = fd.readline().split(',')
+		index_subset = self.feature_indexes(header)
+		self.input_names = [header[i].strip() for i in index_subset] # names of the x columns
+		chunk_size = getattr(n_chunks, 'size', n_chunks)
+		for line in fd:
 			tmp = line.strip('\n').split(',')
 			#x_in.append(tmp[1:-1])
 			x_in.append([tmp[j] for j in index_subset])
 			y_in.append(tmp[-1]) # choose result based on label
 			flow_ids.append(tmp[0])
-			if (i+1) % n_chunks == 0:
+			if len(x_in) >= chunk_size:
 				yield self.process_data(x_in, y_in, flow_ids)
 				x_in, y_in, flow_ids = [], [], []
-		yield self.process_data(x_in, y_in, flow_ids)
-
-	def process_data(self, x, labels, flow_ids):
-		'''Process data, y must be a list of labels, returns list with both lists converted to np.array'''
-		y = []
-		for label in labels:
-			# try to apply label to elf.outputs, if not existent use label mapping to find valid label conversion
-			if label in self.outputs:
-				y.append(self.outputs[label]) # encode label into categorical ouptut classes
-			elif label in self.label_map:
-				y.append(self.outputs[self.label_map[label]]) # if an error ocurrs here your label conversion is wrong
-			else:
-				self.logger.log("%s : Unknown label %s. Add it to correct mapping section in config file" % (self.node_name, label), self.logger.error, self.verbose)
-				exit()
-		x = np.array(x, dtype='float64')
-		y = np.array(y, dtype='int8')
-		flow_ids = np.array(flow_ids)
-		return [x, y, labels, flow_ids]
+				chunk_size = getattr(n_chunks, 'size', n_chunks)
+		if x_in:
+			yield self.process_data(x_in, y_in, flow_ids)
+
+	def stage(self, name):
+		'''Context timing a stage of this node when profiled (self.timer is set)'''
+		return self.timer.stage(name) if self.timer else contextlib.nullcontext()
+
+	def process_data(self, x, labels, flow_ids, dtype=None):
+		'''Process data, y must be a list of labels, returns list with both lists converted to np.array
+
+			x is converted to dtype, the compute dtype of the node by default. labels is None for unlabelled rows
+			(e.g. classifier service requests): nothing is encoded and predict doesn't count them in the stats
+		'''
+		with self.stage('encode'):
+			y = [] if labels is not None else None
+			for label in (labels if labels is not None else []):
+				# try to apply label to elf.outputs, if not existent use label mapping to find valid label conversion
+				if label in self.outputs:
+					y.append(self.outputs[label]) # encode label into categorical ouptut classes
+				elif label in self.label_map:
+					y.append(self.outputs[self.label_map[label]]) # if an error ocurrs here your label conversion is wrong
+				else:
+					self.logger.log("%s : Unknown label %s. Add it to correct mapping section in config file" % (self.node_name, label), self.logger.error, self.verbose)
+					exit()
+			x = np.asarray(x, dtype=dtype or self.compute_dtype) # arrays that already have the dtype (e.g. shared memory) aren't copied
+			y = np.array(y, dtype='int8') if y is not None else None
+			flow_ids = np.asarray(flow_ids)
+			return [x, y, labels, flow_ids]
 
 	def train(self, train_filename, disable_load=False):
 		'''Create or load train model from given dataset and apply it to the test dataset
 
-			If there is already a created model with the same classifier and train dataset
+			If there is already a created model with the same settings and train dataset
 				it will be loaded, otherwise a new one is created and saved
 
 			Parameters
@@ -153,94 +207,223 @@ class NodeModel:
 			- train_filename	  filename of the train dataset
 			- disable_load		  disable load of trained classifier models
 		'''
-		# generate model filename
-		self.saved_model_file = self.gen_saved_model_pathname(self.save_path, train_filename, self.classifier)
-		self.saved_scaler_file = (os.path.dirname(self.saved_model_file) + '/scalerX_' + self.node_name) if self.scaler else None
-		self.saved_feature_selection_file = (os.path.dirname(self.saved_model_file) + '/FeatureSelection_' + self.node_name) if self.feature_selection else None
-
-		if os.path.isfile(self.saved_model_file) and not disable_load and not self.force_train:
-			# LOAD MODEL
-			self.logger.log("%s importing model from %s" % (self.node_name, self.saved_model_file),self.logger.normal, self.verbose)
-			self.model = self.load_model(self.saved_model_file)
-		else:
+		# model filename, keyed by the node settings and the train data
+		self.saved_model_file = self.artifacts.entry_file(train_filename, self.settings())
+		if disable_load or self.force_train or not self.load(train_filename):
 			# CREATE NEW MODEL
 			with open(train_filename, 'r') as fd:
 				X_train, y_train, _, _ = self.parse_csvdataset(fd)
+			self.fit(X_train, y_train)
+			self.artifacts.put(self.saved_model_file, self.pipeline())
+		self.logger.log("%s model: %s" % (self.node_name, self.classifier), self.logger.normal, True)
+		return self.model
+
+	def load(self, train_filename):
+		'''Load the cached model fitted with the settings of this node on train_filename, returns False if there is none'''
+		self.saved_model_file = self.artifacts.entry_file(train_filename, self.settings())
+		pipeline = self.artifacts.get(self.saved_model_file) or self.import_legacy_pipeline(train_filename)
+		if not pipeline:
+			return False
+		# LOAD MODEL
+		self.logger.log("%s importing model from %s" % (self.node_name, self.saved_model_file),self.logger.normal, self.verbose)
+		self.set_pipeline(pipeline)
+		return True
+
+	def import_legacy_pipeline(self, train_filename):
+		'''Import the model, scaler and feature selection saved in the layout used before the artifact cache
+		(<train file>-<md5 of the classifier>, scalerX_<node>, FeatureSelection_<node>) into the cache entry, None if there are none
+
+			scalerX_<node> and FeatureSelection_<node> were shared by every setting of the node, so they are only imported when
+			they were built with the current scaler and feature selection settings, after the last change of the train file
+		'''
+		legacy_model_file = self.save_path + '/%s-%s' % (train_filename[:-4].replace('/','-'), hashlib.md5(self.classifier.encode('utf-8')).hexdigest()[:7])
+		legacy_scaler_file = self.save_path + '/scalerX_' + self.node_name
+		legacy_fs_file = self.save_path + '/FeatureSelection_' + self.node_name
+		legacy_files = [legacy_model_file] + ([legacy_scaler_file] if self.scaler else []) + ([legacy_fs_file] if self.feature_selection else [])
+		if not all([os.path.isfile(f) for f in legacy_files]):
+			return None
+		if os.path.isfile(train_filename) and os.path.getmtime(train_filename) > min([os.path.getmtime(f) for f in legacy_files]):
+			self.logger.log("%s : legacy model %s is older than %s, not importing it" % (self.node_name, legacy_model_file, train_filename), self.logger.warning, True)
+			return None
+		pipeline = (self.load_model(legacy_model_file), self.load_model(legacy_scaler_file) if self.scaler else None,
+					self.load_model(legacy_fs_file) if self.feature_selection else None)
+		for estimator, settings, module in zip(pipeline[1:], (self.scaler, self.feature_selection), (self.scaler_module, self.feature_selection_module)):
+			if estimator is not None and not self.same_settings(estimator, self.build_estimator(settings, module)):
+				self.logger.log("%s : legacy %s does not match the settings %s, not importing it" % (self.node_name, type(estimator).__name__, settings), self.logger.warning, True)
+				return None
+		self.artifacts.put(self.saved_model_file, pipeline)
+		self.logger.log("%s imported legacy model %s into %s" % (self.node_name, legacy_model_file, self.saved_model_file), self.logger.normal, True)
+		return pipeline
 
-			# scaler setup
-			if self.scaler_module:
-				exec('import '+ self.scaler_module) # import scaler module
-			if self.scaler:
-				start_time = time.time()
-				scaler = eval(self.scaler).fit(X_train)
-				X_train = scaler.transform(X_train)    # normalize
-				print("%s scaler trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
-				self.save_model(self.saved_scaler_file, scaler)
-
-			# feature selection
-			if self.feature_selection_module:
-				exec('import '+ self.feature_selection_module) # import feature selection module
-			if self.feature_selection:
-				start_time = time.time()
-				fs_model = eval(self.feature_selection).fit(X_train)
-				X_train = fs_model.transform(X_train) # apply dimension reduction
-				print("%s FS trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
-				self.save_model(self.saved_feature_selection_file, fs_model)
-
-			# classifier setup
-			if self.classifier_module:
-				exec('import '+ self.classifier_module) # import classifier module
-			self.model = eval(self.classifier)
-
-			# train and save the model
-			self.logger.log("%s : Training" %  self.node_name, self.logger.normal, True)
+	@staticmethod
+	def same_settings(fitted, estimator):
+		'''True if fitted is an estimator of the class and parameters of estimator'''
+		params = lambda e: {name: repr(value) for name, value in e.get_params().items()}
+		return type(fitted) is type(estimator) and params(fitted) == params(estimator)
+
+	def fit(self, X_train, y_train):
+		'''Fit scaler, feature selection and classifier of this node to the given train data, nothing is saved'''
+		self.scaler_model = self.fs_model = None
+		# scaler setup
+		if self.scaler:
 			start_time = time.time()
-			try:
-				if self.unsupervised:
-					self.model.fit(X_train)
-				else:
-					self.model.fit(X_train, y_train)
-			except ValueError as err:
-				self.logger.log("%s : Problem found when training model, this classifier might be a regressor:\n%s\nIf it is, use 'regressor' option in configuration file" % (self.node_name, self.model), self.logger.error)
-				self.logger.log("%s : %s" % (self.node_name, err), self.logger.error, True)
-				exit()
-			except TypeError:
-				self.logger.log("%s : Problem found when training model, this classifier might not be unsupervised:\n%s" % (self.node_name, self.model), self.logger.error)
-				exit()
-			print("%s Classifier trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
-			self.save_model(self.saved_model_file, self.model)
-		self.logger.log("%s model: %s" % (self.node_name, self.classifier), self.logger.normal, True)
+			scaler = self.build_estimator(self.scaler, self.scaler_module).fit(X_train)
+			X_train = scaler.transform(X_train)    # normalize
+			print("%s scaler trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
+			self.scaler_model = scaler
+
+		# feature selection
+		if self.feature_selection:
+			start_time = time.time()
+			fs_model = self.build_estimator(self.feature_selection, self.feature_selection_module).fit(X_train)
+			X_train = fs_model.transform(X_train) # apply dimension reduction
+			print("%s FS trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
+			self.fs_model = fs_model
+
+		# classifier setup
+		self.model = self.build_estimator(self.classifier, self.classifier_module)
+
+		# train the model
+		self.logger.log("%s : Training" %  self.node_name, self.logger.normal, True)
+		start_time = time.time()
+		try:
+			if self.unsupervised:
+				self.model.fit(X_train)
+			else:
+				self.model.fit(X_train, y_train)
+		except ValueError as err:
+			self.logger.log("%s : Problem found when training model, this classifier might be a regressor:\n%s\nIf it is, use 'regressor' option in configuration file" % (self.node_name, self.model), self.logger.error)
+			self.logger.log("%s : %s" % (self.node_name, err), self.logger.error, True)
+			exit()
+		except TypeError:
+			self.logger.log("%s : Problem found when training model, this classifier might not be unsupervised:\n%s" % (self.node_name, self.model), self.logger.error)
+			exit()
+		print("%s Classifier trained in " % self.node_name + str(time.time() - start_time) + " seconds", file=sys.stderr)
+
+		if self.knn_index or self.knn_condense_tolerance is not None:
+			self.model = knn.optimize(self, X_train, y_train)
+		self.compile()
+		self.cast()
 		return self.model
 
-	def predict(self, test_data):
-		'''Apply a created model to given test_data (tuple with data input and data labels) and return predicted classification'''
+	def compile(self):
+		'''Export the model to the array based inference engine when enabled and supported'''
+		self.compiled_model = None
+		if not self.compiled_inference or compiled.engine(self.model) is None:
+			return
+		self.compiled_model = compiled.compile_model(self.model)
+		if self.compiled_model is None:
+			self.logger.log("%s : compiled %s predictions differ from sklearn, using sklearn predict" % (self.node_name, type(self.model).__name__), self.logger.warning, True)
+		else:
+			self.logger.log("%s : using compiled %s" % (self.node_name, type(self.model).__name__), self.logger.normal, self.verbose)
+
+	def cast(self):
+		'''Cast the fitted pipeline to the compute dtype for inference'''
+		self.inference_pipeline = None
+		if self.compute_dtype != np.float64:
+			self.inference_pipeline = tuple([precision.cast_estimator(estimator, self.compute_dtype) for estimator in self.float64_pipeline()])
+
+	def float64_pipeline(self):
+		return self.scaler_model, self.fs_model, self.compiled_model or self.model
+
+	def check_dtype(self, X):
+		'''Count the rows of X (float64 features) whose prediction changes with the compute dtype
+
+			The node falls back to float64 if more than dtype_tolerance of the rows change
+		'''
+		if self.inference_pipeline is None or not len(X):
+			return 0
+		X = np.asarray(X, dtype='float64')
+		y_float64 = self.predict_rows(X, self.float64_pipeline())
+		y_predicted = self.predict_rows(X.astype(self.compute_dtype))
+		changed = int(np.count_nonzero((np.asarray(y_predicted) != np.asarray(y_float64)).reshape(len(X), -1).any(axis=1)))
+		message = "%s : %s changes %d of %d reference verdicts" % (self.node_name, self.compute_dtype, changed, len(X))
+		if changed > self.dtype_tolerance * len(X):
+			self.logger.log(message + ", predicting in float64", self.logger.warning, True)
+			self.compute_dtype = np.dtype('float64')
+			self.inference_pipeline = None
+		else:
+			self.logger.log(message, self.logger.warning if changed else self.logger.normal, self.verbose or changed > 0)
+		return changed
+
+	def pipeline(self):
+		'''Return the fitted (model, scaler, feature selection) of this node'''
+		return self.model, self.scaler_model, self.fs_model
+
+	def set_pipeline(self, pipeline):
+		'''Use an already fitted (model, scaler, feature selection), e.g. from a cascade snapshot'''
+		self.model, self.scaler_model, self.fs_model = pipeline
+		self.compile()
+		self.cast()
+
+	def artifact_files(self):
+		'''Return the saved files this node was loaded from'''
+		return [self.saved_model_file] if self.saved_model_file else []
+
+	def predict(self, test_data, stats=None):
+		'''Apply a created model to given test_data (tuple with data input and data labels) and return predicted classification
+
+			The results are counted in stats (e.g. the stats of one input file), self.stats by default
+		'''
 
 		if not self.model:
 			self.logger.log("%s : The model hasn't been trained or loaded yet. Run NodeModel.train" % self.node_name, self.logger.error)
 			exit()
 		X_test, y_test, _, flow_ids = test_data
 
+		self.logger.debug("%s : Predicting on #%d samples", self.node_name, len(X_test))
+		predict_rows = self.predict_batches if self.batch_sizer else self.predict_rows
+		if self.prediction_cache:
+			y_predicted = self.prediction_cache.predict(X_test, predict_rows)
+		else:
+			y_predicted = predict_rows(X_test)
+		if y_test is not None: # unlabelled rows aren't counted
+			with self.stage('stats'):
+				(stats or self.stats).update(y_predicted, y_test)
+		return y_predicted,flow_ids
+
+	def predict_batches(self, X_test):
+		'''predict_rows in batches of the adaptive batch size, feeding their throughput back to the sizer'''
+		if len(X_test) <= self.batch_sizer.size:
+			start_time = time.perf_counter()
+			y_predicted = self.predict_rows(X_test)
+			self.batch_sizer.update(len(X_test), time.perf_counter() - start_time)
+			return y_predicted
+		batches = []
+		start = 0
+		while start < len(X_test):
+			end = start + self.batch_sizer.size
+			start_time = time.perf_counter()
+			batches.append(self.predict_rows(X_test[start:end]))
+			self.batch_sizer.update(len(batches[-1]), time.perf_counter() - start_time)
+			start = end
+		return np.concatenate(batches)
+
+	def predict_rows(self, X_test, pipeline=None):
+		'''Scale, reduce and classify the rows of X_test with pipeline (scaler, feature selection, model), by default the one of the compute dtype'''
+		scaler_model, fs_model, model = pipeline or self.inference_pipeline or self.float64_pipeline()
+
 		# apply network to the test data
-		if self.saved_scaler_file and os.path.isfile(self.saved_scaler_file):
-			scaler = self.load_model(self.saved_scaler_file)
+		if scaler_model is not None:
 			try:
-				X_test = scaler.transform(X_test) # normalize
+				with self.stage('scale'):
+					X_test = scaler_model.transform(X_test) # normalize
 			except ValueError as err:
 				self.logger.log("%s : Transforming with scaler. %s" % (self.node_name, err), self.logger.error)
 				exit()
 
 		# apply feature selection transformation to test data
-		if self.saved_feature_selection_file and os.path.isfile(self.saved_feature_selection_file):
-			fs_model = self.load_model(self.saved_feature_selection_file)
+		if fs_model is not None:
 			try:
-				X_test = fs_model.transform(X_test) # dimension reduction
+				with self.stage('reduce'):
+					X_test = fs_model.transform(X_test) # dimension reduction
 			except ValueError as err:
 				self.logger.log("%s : Performing feature selection. %s" % (self.node_name, err), self.logger.error)
 				exit()
 
-		self.logger.log("%s : Predicting on #%d samples" % (self.node_name, len(X_test)), self.logger.normal, self.verbose)
 		try:
-			y_predicted = self.model.predict(X_test)
+			with self.stage('predict'):
+				y_predicted = model.predict(X_test)
 		except ValueError as err:
 			self.logger.log("%s : Predicting. %s" % (self.node_name, err), self.logger.error)
 			exit()
@@ -251,7 +434,4 @@ class NodeModel:
 		if self.unsupervised:
 			y_predicted[y_predicted == 1] = 0
 			y_predicted[y_predicted == -1] = 1
-		self.stats.update(y_predicted, y_test)
-		return y_predicted,flow_ids
-
-
+		return y_predicted
@@ -0,0 +1,90 @@
+"""This file contains the class LoadShedder
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class LoadShedder:
+	'''Overload protection of the classifier: rows of incoming chunks are dropped while too many chunks
+	are waiting to be classified or chunks take too long, so latency stays bounded under attack
+
+		While overloaded, flows of communications (source and destination addresses) classified recently and flows
+		with less than overload-min-packets packets are dropped first; past overload-drop-pending waiting chunks,
+		whole chunks are dropped. Every dropped row is counted, so counts can be scaled by the kept rate
+	'''
+
+	def __init__(self, config):
+		self.max_pending  = config.getint('ids', 'overload-pending', fallback=0)		  # waiting chunks that trigger shedding, 0 = never
+		self.max_latency  = config.getfloat('ids', 'overload-latency', fallback=0)	  # chunk latency (seconds) that triggers shedding, 0 = never
+		self.drop_pending = config.getint('ids', 'overload-drop-pending', fallback=0)   # waiting chunks above which whole chunks are dropped, 0 = never
+		self.min_packets  = config.getint('ids', 'overload-min-packets', fallback=0)
+		self.seen_size	  = config.getint('ids', 'overload-seen-flows', fallback=100000)
+		self.seen = OrderedDict()
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.latency = 0.0
+		self.rows = self.kept = self.shed_rows = self.chunks = self.dropped_chunks = self.overloaded_chunks = 0
+
+	@property
+	def enabled(self):
+		return bool(self.max_pending or self.max_latency or self.drop_pending)
+
+	def overloaded(self):
+		return (self.max_pending and self.pending >= self.max_pending) or (self.max_latency and self.latency >= self.max_latency)
+
+	@staticmethod
+	def communication(flow_id):
+		'''Source and destination addresses of a flow id (src-sport-dst-dport-protocol-counter)'''
+		fields = flow_id.split('-')
+		return fields[0] + '-' + fields[2]
+
+	def admit(self, test_data, input_names):
+		'''Return the rows of test_data (as returned by NodeModel.process_data) to classify, None if none is
+
+			input_names are the columns of x, used to find the packet counts. Admitted chunks are pending until done is called
+		'''
+		x, y, labels, flow_ids = test_data
+		communications = [self.communication(flow_id) for flow_id in flow_ids]
+		with self.lock:
+			self.rows += len(x)
+			self.chunks += 1
+			if self.drop_pending and self.pending >= self.drop_pending:
+				self.dropped_chunks += 1
+				return None
+			if self.enabled and self.overloaded():
+				self.overloaded_chunks += 1
+				keep = np.array([c not in self.seen for c in communications], dtype=bool)
+				if self.min_packets and 'fwd_n_pkts' in input_names and 'bwd_n_pkts' in input_names:
+					n_pkts = x[:, input_names.index('fwd_n_pkts')] + x[:, input_names.index('bwd_n_pkts')]
+					keep &= n_pkts >= self.min_packets
+				self.shed_rows += len(x) - keep.sum()
+				if not keep.any():
+					return None
+				x, y, flow_ids = x[keep], y[keep], flow_ids[keep]
+				labels = [label for label, k in zip(labels, keep) if k]
+				communications = [c for c, k in zip(communications, keep) if k]
+			for c in communications:
+				self.seen[c] = True
+				self.seen.move_to_end(c)
+			while len(self.seen) > self.seen_size:
+				self.seen.popitem(last=False)
+			self.kept += len(x)
+			self.pending += 1
+		return [x, y, labels, flow_ids]
+
+	def done(self, latency):
+		'''An admitted chunk was classified in latency seconds (since it was read)'''
+		with self.lock:
+			self.pending -= 1
+			self.latency = latency
+
+	def __repr__(self):
+		with self.lock:
+			return "Load shedding: %d/%d flows classified (rate %4f), %d flows shed in %d overloaded chunks, %d chunks dropped\n" % \
+				(self.kept, self.rows, float(self.kept)/self.rows if self.rows else 1, self.shed_rows, self.overloaded_chunks, self.dropped_chunks)
@@ -0,0 +1,35 @@
+"""This file contains the casting of fitted estimators to a lower precision compute dtype
+
+Nodes are always fitted in float64; with compute-dtype = float32 the fitted scaler, feature selection
+and classifier are cast for inference so the features of a chunk stay float32 through the whole pipeline.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import copy
+import numpy as np
+from lib.compiled import CompiledTree
+
+def cast_array(value, dtype):
+	'''value cast to dtype if it's a float64 array (or a list of them), otherwise value itself'''
+	if isinstance(value, np.ndarray) and value.dtype == np.float64:
+		return value.astype(dtype)
+	if isinstance(value, list) and value and all([isinstance(v, np.ndarray) and v.dtype == np.float64 for v in value]):
+		return [v.astype(dtype) for v in value]
+	return value
+
+def cast_estimator(estimator, dtype):
+	'''Shallow copy of a fitted estimator with its float64 array attributes (weights, means, components...) cast to dtype
+
+		The original estimator is left untouched. Compiled trees are kept as they are: inputs are compared
+		as float32 with float64 thresholds, like sklearn does
+	'''
+	if estimator is None or dtype == np.float64 or isinstance(estimator, CompiledTree):
+		return estimator
+	estimator = copy.copy(estimator)
+	for name, value in list(vars(estimator).items()):
+		setattr(estimator, name, cast_array(value, dtype))
+	return estimator
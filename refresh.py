@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""This file contains the incremental model refresh: fitted nodes are updated with new labelled datasets
+without retraining them on their whole train files (see lib/incremental.py for the update of each classifier)
+
+The refreshed pipeline replaces the cached one of the node (the one classifier.py loads for its settings and
+train file) and the new datasets are recorded in a lineage file next to it, so a dataset is never applied twice.
+
+  ./refresh.py -c configs/ids.cfg l1=DATA/new/layer1.csv l2-fastdos=DATA/new/benign-fastdos.csv
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, argparse, sys, time, json
+import numpy as np
+from lib.node import NodeModel
+from lib.cascade import Cascade
+from lib import incremental
+from lib.config import read_config
+
+# =====================
+#     CLI OPTIONS
+# =====================
+
+op = argparse.ArgumentParser(description="Update fitted nodes with new labelled datasets")
+op.add_argument('datasets', metavar='NODE=FILE', nargs='+', help='new dataset of a node (l1, l2-...), can be repeated')
+op.add_argument('-c', '--config-file', help="configuration file", dest='config_file', default='configs/ids.cfg')
+op.add_argument('--full', action='store_true', help="retrain on the train file and the new datasets instead of updating the models", dest='full')
+op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
+args = op.parse_args()
+
+# =====================
+#       LINEAGE
+# =====================
+
+def read_lineage(node, train_file):
+    '''Lineage of the cached pipeline of node: the train file it was fitted on and the refreshes applied to it'''
+    lineage_file = node.artifacts.lineage_file(node.saved_model_file)
+    if os.path.isfile(lineage_file):
+        with open(lineage_file, 'r') as fd:
+            return json.load(fd)
+    return {'node': node.node_name, 'settings': node.settings(), 'model_file': os.path.basename(node.saved_model_file),
+            'train_file': {'file': os.path.abspath(train_file), 'fingerprint': node.artifacts.fingerprint(train_file) if os.path.isfile(train_file) else None},
+            'refreshes': []}
+
+def refreshed_files(node, lineage):
+    '''Datasets of the previous refreshes that are still available unchanged, fitted again by a full retrain'''
+    return [f for refresh in lineage['refreshes'] for f in refresh['files']
+            if os.path.isfile(f['file']) and node.artifacts.fingerprint(f['file']) == f['fingerprint']]
+
+def drop_refreshes(node, lineage, kept_files):
+    '''Remove from lineage the datasets a full retrain didn't fit (missing or changed), so they can be applied again'''
+    kept = set([f['fingerprint'] for f in kept_files])
+    for refresh in lineage['refreshes']:
+        for f in refresh['files']:
+            if f['fingerprint'] not in kept:
+                print("%s: %s (refreshed on %s) is missing or changed, it was left out of the retrain" % (node.node_name, f['file'], refresh['time']), file=sys.stderr)
+        refresh['files'] = [f for f in refresh['files'] if f['fingerprint'] in kept]
+    lineage['refreshes'] = [refresh for refresh in lineage['refreshes'] if refresh['files']]
+
+def write_lineage(node, lineage):
+    node.artifacts.write_atomic(node.artifacts.lineage_file(node.saved_model_file), json.dumps(lineage, indent=2).encode('utf-8'))
+
+# =====================
+#         RUN
+# =====================
+
+if __name__ == '__main__':
+    conf = read_config(args.config_file)
+
+    node_files = {}
+    for item in args.datasets:
+        node_name, _, filename = item.partition('=')
+        if node_name not in ['l1'] + Cascade.l2_names(conf) or not filename:
+            print("%s: expected NODE=FILE with a node of %s (l1 or one of %s)" % (item, args.config_file, ', '.join(Cascade.l2_names(conf))), file=sys.stderr)
+            exit()
+        if not os.path.isfile(filename):
+            print("%s: file not found" % filename, file=sys.stderr)
+            exit()
+        node_files.setdefault(node_name, []).append(filename)
+
+    for node_name, filenames in node_files.items():
+        start_time = time.time()
+        node = NodeModel(node_name, conf, verbose=args.verbose)
+        train_file = conf.get('ids', node_name)
+        if not node.load(train_file):
+            print("%s: no fitted model for %s, train it first (e.g. ./classifier.py -c %s)" % (node_name, train_file, args.config_file), file=sys.stderr)
+            exit()
+        lineage = read_lineage(node, train_file)
+        applied = set([f['fingerprint'] for refresh in lineage['refreshes'] for f in refresh['files']])
+
+        X_new, y_new, new_files = [], [], []
+        for filename in filenames:
+            fingerprint = node.artifacts.fingerprint(filename)
+            if fingerprint in applied:
+                print("%s: %s was already applied, skipping it" % (node_name, filename), file=sys.stderr)
+                continue
+            with open(filename, 'r') as fd:
+                x, y, _, _ = node.parse_csvdataset(fd)
+            X_new.append(x)
+            y_new.append(y)
+            new_files.append({'file': os.path.abspath(filename), 'fingerprint': fingerprint, 'rows': len(x)})
+            applied.add(fingerprint)
+        if not new_files:
+            continue
+
+        previous_files = refreshed_files(node, lineage)
+        method, scaler_update = incremental.refresh(node, np.concatenate(X_new), np.concatenate(y_new), train_file, args.full,
+                                                    conf.getint(node_name, 'refresh-epochs', fallback=conf.getint('ids', 'refresh-epochs', fallback=5)),
+                                                    conf.getint(node_name, 'refresh-estimators', fallback=conf.getint('ids', 'refresh-estimators', fallback=10)),
+                                                    [f['file'] for f in previous_files])
+        if method == 'full_retrain':
+            drop_refreshes(node, lineage, previous_files)
+        node.artifacts.put(node.saved_model_file, node.pipeline(), refreshed=True)
+        lineage['refreshes'].append({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': new_files, 'method': method,
+                                     'scaler': scaler_update, 'seconds': round(time.time() - start_time, 3)})
+        write_lineage(node, lineage)
+        print("%s refreshed in %f seconds, model in %s" % (node_name, time.time() - start_time, node.saved_model_file), file=sys.stderr)
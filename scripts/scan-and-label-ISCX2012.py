@@ -1,32 +1,121 @@
 """Script to scan ISCX-IDS2012 dataset for Attack IPs and label the generated dataset
 
+The labelled flows xml is parsed incrementally and the sources of its Attack flows are indexed (with the
+time intervals of their attacks); every row of the csv generated by flows.py is then labelled with a
+single lookup of the source address of its flow_id. Big csvs are split in byte ranges labelled in parallel.
+
+Rows carry no capture time (the flow_id is addresses, ports, protocol and a counter), so attack intervals can't be
+matched per row: --window only keeps the attackers with an attack in the window the csv was extracted from.
+
 Usage
 
-python scan-and-label-ISCX2012.py <xml-file> <csv-file> <label-to-replace-with>"""
-
-import sys
-tags = {}
-with open(sys.argv[1], "r") as fp:
-	for line in fp:
-		if "<source>" in line:
-			ip = line.split('>')[1].split('<')[0]
-			tags[ip] = []
-			for line in fp:
-				if "<Tag>" in line:
-					tag = line.split('>')[1].split('<')[0]
-					tags[ip].append(tag)
-					break
-				if "<source>" in line:
-					print(ip + " without tag")
-					exit(1)
-print([(ip, tags[ip]) for ip in tags if 'Attack' in tags[ip]])
-
-with open(sys.argv[2], "r") as main_file:
-	with open(sys.argv[2]+'.new','w') as replacement_file:
-		replacement_file.write(next(main_file)) # write header
-		for line in main_file:
-			if any(line.startswith(k) for k in tags if 'Attack' in tags[ip]):
-				line = line.replace('unknown', sys.argv[3])
-			else:
-				line = line.replace('unknown', 'BENIGN')
-			replacement_file.write(line)
+python scan-and-label-ISCX2012.py <xml-file> <csv-file> <label-to-replace-with> [-j JOBS] [--window START END] [-o OUTPUT]"""
+
+import os, sys, argparse, datetime
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+
+op = argparse.ArgumentParser(description="Label a flows.py dataset with the attacker addresses of an ISCX-IDS2012 labelled flows xml")
+op.add_argument('xml_file', help='ISCX labelled flows xml')
+op.add_argument('csv_file', help='dataset generated by flows.py')
+op.add_argument('label', help='label of the rows from attacker addresses (the others get BENIGN)')
+op.add_argument('-o', '--output', help='labelled dataset (default: <csv-file>.new)', dest='output')
+op.add_argument('-j', '--jobs', type=int, help='worker processes', dest='jobs', default=os.cpu_count())
+op.add_argument('--window', nargs=2, metavar=('START', 'END'), help='only attacks active in this window (YYYY-MM-DDTHH:MM:SS, as in the xml), e.g. the one given to flows.py --start/--end', dest='window')
+args = op.parse_args()
+
+ISCX_TIME = '%Y-%m-%dT%H:%M:%S'
+
+def parse_time(value):
+	return datetime.datetime.strptime(value, ISCX_TIME)
+
+def scan_attackers(filename):
+	'''Source address -> [(start, stop)] of its Attack flows, streaming the xml'''
+	attackers = {}
+	n_flows = 0
+	context = ET.iterparse(filename, events=('start', 'end'))
+	_, root = next(context)
+	for event, elem in context:
+		if event != 'end':
+			continue
+		tag = elem.findtext('Tag')
+		if tag is None:
+			continue
+		n_flows += 1
+		if tag == 'Attack':
+			source = elem.findtext('source')
+			if source is None:
+				print("Attack flow without source in %s" % filename, file=sys.stderr)
+				exit(1)
+			attackers.setdefault(source, []).append((parse_time(elem.findtext('startDateTime')), parse_time(elem.findtext('stopDateTime'))))
+		root.clear() # flows are independent, drop the parsed ones so memory stays bounded
+	print("%d flows, %d attacker addresses" % (n_flows, len(attackers)), file=sys.stderr)
+	return attackers
+
+def in_window(intervals, window):
+	return any(start <= window[1] and stop >= window[0] for start, stop in intervals)
+
+def byte_ranges(filename, n):
+	'''n (start, end) offsets splitting filename at line boundaries, after the header'''
+	size = os.path.getsize(filename)
+	with open(filename, 'rb') as fd:
+		fd.readline()
+		offsets = [fd.tell()]
+		for i in range(1, n):
+			fd.seek(max(offsets[-1], size * i // n))
+			fd.readline()
+			offsets.append(fd.tell())
+	offsets.append(size)
+	return [(offsets[i], offsets[i+1]) for i in range(n) if offsets[i] < offsets[i+1]]
+
+attackers = None # source addresses (bytes) of the attacks, set in every worker by set_attackers
+
+def set_attackers(addresses):
+	'''Worker initializer, so the workers get the attackers whatever the start method (fork, spawn, forkserver)'''
+	global attackers
+	attackers = addresses
+
+def label_range(start, end, part_filename):
+	'''Label the rows between offsets start and end of the csv, returns the number of attack rows'''
+	n_attacks = 0
+	label = args.label.encode('utf-8')
+	with open(args.csv_file, 'rb') as fd, open(part_filename, 'wb') as of:
+		fd.seek(start)
+		while fd.tell() < end:
+			line = fd.readline()
+			row, sep, row_label = line.rstrip(b'\n').rpartition(b',')
+			if row_label == b'unknown':
+				if line[:line.index(b'-')] in attackers:
+					row_label = label
+					n_attacks += 1
+				else:
+					row_label = b'BENIGN'
+			of.write(row + sep + row_label + b'\n')
+	return n_attacks
+
+if __name__ == '__main__':
+	attackers = scan_attackers(args.xml_file)
+	if args.window:
+		window = (parse_time(args.window[0]), parse_time(args.window[1]))
+		attackers = {ip: intervals for ip, intervals in attackers.items() if in_window(intervals, window)}
+	print([(ip, len(intervals)) for ip, intervals in attackers.items()])
+	attackers = set([ip.encode('utf-8') for ip in attackers])
+
+	output = args.output or args.csv_file + '.new'
+	ranges = byte_ranges(args.csv_file, max(args.jobs, 1))
+	parts = ['%s.part%d' % (output, i) for i in range(len(ranges))]
+	with Pool(max(args.jobs, 1), initializer=set_attackers, initargs=(attackers,)) as pool:
+		n_attacks = sum(pool.starmap(label_range, [(start, end, part) for (start, end), part in zip(ranges, parts)]))
+
+	with open(output, 'wb') as of:
+		with open(args.csv_file, 'rb') as fd:
+			of.write(fd.readline()) # write header
+		for part in parts:
+			with open(part, 'rb') as fd:
+				while True:
+					block = fd.read(1 << 20)
+					if not block:
+						break
+					of.write(block)
+			os.remove(part)
+	print("%d rows labelled %s" % (n_attacks, args.label), file=sys.stderr)
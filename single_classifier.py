@@ -7,18 +7,20 @@ AUTHOR:
 Fabio Almeida <fabio4335@gmail.com>
 """
 
-import os, argparse, re, sys
+import os, argparse, re, sys, glob
 import numpy as np
 from lib.node import NodeModel
+from lib.log import Stats
+from lib.config import read_config
 import threading
-import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 # =====================
 #     CLI OPTIONS
 # =====================
 
 op = argparse.ArgumentParser(description="Multilayered AI traffic classifier")
-op.add_argument('-i', '--input', metavar='FILE', dest='input', help='csv file with test data. If none is given stdin is read')
+op.add_argument('-i', '--input', metavar='FILE', nargs='+', dest='inputs', help='csv files (or globs) with test data, classified in parallel with per file and total stats. If none is given stdin is read')
 op.add_argument('-d', '--disable-load', action='store_true', help="disable loading of previously created models", dest='disable_load')
 op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
 op.add_argument('-c', '--config-file', help="configuration file", dest='config_file', default='configs/ids.cfg')
@@ -29,9 +31,7 @@ args = op.parse_args()
 # =====================
 flow_results = dict()
 # load config file settings
-conf = configparser.ConfigParser(allow_no_value=True)
-conf.optionxform=str
-conf.read(args.config_file)
+conf = read_config(args.config_file)
 
 # load train files
 L1_TRAIN_FILE = conf.get('ids', 'l1')
@@ -45,18 +45,46 @@ CHUNK_SIZE = conf.getint('ids', 'chunk-size')
 l1 = NodeModel('l1', conf, verbose=args.verbose)
 l1.train(L1_TRAIN_FILE, args.disable_load)
 
-if args.verbose: print("Reading Test Dataset in chunks...")
-fd = open(args.input, 'r') if args.input else sys.stdin
-for test_data in l1.yield_csvdataset(fd, CHUNK_SIZE): # launch threads
-	l1.predict(test_data)
+def classify_input(filename, stats=None):
+	'''Classify a csv file (stdin if None) in chunks, counting the results in stats (l1.stats if None)'''
+	fd = open(filename, 'r') if filename else sys.stdin
+	for test_data in l1.yield_csvdataset(fd, CHUNK_SIZE):
+		l1.predict(test_data, stats)
+	if fd != sys.stdin: fd.close()
+
+inputs = []
+for pattern in args.inputs or []: # expand globs, keeping the given order
+	for filename in sorted(glob.glob(pattern)) or [pattern]:
+		if filename not in inputs: inputs.append(filename)
+missing = [f for f in inputs if not os.path.isfile(f)]
+if missing:
+	print("Input files not found: %s" % ', '.join(missing), file=sys.stderr)
+	exit()
 
-if fd != sys.stdin: fd.close()
+if args.verbose: print("Reading Test Dataset in chunks...")
+if len(inputs) > 1:
+	# every file has its own stats, l1.stats gets their sum
+	file_stats = [Stats(l1) for _ in inputs]
+	with ThreadPoolExecutor(max_workers=conf.getint('ids', 'max-threads')) as executor:
+		list(executor.map(classify_input, inputs, file_stats))
+	for stats in file_stats:
+		l1.stats.merge(stats)
+else:
+	classify_input(inputs[0] if inputs else None)
 
 # =====================
 #   PRINT FINAL STATS
 # =====================
 
-if args.input: print(os.path.basename(args.input))
+if len(inputs) > 1:
+	for filename, stats in zip(inputs, file_stats):
+		print("\033[1;35m%s\033[m" % os.path.basename(filename))
+		print("\033[1;36m    LAYER 1\033[m")
+		print(stats)
+		l1.logger.log("%s %s\n" % (filename, l1.node_name) + str(stats))
+	print("\033[1;35mTOTAL (%d files)\033[m" % len(inputs))
+elif inputs: print(os.path.basename(inputs[0]))
 print("\033[1;36m    LAYER 1\033[m")
 print(l1.stats)
 l1.logger.log("%s\n" % l1.node_name + str(l1.stats))
+if l1.prediction_cache: print(l1.prediction_cache)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""This file contains the configuration sweep runner: every given configuration file is
+evaluated on the same test dataset, in parallel, and the stats of every node are written to a csv table
+
+Train and test datasets are parsed once and shared with the worker processes through shared memory.
+Fitted nodes are looked up in the model cache of every node (keyed by its settings and train data),
+so a node shared by several configurations (e.g. the same l1 in every configs/test/*.cfg) is only fitted once.
+
+AUTHORS:
+
+Joao Meira <joao.meira@tekever.com>
+Fabio Almeida <fabio4335@gmail.com>
+"""
+
+import os, argparse, sys, time, glob, csv
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from lib.node import NodeModel
+from lib.cascade import Cascade
+from lib.config import read_config
+
+# =====================
+#     CLI OPTIONS
+# =====================
+
+op = argparse.ArgumentParser(description="Evaluate many classifier configurations on the same test data")
+op.add_argument('configs', metavar='CONFIG', nargs='+', help='configuration files (or globs, e.g. "configs/test/*.cfg")')
+op.add_argument('-i', '--input', metavar='FILE', dest='input', required=True, help='csv file with test data')
+op.add_argument('-o', '--output', metavar='FILE', dest='output', default='sweep.csv', help='csv file with the results table')
+op.add_argument('-j', '--jobs', type=int, dest='jobs', default=os.cpu_count(), help='number of worker processes')
+op.add_argument('-v', '--verbose', action='store_true', help="Verbose output.", dest='verbose')
+args = op.parse_args()
+
+# =====================
+#    SHARED DATASETS
+# =====================
+
+class SharedDataset:
+    '''x, labels and flow ids of a dataset stored in shared memory, can be sent to worker processes'''
+
+    def __init__(self, arrays=None):
+        self.blocks = {}
+        self.specs = {}
+        for name, array in (arrays or {}).items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    @classmethod
+    def read_csv(cls, filename):
+        with open(filename, 'r') as fd:
+            x, labels, flow_ids = NodeModel.read_csvdataset(fd)
+        return cls({'x': np.array(x, dtype='float64').reshape(len(x), -1), 'labels': np.array(labels, dtype=str), 'flow_ids': np.array(flow_ids, dtype=str)})
+
+    def __getstate__(self):
+        return self.specs
+
+    def __setstate__(self, specs):
+        self.specs = specs
+        self.blocks = {name: shared_memory.SharedMemory(name=spec[0]) for name, spec in specs.items()}
+
+    def arrays(self):
+        return [np.ndarray(self.specs[name][1], dtype=self.specs[name][2], buffer=self.blocks[name].buf) for name in ('x', 'labels', 'flow_ids')]
+
+    def unlink(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+# =====================
+#     NODE MEMOIZING
+# =====================
+
+def fit_node(config_file, node_name, entry_file, dataset):
+    '''Worker: fit a node on a shared train dataset and save it to the model cache'''
+    start_time = time.time()
+    node = NodeModel(node_name, read_config(config_file), verbose=args.verbose)
+    X_train, y_train, _, _ = node.process_data(*dataset.arrays(), dtype='float64')
+    node.fit(X_train, y_train)
+    node.artifacts.put(entry_file, node.pipeline())
+    return time.time() - start_time
+
+def evaluate(config_file, entry_files, dataset):
+    '''Worker: run the test dataset through a configuration, returns a row per node and label'''
+    start_time = time.time()
+    cascade = Cascade(read_config(config_file), config_file, verbose=args.verbose)
+    for node in cascade.nodes:
+        node.set_pipeline(node.artifacts.get(entry_files[node.node_name]))
+    cascade.check_dtypes()
+    x, labels, flow_ids = dataset.arrays()
+    for start in range(0, len(x), cascade.chunk_size):
+        end = start + cascade.chunk_size
+        cascade.predict_chunk(cascade.l1.process_data(x[start:end], labels[start:end], flow_ids[start:end]))
+    elapsed = time.time() - start_time
+
+    rows = []
+    for node in cascade.nodes:
+        confusion_matrix, total_correct = node.stats.merged()
+        row = {'config': config_file, 'node': node.node_name, 'model': ' '.join(node.classifier.split()),
+               'n': int(confusion_matrix.sum()), 'correct': total_correct, 'seconds': round(elapsed, 3)}
+        for label, metrics in node.stats.metrics().items():
+            rows.append(dict(row, label=label, **metrics))
+        if not node.stats.metrics():
+            rows.append(row)
+    return rows
+
+# =====================
+#         RUN
+# =====================
+
+if __name__ == '__main__':
+    config_files = sorted(set([f for pattern in args.configs for f in (glob.glob(pattern) or [pattern])]))
+    start_time = time.time()
+
+    # every distinct node of every configuration, by model cache file
+    config_keys = {}
+    to_fit = {}
+    for config_file in config_files:
+        conf = read_config(config_file)
+        names = ['l1'] + Cascade.l2_names(conf)
+        config_keys[config_file] = {}
+        for node_name in names:
+            node = NodeModel(node_name, conf)
+            key = node.artifacts.entry_file(conf.get('ids', node_name), node.settings())
+            config_keys[config_file][node_name] = key
+            if not os.path.isfile(key):
+                to_fit[key] = (config_file, node_name, conf.get('ids', node_name))
+    print("%d configurations, %d distinct nodes, %d to fit" % (len(config_files), len(set([k for keys in config_keys.values() for k in keys.values()])), len(to_fit)), file=sys.stderr)
+
+    datasets = {}
+    try:
+        for train_file in set([item[2] for item in to_fit.values()]):
+            datasets[train_file] = SharedDataset.read_csv(train_file)
+        datasets[args.input] = test_dataset = SharedDataset.read_csv(args.input)
+        print("Datasets parsed in " + str(time.time() - start_time) + " seconds", file=sys.stderr)
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            # fit every missing node once
+            futures = {key: executor.submit(fit_node, config_file, node_name, key, datasets[train_file]) for key, (config_file, node_name, train_file) in to_fit.items()}
+            for key, future in futures.items():
+                print("%s (%s) fitted in %f seconds" % (to_fit[key][1], to_fit[key][0], future.result()), file=sys.stderr)
+
+            # evaluate every configuration
+            futures = [executor.submit(evaluate, config_file, config_keys[config_file], test_dataset) for config_file in config_files]
+            rows = [row for future in futures for row in future.result()]
+    finally:
+        for dataset in datasets.values():
+            dataset.unlink()
+
+    columns = ['config', 'node', 'model', 'label', 'n', 'correct', 'Overall Acc', 'Recall', 'Miss Rate', 'Specificity', 'Fallout', 'Precision', 'F1 score', 'Mcc', 'seconds']
+    with open(args.output, 'w', newline='') as fd:
+        writer = csv.DictWriter(fd, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print("%d configurations evaluated in %f seconds, results in %s" % (len(config_files), time.time() - start_time, args.output), file=sys.stderr)